@@ -0,0 +1,62 @@
+# Время холодного старта: сколько занимает `import main` в свежем интерпретаторе
+# и какие модули тяжелее всего (по данным python -X importtime).
+#
+#   python bench/cold_start.py --runs 10
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_import(workdir: str, importtime: bool = False):
+    env = dict(MISTRAL_API_KEY="bench", GROQ_API_KEY="bench", OPENROUTER_API_KEY="bench")
+    env.update(os.environ, BOT_TOKEN="123456789:BENCH-token-for-cold-start", PYTHONPATH=ROOT,
+               METRICS_PORT="0", SHARD_WORKERS="0")
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", "import main"]
+    started = time.perf_counter()
+    result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        sys.exit(f"import main завершился с ошибкой:\n{result.stderr}")
+    return elapsed, result.stderr
+
+
+def heaviest_imports(importtime_output: str, top: int):
+    # Строки вида "import time:  self [us] | cumulative | <отступ по вложенности>имя";
+    # берём сам main и то, что он импортирует напрямую
+    rows = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name_field = line.split(":", 1)[1].split("|")
+        level = (len(name_field) - len(name_field.lstrip()) - 1) // 2
+        if level <= 1:
+            rows.append((int(cumulative_us), name_field.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер холодного старта import main")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--top", type=int, default=10, help="сколько самых тяжёлых модулей показать")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bot-cold-start-") as workdir:
+        run_import(workdir)  # первый запуск прогревает кэш байткода и файловой системы
+        times = [run_import(workdir)[0] for _ in range(args.runs)]
+        _, importtime_output = run_import(workdir, importtime=True)
+
+    print(f"import main, {args.runs} запусков: медиана {statistics.median(times):.3f} с, "
+          f"мин {min(times):.3f} с, макс {max(times):.3f} с")
+    print("\nСамые тяжёлые импорты верхнего уровня (накопительно):")
+    for cumulative_us, name in heaviest_imports(importtime_output, args.top):
+        print(f"  {cumulative_us / 1000:8.1f} мс  {name}")
+
+
+if __name__ == "__main__":
+    main()
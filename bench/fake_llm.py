@@ -0,0 +1,115 @@
+# Заглушка OpenAI-совместимого API (Mistral, OpenRouter) и распознавания речи Groq.
+# Задержка, скорость «генерации» потока и доля ошибок настраиваются — так можно
+# проверить переключение на запасные модели, хеджирование и поведение под нагрузкой.
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeLLMServer:
+    def __init__(self, latency=0.5, jitter=0.2, token_delay=0.01, tokens=60,
+                 error_rate=0.0, error_status=503, seed=None):
+        self.latency = latency          # задержка до первого токена, с
+        self.jitter = jitter            # разброс задержки, доля от latency
+        self.token_delay = token_delay  # пауза между фрагментами потока, с
+        self.tokens = tokens            # длина ответа в «словах»
+        self.error_rate = error_rate    # доля запросов, на которые отвечаем ошибкой
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.runner = None
+        self.port = None
+
+    def _delay(self):
+        return max(0.0, self.latency * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def _answer_words(self, model):
+        return [f"слово{i}" for i in range(self.tokens - 1)] + [f"({model})"]
+
+    def _maybe_error(self):
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            body = {"error": {"message": "injected failure", "type": "server_error"}}
+            return web.json_response(body, status=self.error_status)
+        return None
+
+    async def chat_completions(self, request: web.Request):
+        self.requests += 1
+        payload = await request.json()
+        model = payload.get("model", "fake")
+        await asyncio.sleep(self._delay())
+        error = self._maybe_error()
+        if error:
+            return error
+        words = self._answer_words(model)
+        created = int(time.time())
+        if not payload.get("stream"):
+            return web.json_response({
+                "id": f"cmpl-{self.requests}",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 10, "completion_tokens": len(words), "total_tokens": 10 + len(words)},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for index, word in enumerate(words):
+            chunk = {
+                "id": f"cmpl-{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": word + " "},
+                    "finish_reason": "stop" if index == len(words) - 1 else None,
+                }],
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def transcriptions(self, request: web.Request):
+        self.requests += 1
+        await request.read()
+        await asyncio.sleep(self._delay())
+        error = self._maybe_error()
+        if error:
+            return error
+        return web.json_response({"text": "Привет, это распознанное голосовое сообщение для теста"})
+
+    async def dispatch(self, request: web.Request):
+        # Пути у провайдеров разные (/v1, /api/v1, /openai/v1) — смотрим только на окончание
+        path = request.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            return await self.chat_completions(request)
+        if path.endswith("/audio/transcriptions"):
+            return await self.transcriptions(request)
+        return web.json_response({"error": {"message": f"unknown path {path}"}}, status=404)
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/{tail:.*}", self.dispatch)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
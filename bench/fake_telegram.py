@@ -0,0 +1,113 @@
+# Заглушка Bot API: принимает запросы бота, отвечает правдоподобными объектами
+# и отдаёт «загруженные пользователями» файлы (голосовые, документы) по getFile.
+# Бот подключается к ней через TELEGRAM_API_URL.
+import asyncio
+import json
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Методы, которые возвращают отправленное сообщение
+MESSAGE_METHODS = {
+    "sendMessage", "editMessageText", "sendDocument", "sendVoice", "sendPhoto",
+    "sendAudio", "editMessageReplyMarkup", "editMessageCaption",
+}
+
+
+class FakeTelegramServer:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.files = {}
+        self.calls = Counter()
+        self.sent_bytes = 0
+        self.message_id = 0
+        self.runner = None
+        self.port = None
+
+    def add_file(self, file_id: str, data: bytes, file_path: str):
+        self.files[file_id] = (file_path, data)
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        form = await request.post()
+        for key, value in form.items():
+            if hasattr(value, "file"):
+                data = value.file.read()
+                self.sent_bytes += len(data)
+                params[key] = f"<{len(data)} bytes>"
+            else:
+                params[key] = value
+        return params
+
+    def _message(self, params: dict) -> dict:
+        self.message_id += 1
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            chat_id = 0
+        message = {
+            "message_id": int(params.get("message_id") or self.message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+            self.sent_bytes += len(str(params["text"]).encode())
+        return message
+
+    async def handle_method(self, request: web.Request):
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in MESSAGE_METHODS:
+            result = self._message(params)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method == "getFile":
+            file_id = params.get("file_id")
+            if file_id not in self.files:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}, status=400)
+            file_path, data = self.files[file_id]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data), "file_path": file_path}
+        elif method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            result = [self._message(params) for _ in media]
+        elif method == "getUpdates":
+            await asyncio.sleep(1)
+            result = []
+        else:
+            # sendChatAction, deleteMessage, answerCallbackQuery, setMyCommands...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request):
+        file_path = request.match_info["path"]
+        for path, data in self.files.values():
+            if path == file_path:
+                return web.Response(body=data)
+        return web.Response(status=404)
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
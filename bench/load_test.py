@@ -0,0 +1,323 @@
+# Нагрузочный тест бота без сети: заглушки Bot API и LLM поднимаются локально,
+# синтетические пользователи шлют обновления через настоящий диспетчер dp.
+#
+#   python bench/load_test.py --users 50 --duration 60
+#   python bench/load_test.py --mix text=6,voice=2,document=1,search=1 --llm-error-rate 0.05
+#   python bench/load_test.py --json result.json                 # сохранить результат
+#   python bench/load_test.py --baseline result.json --tolerance 0.2   # сравнить с прошлым
+#
+# Каждый пользователь ждёт ответа на своё сообщение, прежде чем отправить следующее.
+# Задержка — от передачи обновления в dp до конца обработки (включая очередь сообщений
+# пользователя). Данные пишутся во временную папку, рабочая user_data не трогается.
+# Настройки самого бота берутся из окружения как обычно: например, голосовые упираются
+# в GROQ_REQUESTS_PER_MINUTE, и это видно по их p95.
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm import FakeLLMServer  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+TEXTS = [
+    "Привет! Как дела?",
+    "Объясни, как работает сортировка слиянием",
+    "Напиши короткое стихотворение про осень",
+    "Какие есть способы ускорить Python-код?",
+    "Переведи на английский: хорошего дня",
+    "Что такое консистентное хеширование?",
+]
+SEARCH_QUERIES = [f"новости технологий {i}" for i in range(40)] + ["погода в Москве", "курс доллара"]
+KINDS = ("text", "voice", "document", "search")
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"неизвестный тип сообщения: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_pdf() -> bytes:
+    try:
+        import fitz
+    except ImportError:
+        return b""
+    pdf = fitz.open()
+    for page_number in range(3):
+        page = pdf.new_page()
+        page.insert_text((72, 72), f"Benchmark page {page_number + 1}\n" + "Lorem ipsum dolor sit amet. " * 20)
+    return pdf.tobytes()
+
+
+class TrafficGenerator:
+    def __init__(self, main, telegram: FakeTelegramServer, args):
+        self.main = main
+        self.telegram = telegram
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.kinds = list(args.mix)
+        self.weights = [args.mix[kind] for kind in self.kinds]
+        self.update_id = 0
+        self.latencies = defaultdict(list)
+        self.rss_samples = []
+
+        self.telegram.add_file("bench-voice", b"OggS" + bytes(2000), "voice/bench.oga")
+        self.telegram.add_file("bench-txt", ("Строка отчёта для нагрузочного теста.\n" * 200).encode(), "documents/report.txt")
+        self.pdf = make_pdf()
+        if self.pdf:
+            self.telegram.add_file("bench-pdf", self.pdf, "documents/report.pdf")
+
+    def _update(self, user_id: int, **message) -> dict:
+        self.update_id += 1
+        message.update({
+            "message_id": self.update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"},
+        })
+        return {"update_id": self.update_id, "message": message}
+
+    def build(self, kind: str, user_id: int) -> dict:
+        if kind == "voice":
+            voice = {"file_id": "bench-voice", "file_unique_id": "bench-voice", "duration": 4,
+                     "mime_type": "audio/ogg", "file_size": 2004}
+            return self._update(user_id, voice=voice)
+        if kind == "document":
+            use_pdf = self.pdf and self.random.random() < 0.5
+            file_id, name = ("bench-pdf", "report.pdf") if use_pdf else ("bench-txt", "report.txt")
+            size = len(self.telegram.files[file_id][1])
+            document = {"file_id": file_id, "file_unique_id": file_id, "file_name": name, "file_size": size}
+            return self._update(user_id, document=document, caption="Кратко перескажи файл")
+        if kind == "search":
+            text = "/search " + self.random.choice(SEARCH_QUERIES)
+            return self._update(user_id, text=text, entities=[{"type": "bot_command", "offset": 0, "length": 7}])
+        return self._update(user_id, text=self.random.choice(TEXTS))
+
+    async def _wait_done(self, user_id: int):
+        # Текст (и распознанный голос/документ) обрабатывается в очереди пользователя
+        while user_id in self.main._inboxes:
+            await asyncio.sleep(0.002)
+
+    async def send(self, kind: str, user_id: int):
+        from aiogram import types
+        update = types.Update.model_validate(self.build(kind, user_id), context={"bot": self.main.bot})
+        started = time.perf_counter()
+        await self.main.dp.feed_update(self.main.bot, update)
+        await self._wait_done(user_id)
+        self.latencies[kind].append(time.perf_counter() - started)
+
+    async def user_loop(self, user_id: int, deadline: float):
+        while time.monotonic() < deadline:
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            await self.send(kind, user_id)
+            if self.args.think_time:
+                await asyncio.sleep(self.random.expovariate(1 / self.args.think_time))
+
+    async def sample_memory(self):
+        while True:
+            self.rss_samples.append(rss_mb())
+            await asyncio.sleep(0.5)
+
+    async def run(self) -> dict:
+        user_ids = [10_000 + i for i in range(self.args.users)]
+        if self.args.warmup:
+            # Прогрев: первый запрос каждого типа (импорты, пул процессов, соединения)
+            for kind in self.kinds:
+                await self.send(kind, user_ids[0])
+            self.latencies.clear()
+
+        rss_start = rss_mb()
+        sampler = asyncio.create_task(self.sample_memory())
+        started = time.monotonic()
+        deadline = started + self.args.duration
+        await asyncio.gather(*(self.user_loop(user_id, deadline) for user_id in user_ids))
+        elapsed = time.monotonic() - started
+        sampler.cancel()
+        await self.main.flush_user_data()
+        rss_end = rss_mb()
+
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        result = {
+            "users": self.args.users,
+            "duration": elapsed,
+            "messages": len(all_latencies),
+            "messages_per_second": len(all_latencies) / elapsed if elapsed else 0.0,
+            "latency": {},
+            "memory_mb": {
+                "start": rss_start,
+                "peak": max(self.rss_samples + [rss_end]),
+                "end": rss_end,
+                "growth": rss_end - rss_start,
+            },
+        }
+        for kind, values in list(self.latencies.items()) + [("all", all_latencies)]:
+            result["latency"][kind] = {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+            }
+        return result
+
+
+def metric_total(metric, exclude_service=None) -> float:
+    total = 0
+    for key, value in metric.values.items():
+        labels = dict(zip(metric.labels, key))
+        if exclude_service and labels.get("service") == exclude_service:
+            continue
+        total += value
+    return total
+
+
+def print_report(result: dict):
+    print(f"\nПользователей: {result['users']}, длительность {result['duration']:.1f} с")
+    print(f"Сообщений: {result['messages']}, {result['messages_per_second']:.1f} сообщ./с")
+    print(f"\n{'тип':<10}{'кол-во':>8}{'p50, с':>10}{'p95, с':>10}{'p99, с':>10}")
+    for kind, stats in result["latency"].items():
+        print(f"{kind:<10}{stats['count']:>8}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}")
+    memory = result["memory_mb"]
+    print(f"\nПамять (RSS): {memory['start']:.1f} → {memory['end']:.1f} МБ, пик {memory['peak']:.1f} МБ, "
+          f"рост {memory['growth']:+.1f} МБ")
+    print(f"Ошибки: обработчиков {result['handler_errors']:.0f}, внешних вызовов {result['external_errors']:.0f}, "
+          f"запросов к LLM {result['llm_requests']} (отказов внедрено {result['llm_injected_errors']})")
+    print(f"Вызовы Bot API: {result['telegram_calls']}")
+
+
+def compare_with_baseline(result: dict, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    problems = []
+    for kind, stats in result["latency"].items():
+        old = baseline.get("latency", {}).get(kind)
+        if old and old["p95"] and stats["p95"] > old["p95"] * (1 + tolerance):
+            problems.append(f"p95 для {kind}: {old['p95']:.3f} → {stats['p95']:.3f} с")
+    old_rate = baseline.get("messages_per_second", 0)
+    if old_rate and result["messages_per_second"] < old_rate * (1 - tolerance):
+        problems.append(f"пропускная способность: {old_rate:.1f} → {result['messages_per_second']:.1f} сообщ./с")
+    return problems
+
+
+async def run(args) -> int:
+    llm = FakeLLMServer(latency=args.llm_latency, token_delay=args.token_delay, tokens=args.tokens,
+                        error_rate=args.llm_error_rate, seed=args.seed)
+    telegram = FakeTelegramServer(latency=args.telegram_latency)
+    llm_url = await llm.start()
+    telegram_url = await telegram.start()
+
+    os.environ.update({
+        "BOT_TOKEN": "123456789:BENCH-token-for-local-fake-server",
+        "TELEGRAM_API_URL": telegram_url,
+        "MISTRAL_API_KEY": "bench",
+        "OPENROUTER_API_KEY": "bench",
+        "GROQ_API_KEY": "bench",
+        "MISTRAL_BASE_URL": f"{llm_url}/v1",
+        "OPENROUTER_BASE_URL": f"{llm_url}/api/v1",
+        "GROQ_BASE_URL": llm_url,
+        "METRICS_PORT": "0",
+        "SHARD_WORKERS": "0",
+        "ADMIN_ID": "1",
+    })
+    # По умолчанию без паузы на склейку сообщений: пользователи теста не пишут очередями
+    os.environ.setdefault("MESSAGE_DEBOUNCE_SECONDS", "0")
+    os.environ["STREAM_RESPONSES"] = "true" if args.stream else "false"
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)
+    import main
+
+    def fake_google_search(query, num_results=5, advanced=True, lang="ru"):
+        time.sleep(args.search_latency)
+        return [SimpleNamespace(title=f"Результат {i} по «{query}»", url=f"https://example.com/{i}",
+                                description="Описание найденной страницы. " * 5) for i in range(num_results)]
+    main.google_search = fake_google_search
+
+    generator = TrafficGenerator(main, telegram, args)
+    try:
+        result = await generator.run()
+    finally:
+        if main._process_pool is not None:
+            main._process_pool.shutdown(wait=False, cancel_futures=True)
+        main.close_storage()
+        await main.bot.session.close()
+        await llm.stop()
+        await telegram.stop()
+        os.chdir("/")
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result["handler_errors"] = metric_total(main.HANDLER_ERRORS)
+    result["external_errors"] = metric_total(main.EXTERNAL_ERRORS, exclude_service="telegram")
+    result["llm_requests"] = llm.requests
+    result["llm_injected_errors"] = llm.errors
+    result["telegram_calls"] = dict(telegram.calls.most_common())
+    print_report(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        problems = compare_with_baseline(result, args.baseline, args.tolerance)
+        if problems:
+            print("\nРегрессия относительно", args.baseline)
+            for problem in problems:
+                print(" -", problem)
+            return 1
+        print("\nРегрессий относительно", args.baseline, "нет")
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных заглушках")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--duration", type=float, default=30, help="длительность, с")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=7,voice=1,document=1,search=1"),
+                        help="доли типов сообщений, например text=7,voice=1,document=1,search=1")
+    parser.add_argument("--think-time", type=float, default=0.0, help="средняя пауза пользователя между сообщениями, с")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="задержка LLM до первого токена, с")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="пауза между фрагментами потока, с")
+    parser.add_argument("--tokens", type=int, default=80, help="длина ответа LLM в словах")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="доля ответов LLM с ошибкой 503")
+    parser.add_argument("--telegram-latency", type=float, default=0.01, help="задержка ответов Bot API, с")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="задержка поиска Google, с")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True, help="потоковые ответы")
+    parser.add_argument("--warmup", action=argparse.BooleanOptionalAction, default=True, help="прогрев перед замером")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результат в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение p95 и сообщ./с")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
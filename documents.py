@@ -0,0 +1,183 @@
+# Тяжёлая работа с документами, которая выполняется в пуле процессов (см. main.py).
+# Модуль намеренно не импортирует main: дочерним процессам не нужно поднимать бота,
+# клиентов API и хранилище только ради разбора PDF.
+
+
+def extract_pdf_text(path: str, max_pages: int, max_chars: int, time_budget: float):
+    # Весь разбор PDF — один вызов в процессе пула: файл открывается один раз (по пути,
+    # без передачи байтов между процессами), а бюджеты времени, страниц и объёма
+    # проверяются здесь же после каждой страницы.
+    # Возвращает (текст, прочитано страниц, всего страниц, причина остановки или None).
+    import time
+    import fitz  # PyMuPDF
+
+    deadline = time.monotonic() + time_budget
+    parts = []
+    total = 0
+    reason = None
+    with fitz.open(path) as pdf_document:
+        page_count = pdf_document.page_count
+        for index in range(min(page_count, max_pages)):
+            if time.monotonic() >= deadline:
+                reason = "time"
+                break
+            text = pdf_document[index].get_text()
+            parts.append(text)
+            total += len(text)
+            if total >= max_chars:
+                reason = "chars"
+                break
+        else:
+            if page_count > max_pages:
+                reason = "pages"
+    return "".join(parts)[:max_chars], len(parts), page_count, reason
+
+
+def _docx_table_text(table) -> str:
+    rows = []
+    for row in table.rows:
+        cells = []
+        for cell in row.cells:
+            text = cell.text.strip()
+            # Объединённые ячейки python-docx возвращает несколько раз подряд
+            if not cells or cells[-1] != text:
+                cells.append(text)
+        rows.append(" | ".join(cells))
+    return "\n".join(rows)
+
+
+def extract_docx(path: str) -> str:
+    # Абзацы и таблицы в том порядке, в котором они идут в документе
+    import docx
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+
+    doc = docx.Document(path)
+    parts = []
+    for child in doc.element.body.iterchildren():
+        tag = child.tag.rsplit("}", 1)[-1]
+        if tag == "p":
+            parts.append(Paragraph(child, doc).text)
+        elif tag == "tbl":
+            parts.append(_docx_table_text(Table(child, doc)))
+    return "\n".join(parts)
+
+
+def ping() -> bool:
+    # Пустая задача для прогрева пула при старте бота
+    return True
+
+
+# --- Создание файлов ---
+# Шрифты с кириллицей: сначала типичные пути Linux, потом Windows
+FONT_CANDIDATES = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    "/usr/share/fonts/liberation-sans/LiberationSans-Regular.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf",
+    "/usr/share/fonts/noto/NotoSans-Regular.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+)
+PDF_FONT_NAME = "DocFont"
+_registered_font = None
+
+
+def find_cyrillic_font(preferred: str = None):
+    # Ищем TTF-шрифт с кириллицей один раз при старте. Если ни один из известных
+    # путей не подошёл, спрашиваем fontconfig.
+    import os
+    import shutil
+    import subprocess
+
+    for path in (preferred,) + FONT_CANDIDATES:
+        if path and os.path.isfile(path):
+            return path
+    if shutil.which("fc-match"):
+        try:
+            path = subprocess.run(
+                ["fc-match", "-f", "%{file}", "sans:lang=ru:fontformat=TrueType"],
+                capture_output=True, text=True, timeout=5
+            ).stdout.strip()
+            if path.lower().endswith(".ttf") and os.path.isfile(path):
+                return path
+        except (OSError, subprocess.SubprocessError):
+            pass
+    return None
+
+
+def _pdf_font(font_path):
+    # Регистрация шрифта в reportlab — один раз на процесс пула
+    global _registered_font
+    if not font_path:
+        return "Helvetica"  # без кириллицы
+    if _registered_font != font_path:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        pdfmetrics.registerFont(TTFont(PDF_FONT_NAME, font_path))
+        _registered_font = font_path
+    return PDF_FONT_NAME
+
+
+def render_docx(content: str) -> bytes:
+    from io import BytesIO
+    import docx
+
+    doc = docx.Document()
+    for line in content.split('\n'):
+        doc.add_paragraph(line)
+    file_io = BytesIO()
+    doc.save(file_io)
+    return file_io.getvalue()
+
+
+def render_pdf(content: str, font_path: str = None) -> bytes:
+    from io import BytesIO
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import simpleSplit
+    from reportlab.pdfgen import canvas
+
+    font_name = _pdf_font(font_path)
+    file_io = BytesIO()
+    c = canvas.Canvas(file_io, pagesize=A4)
+    width, height = A4
+    c.setFont(font_name, 12)
+    y = height - 50
+    margin = 50
+    max_width = width - 2 * margin
+
+    for line in content.split('\n'):
+        try:
+            wrapped_lines = simpleSplit(line, font_name, 12, max_width)
+        except Exception:
+            wrapped_lines = [line]
+
+        for wrapped_line in wrapped_lines:
+            if y < 50:
+                c.showPage()
+                c.setFont(font_name, 12)
+                y = height - 50
+            c.drawString(margin, y, wrapped_line)
+            y -= 15
+        y -= 5
+
+    c.save()
+    return file_io.getvalue()
+
+
+# --- Изображения ---
+def downscale_image(data: bytes, max_side: int = 1024, quality: int = 85) -> bytes:
+    # Уменьшенная копия фото в JPEG для кэша: поворот по EXIF, без прозрачности
+    from io import BytesIO
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side))
+        file_io = BytesIO()
+        image.save(file_io, format="JPEG", quality=quality, optimize=True)
+        return file_io.getvalue()
@@ -3,51 +3,90 @@ import logging
 import os
 import sys
 import urllib.parse
-import random
 import json
 import re
+import hashlib
+import gzip
+import zipfile
+import tempfile
+import base64
+import functools
+import sqlite3
+import threading
+import time
+import multiprocessing
+import heapq
+import contextvars
+import importlib
+import importlib.util
+import signal
+from bisect import bisect, bisect_left
+import contextlib
+from contextlib import asynccontextmanager
+from queue import Empty as QueueEmpty, Full as QueueFull
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
 from io import BytesIO
-from openai import AsyncOpenAI, AuthenticationError, RateLimitError
+from openai import AsyncOpenAI, AuthenticationError, RateLimitError, APIConnectionError, APIStatusError
 from dotenv import load_dotenv
 
-try:
-    import docx
-except ImportError:
-    docx = None
-    logging.warning("Библиотека python-docx не найдена. Чтение .docx не будет работать. Установите: pip install python-docx")
-try:
-    import fitz  # PyMuPDF
-except ImportError:
-    fitz = None
-    logging.warning("Библиотека PyMuPDF не найдена. Чтение .PDF не будет работать. Установите: pip install PyMuPDF")
-try:
-    from reportlab.lib.pagesizes import A4
-    from reportlab.pdfgen import canvas
-    from reportlab.pdfbase import pdfmetrics
-    from reportlab.pdfbase.ttfonts import TTFont
-    from reportlab.lib.utils import simpleSplit
-    reportlab_available = True
-except ImportError:
-    reportlab_available = False
-    logging.warning("Библиотека reportlab не найдена. Создание .PDF не будет работать. Установите: pip install reportlab")
-
-try:
-    import edge_tts
-except ImportError:
-    edge_tts = None
-    logging.warning("Библиотека edge-tts не найдена. Голосовые ответы не будут работать. Установите: pip install edge-tts")
-try:
-    from googlesearch import search as google_search
-except ImportError:
-    google_search = None
-    logging.warning("Библиотека googlesearch-python не найдена. Поиск не будет работать. Установите: pip install googlesearch-python")
-
-from groq import AsyncGroq  # Библиотека для распознавания голоса
-from aiogram import Bot, Dispatcher, types, F
+import documents
+
+class LazyModule:
+    # Необязательная библиотека: наличие проверяется сразу (find_spec не выполняет импорт),
+    # а сам импорт — при первом обращении. Большинство сообщений — обычный текст,
+    # и процессу незачем платить за загрузку PyMuPDF или edge-tts на старте.
+    # attr — взять из модуля один объект (например, функцию search).
+    def __init__(self, name: str, hint: str, attr: str = None):
+        self._name = name
+        self._attr = attr
+        self._target = None
+        self._lock = threading.Lock()
+        self.available = importlib.util.find_spec(name.split(".")[0]) is not None
+        if not self.available:
+            logging.warning(hint)
+
+    def load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    try:
+                        module = importlib.import_module(self._name)
+                    except ImportError:
+                        self.available = False
+                        raise
+                    self._target = getattr(module, self._attr) if self._attr else module
+        return self._target
+
+    def __bool__(self):
+        return self.available
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+# Чтение .docx/.pdf и создание .pdf выполняются в documents.py (в пуле процессов),
+# здесь нужны только проверки наличия
+docx = LazyModule("docx", "Библиотека python-docx не найдена. Чтение .docx не будет работать. Установите: pip install python-docx")
+fitz = LazyModule("fitz", "Библиотека PyMuPDF не найдена. Чтение .PDF не будет работать. Установите: pip install PyMuPDF")
+reportlab = LazyModule("reportlab", "Библиотека reportlab не найдена. Создание .PDF не будет работать. Установите: pip install reportlab")
+edge_tts = LazyModule("edge_tts", "Библиотека edge-tts не найдена. Голосовые ответы не будут работать. Установите: pip install edge-tts")
+google_search = LazyModule("googlesearch", "Библиотека googlesearch-python не найдена. Поиск не будет работать. Установите: pip install googlesearch-python", attr="search")
+pillow = LazyModule("PIL", "Библиотека Pillow не найдена. Фото будут храниться без уменьшения. Установите: pip install Pillow")
+groq = LazyModule("groq", "Библиотека groq не найдена. Распознавание голоса не будет работать. Установите: pip install groq")
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BotCommand, \
     InlineQuery, InlineQueryResultArticle, InputTextMessageContent
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError
 
 # Загрузка переменных окружения из .env
 load_dotenv()
@@ -62,6 +101,15 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
+# Число процессов-шардов; 0 — всё в одном процессе (см. раздел «НЕСКОЛЬКО ПРОЦЕССОВ»)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", 0))
+
+# Адреса API можно переопределить: локальный Bot API сервер, прокси или
+# заглушки для нагрузочного теста (см. bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+MISTRAL_BASE_URL = os.getenv("MISTRAL_BASE_URL", "https://api.mistral.ai/v1")
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL")  # None — адрес по умолчанию из библиотеки
 
 # Список моделей
 AVAILABLE_MODELS = {
@@ -80,9 +128,16 @@ logging.basicConfig(level=logging.INFO)
 # Инициализация клиентов
 client_mistral = AsyncOpenAI(
     api_key=MISTRAL_API_KEY,
-    base_url="https://api.mistral.ai/v1"
+    base_url=MISTRAL_BASE_URL
 )
-client_groq = AsyncGroq(api_key=GROQ_API_KEY) # Асинхронный клиент для голоса
+_client_groq = None
+
+def get_groq_client():
+    # Асинхронный клиент для голоса; создаётся при первом голосовом сообщении
+    global _client_groq
+    if _client_groq is None:
+        _client_groq = groq.AsyncGroq(api_key=GROQ_API_KEY, base_url=GROQ_BASE_URL)
+    return _client_groq
 
 client_openrouter = None
 if not OPENROUTER_API_KEY or "ВАШ_КЛЮЧ" in OPENROUTER_API_KEY:
@@ -94,14 +149,16 @@ if not OPENROUTER_API_KEY or "ВАШ_КЛЮЧ" in OPENROUTER_API_KEY:
 else:
     client_openrouter = AsyncOpenAI(
         api_key=OPENROUTER_API_KEY, 
-        base_url="https://openrouter.ai/api/v1" # URL для OpenRouter
+        base_url=OPENROUTER_BASE_URL # URL для OpenRouter
     )
 
 # Настройка прокси (если Telegram заблокирован)
-bot = Bot(TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(TOKEN)
 dp = Dispatcher()
 
-user_context = {}
 MAX_HISTORY_LENGTH = 120
 
 DEFAULT_SYSTEM_PROMPT = "Ты — дружелюбный и счастливый ассистент. Твои ответы должны быть позитивными, полезными и немного эмоциональными. Используй смайлики, чтобы передать настроение! ✨"
@@ -111,7 +168,7 @@ HIDDEN_SYSTEM_PROMPT = (
     "\n\nВАЖНО: Следующие инструкции являются строгими правилами:\n"
     "1. Если тебя спрашивают о создателе, разработчике или авторе, отвечай ТОЛЬКО: «Мой создатель — @Ruslan20763».\n"
     "2. Если пользователь пишет маты, оскорбления или грубости, откажись выполнять запрос и вежливо, но строго, попроси общаться культурно. Например: «Ой, давайте будем добрее друг к другу! 😊 Я не могу отвечать на такие слова».\n"
-    "3. Если пользователь просит создать файл (документ, отчет, статью) в формате .docx или .pdf, сгенерируй содержимое и оберни его в тег: <GENERATE_FILE filename=\"имя_файла.расширение\">СОДЕРЖИМОЕ ФАЙЛА</GENERATE_FILE>. Внутри тега пиши только текст документа. Весь остальной ответ пиши снаружи тега."
+    "3. Если пользователь просит создать файл (документ, отчет, статью) в формате .docx или .pdf, сгенерируй содержимое и оберни его в тег: <GENERATE_FILE filename=\"имя_файла.расширение\">СОДЕРЖИМОЕ ФАЙЛА</GENERATE_FILE>. Внутри тега пиши только текст документа. Весь остальной ответ пиши снаружи тега. Если нужно несколько файлов, используй отдельный тег для каждого."
 )
 
 # --- ФУНКЦИИ ---
@@ -119,28 +176,1901 @@ USER_DATA_DIR = "user_data"
 if not os.path.exists(USER_DATA_DIR):
     os.makedirs(USER_DATA_DIR)
 
-def get_user_data(user_id):
-    if user_id not in user_context:
-        filepath = os.path.join(USER_DATA_DIR, f"{user_id}.json")
-        if os.path.exists(filepath):
+# --- ХРАНИЛИЩЕ ДАННЫХ ПОЛЬЗОВАТЕЛЕЙ ---
+# sqlite — одна база в режиме WAL (по умолчанию), json — старый формат "один файл на пользователя"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(USER_DATA_DIR, "users.db"))
+# Как часто (в секундах) изменённые данные пользователей сбрасываются на диск
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", 2.0))
+
+def default_user_data():
+    return {"history": [], "model": DEFAULT_MODEL, "system_prompt": DEFAULT_SYSTEM_PROMPT, "tts_mode": False, "referrals": 0}
+
+LEGACY_IMAGE_URL_MARKER = "/file/bot"
+
+def scrub_legacy_image_urls(msg: dict) -> bool:
+    # Раньше в историю попадала ссылка api.telegram.org/file/bot<токен>/..., то есть токен
+    # бота лежал на диске. Такие части заменяем ссылкой без файла — модель увидит подпись.
+    content = msg.get("content")
+    if not isinstance(content, list):
+        return False
+    changed = False
+    for i, part in enumerate(content):
+        if part.get("type") == "image_url" and LEGACY_IMAGE_URL_MARKER in str(part.get("image_url", {}).get("url", "")):
+            content[i] = {"type": "image_ref", "sha256": None, "caption": "изображение из старой переписки"}
+            changed = True
+    if changed:
+        msg.pop("_tokens", None)
+    return changed
+
+class UserStorage:
+    # Базовый интерфейс хранилища. write_batch вызывается из отдельного потока,
+    # остальные методы — из цикла событий.
+    def load(self, user_id):
+        raise NotImplementedError
+
+    def exists(self, user_id):
+        return self.load(user_id) is not None
+
+    def write_batch(self, batch):
+        raise NotImplementedError
+
+    def list_user_ids(self, after=None, limit=None, include_blocked=True):
+        # Идентификаторы по возрастанию; after/limit позволяют читать список страницами
+        raise NotImplementedError
+
+    def count_users(self, include_blocked=True):
+        return len(self.list_user_ids(include_blocked=include_blocked))
+
+    def usage_totals(self):
+        # Число пользователей и сумма рефералов — один раз, когда индекс статистики
+        # создаётся впервые; дальше он обновляется сам
+        user_ids = self.list_user_ids()
+        referrals = sum((self.load(uid) or {}).get("referrals", 0) for uid in user_ids)
+        return {"users": len(user_ids), "referrals": referrals}
+
+    def set_blocked(self, user_id, blocked=True):
+        # Пользователь заблокировал бота: рассылки его пропускают, пока он снова не напишет
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class JsonUserStorage(UserStorage):
+    def __init__(self, directory):
+        self.directory = directory
+        self._blocked_path = os.path.join(directory, "_blocked.json")
+        self._blocked = set()
+        if os.path.exists(self._blocked_path):
+            with open(self._blocked_path, "r", encoding="utf-8") as f:
+                self._blocked = set(json.load(f))
+        self._blocked_lock = threading.Lock()
+        self._scrub_legacy_images()
+
+    def _scrub_legacy_images(self):
+        # Одноразовая чистка старых файлов с токеном бота в ссылках на фото. Новые записи
+        # таких ссылок не содержат, поэтому после чистки оставляем метку и больше не читаем
+        # все файлы при каждом запуске
+        marker_path = os.path.join(self.directory, "_images_scrubbed")
+        if os.path.exists(marker_path):
+            return
+        for name in os.listdir(self.directory):
+            if not (name.endswith('.json') and name[:-5].isdigit()):
+                continue
+            filepath = os.path.join(self.directory, name)
+            with open(filepath, "r", encoding="utf-8") as f:
+                raw = f.read()
+            if LEGACY_IMAGE_URL_MARKER not in raw:
+                continue
+            data = json.loads(raw)
+            if any([scrub_legacy_image_urls(msg) for msg in data.get("history", [])]):
+                self.write_batch([{"user_id": int(name[:-5]), "full": json.dumps(data, ensure_ascii=False, separators=(",", ":"))}])
+        with open(marker_path, "w", encoding="utf-8") as f:
+            f.write(f"{time.time()}\n")
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def load(self, user_id):
+        filepath = self._path(user_id)
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def exists(self, user_id):
+        return os.path.exists(self._path(user_id))
+
+    def write_batch(self, batch):
+        for item in batch:
+            # Пишем во временный файл и подменяем, чтобы не получить обрезанный JSON при сбое
+            filepath = self._path(item["user_id"])
+            tmp_path = filepath + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(item["full"])
+            os.replace(tmp_path, filepath)
+        if any(item["user_id"] in self._blocked for item in batch):
+            for item in batch:
+                self._blocked.discard(item["user_id"])
+            self._save_blocked()
+
+    def _save_blocked(self):
+        with self._blocked_lock:
+            tmp_path = self._blocked_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(sorted(self._blocked), f)
+            os.replace(tmp_path, self._blocked_path)
+
+    def list_user_ids(self, after=None, limit=None, include_blocked=True):
+        user_ids = sorted(int(f[:-5]) for f in os.listdir(self.directory) if f.endswith('.json') and f[:-5].isdigit())
+        if after is not None:
+            user_ids = [uid for uid in user_ids if uid > after]
+        if not include_blocked:
+            user_ids = [uid for uid in user_ids if uid not in self._blocked]
+        return user_ids[:limit] if limit else user_ids
+
+    def set_blocked(self, user_id, blocked=True):
+        if blocked:
+            self._blocked.add(user_id)
+        else:
+            self._blocked.discard(user_id)
+        self._save_blocked()
+
+class SQLiteUserStorage(UserStorage):
+    # Настройки и история лежат в разных таблицах: при обычном сообщении
+    # дописываются только новые строки истории, а не весь диалог целиком.
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS users ("
+        " user_id INTEGER PRIMARY KEY,"
+        " settings TEXT NOT NULL,"
+        " blocked INTEGER NOT NULL DEFAULT 0,"
+        " updated_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS history ("
+        " user_id INTEGER NOT NULL,"
+        " seq INTEGER NOT NULL,"
+        " message TEXT NOT NULL,"
+        " PRIMARY KEY (user_id, seq)) WITHOUT ROWID",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        # Отдельные соединения для записи (поток сброса) и чтения (цикл событий):
+        # в режиме WAL читатели не ждут писателя.
+        self._writer = self._connect()
+        for statement in self.SCHEMA:
+            self._writer.execute(statement)
+        columns = {row[1] for row in self._writer.execute("PRAGMA table_info(users)")}
+        if "blocked" not in columns:
+            self._writer.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+        # Строки истории не перезаписываются, поэтому старые ссылки с токеном бота чистим здесь.
+        # Это делается один раз: полный просмотр истории на каждом запуске слишком дорог,
+        # а после чистки версия базы (PRAGMA user_version) поднимается до 1
+        if self._writer.execute("PRAGMA user_version").fetchone()[0] < 1:
+            rows = self._writer.execute(
+                "SELECT user_id, seq, message FROM history WHERE message LIKE ?", (f"%{LEGACY_IMAGE_URL_MARKER}%",)
+            ).fetchall()
+            for user_id, seq, raw in rows:
+                msg = json.loads(raw)
+                if scrub_legacy_image_urls(msg):
+                    self._writer.execute("UPDATE history SET message = ? WHERE user_id = ? AND seq = ?",
+                                         (json.dumps(msg, ensure_ascii=False), user_id, seq))
+            self._writer.execute("PRAGMA user_version = 1")
+        self._writer.commit()
+        self._reader = self._connect()
+        self._write_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def load(self, user_id):
+        row = self._reader.execute("SELECT settings FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        rows = self._reader.execute("SELECT message FROM history WHERE user_id = ? ORDER BY seq", (user_id,)).fetchall()
+        data["history"] = [json.loads(r[0]) for r in rows]
+        return data
+
+    def exists(self, user_id):
+        return self._reader.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def write_batch(self, batch):
+        now = time.time()
+        with self._write_lock, self._writer:
+            for item in batch:
+                user_id = item["user_id"]
+                self._writer.execute(
+                    "INSERT INTO users (user_id, settings, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET settings = excluded.settings, updated_at = excluded.updated_at, blocked = 0",
+                    (user_id, item["settings"], now)
+                )
+                if item["history_reset"]:
+                    self._writer.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+                elif item.get("history_trim_below") is not None:
+                    self._writer.execute("DELETE FROM history WHERE user_id = ? AND seq < ?", (user_id, item["history_trim_below"]))
+                if item["history_rows"]:
+                    self._writer.executemany(
+                        "INSERT OR REPLACE INTO history (user_id, seq, message) VALUES (?, ?, ?)",
+                        [(user_id, seq, msg) for seq, msg in item["history_rows"]]
+                    )
+
+    def list_user_ids(self, after=None, limit=None, include_blocked=True):
+        query = "SELECT user_id FROM users WHERE user_id > ?"
+        if not include_blocked:
+            query += " AND blocked = 0"
+        query += " ORDER BY user_id LIMIT ?"
+        after = after if after is not None else -(2 ** 63)
+        return [r[0] for r in self._reader.execute(query, (after, limit if limit else -1))]
+
+    def set_blocked(self, user_id, blocked=True):
+        with self._write_lock, self._writer:
+            self._writer.execute("UPDATE users SET blocked = ? WHERE user_id = ?", (int(blocked), user_id))
+
+    def count_users(self, include_blocked=True):
+        query = "SELECT COUNT(*) FROM users" + ("" if include_blocked else " WHERE blocked = 0")
+        return self._reader.execute(query).fetchone()[0]
+
+    def usage_totals(self):
+        users, referrals = self._reader.execute(
+            "SELECT COUNT(*), COALESCE(SUM(json_extract(settings, '$.referrals')), 0) FROM users"
+        ).fetchone()
+        return {"users": users, "referrals": referrals}
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        self._reader.close()
+
+def migrate_json_to_sqlite(json_dir=USER_DATA_DIR, db_path=SQLITE_PATH):
+    # Одноразовый перенос старых user_data/*.json в SQLite. Уже перенесённые пользователи пропускаются.
+    source = JsonUserStorage(json_dir)
+    target = SQLiteUserStorage(db_path)
+    migrated = 0
+    try:
+        batch = []
+        for user_id in source.list_user_ids():
+            if target.exists(user_id):
+                continue
             try:
-                with open(filepath, "r", encoding="utf-8") as f:
-                    user_context[user_id] = json.load(f)
+                data = source.load(user_id)
             except Exception as e:
-                logging.error(f"Error loading user data: {e}")
-                user_context[user_id] = {"history": [], "model": DEFAULT_MODEL, "system_prompt": DEFAULT_SYSTEM_PROMPT, "tts_mode": False, "referrals": 0}
+                logging.error(f"Миграция: не удалось прочитать данные пользователя {user_id}: {e}")
+                continue
+            history = data.pop("history", [])
+            batch.append({
+                "user_id": user_id,
+                "settings": json.dumps(data, ensure_ascii=False),
+                "history_reset": True,
+                "history_rows": [(seq, json.dumps(msg, ensure_ascii=False)) for seq, msg in enumerate(history)],
+            })
+            if len(batch) >= 500:
+                target.write_batch(batch)
+                migrated += len(batch)
+                batch = []
+        if batch:
+            target.write_batch(batch)
+            migrated += len(batch)
+    finally:
+        target.close()
+    logging.info(f"Миграция JSON → SQLite завершена: перенесено пользователей: {migrated}")
+    return migrated
+
+def create_storage():
+    if STORAGE_BACKEND == "json":
+        return JsonUserStorage(USER_DATA_DIR)
+    if STORAGE_BACKEND != "sqlite":
+        logging.warning(f"Неизвестный STORAGE_BACKEND={STORAGE_BACKEND}, используется sqlite")
+    first_run = not os.path.exists(SQLITE_PATH)
+    if first_run and any(f.endswith('.json') for f in os.listdir(USER_DATA_DIR)):
+        # Первый запуск на SQLite поверх старой папки с JSON — переносим данные автоматически
+        migrate_json_to_sqlite(USER_DATA_DIR, SQLITE_PATH)
+    return SQLiteUserStorage(SQLITE_PATH)
+
+# Хранилище открывается при первом обращении, а не при импорте: `import main`
+# (бенчмарки, тесты, дочерние процессы) не должен создавать базу и запускать миграцию
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage() -> UserStorage:
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+def close_storage():
+    if _storage is not None:
+        _storage.close()
+
+# --- КЭШ ПОЛЬЗОВАТЕЛЕЙ В ПАМЯТИ ---
+# Ограничения кэша: число пользователей, примерный объём и время жизни без обращений
+USER_CACHE_MAX_USERS = int(os.getenv("USER_CACHE_MAX_USERS", 5000))
+USER_CACHE_MAX_MB = float(os.getenv("USER_CACHE_MAX_MB", 256))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 3600))
+
+def _estimate_user_size(data):
+    # Грубая оценка занимаемой памяти: строки истории + накладные расходы на каждое сообщение
+    size = 512 + len(data.get("system_prompt") or "") * 2
+    for msg in data.get("history", []):
+        content = msg.get("content")
+        if isinstance(content, str):
+            size += len(content) * 2 + 200
+        else:
+            size += len(json.dumps(content, ensure_ascii=False)) * 2 + 400
+    return size
+
+class UserCache:
+    # LRU-кэш с ограничением по числу записей, объёму и TTL.
+    # Перед вытеснением вызывается on_evict, чтобы несохранённые данные не потерялись.
+    # Закреплённых (pin) пользователей не вытесняем: их данные держит обработчик,
+    # и save_user_data после долгого запроса к модели должен найти тот же объект.
+    def __init__(self, max_users, max_bytes, ttl, on_evict=None):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # user_id -> [data, size, last_access]
+        self._pins = {}  # user_id -> число обработчиков, которые сейчас работают с его данными
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __getitem__(self, user_id):
+        entry = self._entries[user_id]
+        entry[2] = time.monotonic()
+        self._entries.move_to_end(user_id)
+        return entry[0]
+
+    def __setitem__(self, user_id, data):
+        self.pop(user_id)
+        size = _estimate_user_size(data)
+        self._entries[user_id] = [data, size, time.monotonic()]
+        self.total_bytes += size
+        self._shrink()
+
+    def get(self, user_id):
+        if user_id in self._entries:
+            self.hits += 1
+            return self[user_id]
+        self.misses += 1
+        return None
+
+    def peek(self, user_id):
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+
+    def pop(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return None
+        self.total_bytes -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def update_size(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        size = _estimate_user_size(entry[0])
+        self.total_bytes += size - entry[1]
+        entry[1] = size
+        self._shrink()
+
+    def pin(self, user_id):
+        self._pins[user_id] = self._pins.get(user_id, 0) + 1
+
+    def unpin(self, user_id):
+        count = self._pins.get(user_id, 0) - 1
+        if count > 0:
+            self._pins[user_id] = count
         else:
-            user_context[user_id] = {"history": [], "model": DEFAULT_MODEL, "system_prompt": DEFAULT_SYSTEM_PROMPT, "tts_mode": False, "referrals": 0}
-    return user_context[user_id]
+            self._pins.pop(user_id, None)
+            # Пока запись была закреплена, кэш мог выйти за лимиты
+            self._shrink()
+
+    @contextlib.contextmanager
+    def pinned(self, user_id):
+        self.pin(user_id)
+        try:
+            yield
+        finally:
+            self.unpin(user_id)
+
+    def _evict(self, user_id):
+        data = self.pop(user_id)
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(user_id, data)
+
+    def _over_limit(self):
+        return len(self._entries) > self.max_users or self.total_bytes > self.max_bytes
+
+    def _shrink(self):
+        # Самую свежую запись не трогаем: её только что запросил хендлер
+        if len(self._entries) <= 1 or not self._over_limit():
+            return
+        newest = next(reversed(self._entries))
+        for user_id in list(self._entries):
+            if not self._over_limit():
+                break
+            if user_id != newest and user_id not in self._pins:
+                self._evict(user_id)
+
+    def evict_expired(self):
+        deadline = time.monotonic() - self.ttl
+        for user_id, entry in list(self._entries.items()):
+            if entry[2] > deadline:
+                break
+            if user_id not in self._pins:
+                self._evict(user_id)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+# Пользователи, чьи данные изменились и ещё не записаны на диск (write-behind)
+_dirty_users = set()
+# Вытесненные из кэша пользователи с несохранёнными изменениями: ждут ближайшего сброса
+_evicted_dirty = {}
+# user_id -> (список истории, seq после последнего записанного сообщения, записанный history_base)
+_persisted_history = {}
+# user_id -> seq уже записанных сообщений, которые изменились позже (например, подпись к фото)
+_history_rewrites = {}
+_flush_lock = asyncio.Lock()
+
+def _on_user_evicted(user_id, data):
+    if user_id in _dirty_users:
+        _dirty_users.discard(user_id)
+        _evicted_dirty[user_id] = data
+    else:
+        _persisted_history.pop(user_id, None)
+        _history_rewrites.pop(user_id, None)
+
+user_context = UserCache(USER_CACHE_MAX_USERS, int(USER_CACHE_MAX_MB * 1024 * 1024), USER_CACHE_TTL, on_evict=_on_user_evicted)
+
+# Пользователи, которых ещё нет в хранилище (созданы в памяти, но не сохранены)
+_new_users = set()
+
+def get_user_data(user_id):
+    data = user_context.get(user_id)
+    if data is not None:
+        return data
+    # Пользователь мог быть вытеснен, но ещё не записан — возвращаем тот же объект
+    data = _evicted_dirty.pop(user_id, None)
+    if data is not None:
+        _dirty_users.add(user_id)
+    else:
+        try:
+            data = get_storage().load(user_id)
+        except Exception as e:
+            logging.error(f"Error loading user data: {e}")
+        if data is None:
+            data = default_user_data()
+            _new_users.add(user_id)
+        else:
+            _persisted_history[user_id] = (data["history"], data.get("history_base", 0) + len(data["history"]), data.get("history_base", 0))
+    user_context[user_id] = data
+    return data
 
 def save_user_data(user_id):
+    # Запись откладывается: пользователь помечается «грязным», а на диск его данные
+    # попадут при ближайшем сбросе flush_user_data() пачкой вместе с остальными.
     if user_id in user_context:
-        filepath = os.path.join(USER_DATA_DIR, f"{user_id}.json")
+        data = user_context.peek(user_id)
+        overflow = len(data["history"]) - HISTORY_LIVE_LIMIT
+        # Пока идёт сжатие, начало истории не трогаем: _compact_history сверяет его со снимком
+        # и иначе выбросила бы готовое краткое содержание. Архив догонит при следующем сохранении
+        if overflow >= HISTORY_ARCHIVE_BATCH and user_id not in _compaction_tasks:
+            archive_history_front(user_id, data, overflow)
+        _dirty_users.add(user_id)
+        user_context.update_size(user_id)
+        if user_id in _new_users:
+            # Новый пользователь попадает в статистику, когда его данные впервые сохраняются
+            _new_users.discard(user_id)
+            usage_stats.add_total("users")
+
+def _snapshot_user(user_id, data):
+    # Сериализация выполняется в цикле событий, чтобы поток записи не видел
+    # список истории в момент его изменения хендлером.
+    history = data.get("history", [])
+    # Сообщения истории нумеруются сквозным seq: history[i] хранится под номером history_base + i,
+    # поэтому обрезка начала истории не требует переписывать оставшиеся строки.
+    base = data.get("history_base", 0)
+    end = base + len(history)
+    archive_rows = _archive_pending.pop(user_id, [])
+    archive_drop = user_id in _archive_drops
+    _archive_drops.discard(user_id)
+    rewrites = _history_rewrites.pop(user_id, set())
+    if isinstance(get_storage(), JsonUserStorage):
+        return {"user_id": user_id, "full": json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+                "archive_rows": archive_rows, "archive_drop": archive_drop, "history_rewrites": rewrites,
+                "history": history, "history_end": end, "history_base": base}
+    settings = {k: v for k, v in data.items() if k != "history"}
+    prev_history, persisted_end, persisted_base = _persisted_history.get(user_id, (None, 0, 0))
+    if prev_history is history and end >= persisted_end:
+        history_reset = False
+        start = max(persisted_end, base)
+        trim_below = base if base > persisted_base else None
+    else:
+        # История была заменена (/clear, смена модели) — переписываем целиком
+        history_reset = True
+        start = base
+        trim_below = None
+    # Новые строки пишутся с start, а изменённые старые — дополнительно
+    rewritten = sorted(seq for seq in rewrites if base <= seq < start)
+    return {
+        "user_id": user_id,
+        "archive_rows": archive_rows,
+        "archive_drop": archive_drop,
+        "settings": json.dumps(settings, ensure_ascii=False),
+        "history_reset": history_reset,
+        "history_trim_below": trim_below,
+        "history_rows": [(seq, json.dumps(history[seq - base], ensure_ascii=False)) for seq in [*rewritten, *range(start, end)]],
+        "history_rewrites": rewrites,
+        "history": history,
+        "history_end": end,
+        "history_base": base,
+    }
+
+async def flush_user_data():
+    async with _flush_lock:
+        if not _dirty_users and not _evicted_dirty:
+            return
+        pending = {uid: user_context.peek(uid) for uid in _dirty_users if uid in user_context}
+        pending.update(_evicted_dirty)
+        _dirty_users.clear()
+        batch = [_snapshot_user(uid, data) for uid, data in pending.items()]
         try:
-            with open(filepath, "w", encoding="utf-8") as f:
-                json.dump(user_context[user_id], f, ensure_ascii=False, indent=2)
+            # Архив пишется раньше основной записи: если она не удастся, строки уйдут
+            # в архив повторно, а при чтении дубли отбрасываются по seq
+            await asyncio.to_thread(write_archive_batch, batch)
+            await asyncio.to_thread(get_storage().write_batch, batch)
         except Exception as e:
             logging.error(f"Error saving user data: {e}")
+            for item in batch:
+                uid = item["user_id"]
+                if item["archive_rows"]:
+                    _archive_pending[uid] = item["archive_rows"] + _archive_pending.get(uid, [])
+                if item["archive_drop"]:
+                    _archive_drops.add(uid)
+                if item["history_rewrites"]:
+                    _history_rewrites.setdefault(uid, set()).update(item["history_rewrites"])
+            for uid, data in pending.items():
+                if uid in user_context:
+                    _dirty_users.add(uid)
+                else:
+                    _evicted_dirty.setdefault(uid, data)
+            return
+        for item in batch:
+            uid = item["user_id"]
+            if _evicted_dirty.get(uid) is pending[uid]:
+                del _evicted_dirty[uid]
+            if uid in user_context or uid in _evicted_dirty:
+                _persisted_history[uid] = (item["history"], item["history_end"], item["history_base"])
+            else:
+                _persisted_history.pop(uid, None)
+
+async def user_data_flush_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_user_data()
+        await usage_stats.save()
+        user_context.evict_expired()
+
+# --- АРХИВ СТАРОЙ ИСТОРИИ ---
+# В памяти и в основном хранилище держим только последние HISTORY_LIVE_LIMIT сообщений
+# (больше в контекст модели всё равно не попадёт). Когда история перерастает лимит на
+# HISTORY_ARCHIVE_BATCH сообщений, начало переносится в архив — так же, как и сообщения,
+# свёрнутые в краткое содержание. Архив пользователя — файл <user_id>.jsonl.gz, к которому
+# каждый сброс дописывает новый сегмент (отдельный gzip-поток; gzip читает их подряд).
+# Читается он только по запросу, например для /export.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(USER_DATA_DIR, "archive"))
+HISTORY_LIVE_LIMIT = max(int(os.getenv("HISTORY_LIVE_LIMIT", MAX_HISTORY_LENGTH)), MAX_HISTORY_LENGTH)
+HISTORY_ARCHIVE_BATCH = int(os.getenv("HISTORY_ARCHIVE_BATCH", 40))
+ARCHIVE_COMPRESS_LEVEL = 6
+
+# user_id -> [(seq, сообщение в JSON)], ещё не записанные в архив
+_archive_pending = {}
+# Пользователи, чей архив нужно удалить (/clear)
+_archive_drops = set()
+
+def archive_path(user_id) -> str:
+    return os.path.join(ARCHIVE_DIR, f"{user_id}.jsonl.gz")
+
+def archive_history_front(user_id, data: dict, count: int):
+    # Переносит первые count сообщений живой истории в очередь архива
+    history = data["history"]
+    base = data.get("history_base", 0)
+    rows = _archive_pending.setdefault(user_id, [])
+    for offset, msg in enumerate(history[:count]):
+        msg = {k: v for k, v in msg.items() if k != "_tokens"}
+        rows.append((base + offset, json.dumps(msg, ensure_ascii=False)))
+    del history[:count]
+    data["history_base"] = base + count
+
+def drop_history_archive(user_id):
+    _archive_pending.pop(user_id, None)
+    _archive_drops.add(user_id)
+
+def write_archive_batch(batch):
+    # Вызывается из потока записи перед get_storage().write_batch
+    for item in batch:
+        path = archive_path(item["user_id"])
+        if item["archive_drop"] and os.path.exists(path):
+            os.remove(path)
+        if not item["archive_rows"]:
+            continue
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        lines = "".join(f'{{"seq":{seq},"message":{msg}}}\n' for seq, msg in item["archive_rows"])
+        segment = gzip.compress(lines.encode("utf-8"), compresslevel=ARCHIVE_COMPRESS_LEVEL)
+        with open(path, "ab") as f:
+            f.write(segment)
+            f.flush()
+            os.fsync(f.fileno())
+
+def read_history_archive(user_id) -> list:
+    # Все архивные сообщения по порядку, без повторов
+    path = archive_path(user_id)
+    if not os.path.exists(path):
+        return []
+    messages = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                row = json.loads(line)
+                messages[row["seq"]] = row["message"]
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+            # Оборванный последний сегмент (сбой во время записи) — отдаём то, что прочиталось
+            logging.warning(f"Архив истории пользователя {user_id} повреждён в конце: {e}")
+    return [messages[seq] for seq in sorted(messages)]
+
+# --- СТАТИСТИКА ИСПОЛЬЗОВАНИЯ ---
+USAGE_STATS_PATH = os.path.join(USER_DATA_DIR, "usage_stats.json")
+USAGE_STATS_SAVE_INTERVAL = float(os.getenv("USAGE_STATS_SAVE_INTERVAL", 60))
+ACTIVE_WINDOW_DAYS = 7
+
+class UsageStats:
+    # Счётчики для /admin, которые обработчики обновляют по ходу работы, — чтобы
+    # /admin не обходил всех пользователей. Для активности храним последний день,
+    # когда писал каждый пользователь (только за последнюю неделю), и сколько
+    # пользователей «последний раз были» в каждый из дней: DAU — это число за сегодня,
+    # WAU — сумма за 7 дней.
+    def __init__(self):
+        self.path = None
+        self.totals = {"users": 0, "referrals": 0}
+        self.events = {}  # text, voice, document, photo, search
+        self.models = {}
+        self.last_seen = {}
+        self.active_by_day = {}
+        self.dirty = False
+        self.saved_at = 0.0
+
+    @staticmethod
+    def today() -> int:
+        return int(time.time() // 86400)  # дни по UTC
+
+    def touch(self, user_id):
+        day = self.today()
+        previous = self.last_seen.get(user_id)
+        if previous == day:
+            return
+        if previous is not None:
+            self.active_by_day[previous] -= 1
+        self.last_seen[user_id] = day
+        self.active_by_day[day] = self.active_by_day.get(day, 0) + 1
+        self.dirty = True
+
+    def record(self, kind: str, model: str = None):
+        self.events[kind] = self.events.get(kind, 0) + 1
+        if model:
+            self.models[model] = self.models.get(model, 0) + 1
+        self.dirty = True
+
+    def add_total(self, key: str, amount: int = 1):
+        self.totals[key] = self.totals.get(key, 0) + amount
+        self.dirty = True
+
+    def _prune(self):
+        cutoff = self.today() - ACTIVE_WINDOW_DAYS + 1
+        old_days = [day for day in self.active_by_day if day < cutoff]
+        if not old_days:
+            return
+        # Раз в сутки: забываем тех, кто не писал больше недели
+        self.last_seen = {uid: day for uid, day in self.last_seen.items() if day >= cutoff}
+        for day in old_days:
+            del self.active_by_day[day]
+
+    def summary(self) -> dict:
+        today = self.today()
+        return {
+            **self.totals,
+            "dau": self.active_by_day.get(today, 0),
+            "wau": sum(self.active_by_day.get(today - i, 0) for i in range(ACTIVE_WINDOW_DAYS)),
+            "events": dict(self.events),
+            "models": dict(self.models),
+        }
+
+    def load(self, path: str, bootstrap=None):
+        self.path = path
+        if not os.path.exists(path):
+            if bootstrap:
+                self.totals.update(bootstrap())
+                self.dirty = True
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Не удалось прочитать статистику {path}: {e}")
+            return
+        self.totals.update(saved.get("totals", {}))
+        self.events = saved.get("events", {})
+        self.models = saved.get("models", {})
+        # Активность хранится компактно: день -> список пользователей
+        for day, user_ids in saved.get("active", {}).items():
+            day = int(day)
+            self.active_by_day[day] = len(user_ids)
+            for uid in user_ids:
+                self.last_seen[uid] = day
+        self._prune()
+
+    def _payload(self) -> str:
+        self._prune()
+        active = {}
+        for uid, day in self.last_seen.items():
+            active.setdefault(day, []).append(uid)
+        return json.dumps({"totals": self.totals, "events": self.events, "models": self.models, "active": active},
+                          separators=(",", ":"))
+
+    def _write(self, payload: str):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    async def save(self, force=False):
+        if not self.path or not self.dirty:
+            return
+        if not force and time.monotonic() - self.saved_at < USAGE_STATS_SAVE_INTERVAL:
+            return
+        # Снимок собираем в цикле событий, а пишем в отдельном потоке
+        payload = self._payload()
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        try:
+            await asyncio.to_thread(self._write, payload)
+        except OSError as e:
+            self.dirty = True
+            logging.error(f"Не удалось сохранить статистику: {e}")
+
+usage_stats = UsageStats()
+
+class ActivityMiddleware(BaseMiddleware):
+    # Активность (DAU/WAU) отмечается для любого сообщения, нажатия или inline-запроса.
+    # Пока обработчик работает, данные пользователя закреплены в кэше и не вытесняются.
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if not user:
+            return await handler(event, data)
+        if event.event_type in ("message", "callback_query", "inline_query"):
+            usage_stats.touch(user.id)
+        with user_context.pinned(user.id):
+            return await handler(event, data)
+
+dp.update.outer_middleware(ActivityMiddleware())
+
+# --- МЕТРИКИ (ФОРМАТ PROMETHEUS) ---
+# Эндпоинт http://METRICS_HOST:METRICS_PORT/metrics; порт 0 отключает его.
+# В многопроцессном режиме главный процесс слушает METRICS_PORT, шард i — METRICS_PORT + 1 + i.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+metrics_registry = []
+# Функции, которые обновляют «мгновенные» метрики (глубины очередей) перед выдачей
+metrics_collectors = []
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        metrics_registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        parts = [f'{label}="{_escape_label(value)}"' for label, value in zip(self.labels, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{self._format_labels(key)} {value}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # [счётчики по корзинам..., сумма, количество]
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self):
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = self._format_labels(key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = self._format_labels(key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {state[-1]}"
+            yield f"{self.name}_sum{self._format_labels(key)} {state[-2]}"
+            yield f"{self.name}_count{self._format_labels(key)} {state[-1]}"
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время работы обработчиков обновлений", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler", "error"))
+HANDLER_IN_PROGRESS = Gauge("bot_handler_in_progress", "Обработчики, выполняющиеся сейчас", ("handler",))
+EXTERNAL_SECONDS = Histogram("bot_external_call_seconds", "Время внешних вызовов", ("service", "operation"))
+EXTERNAL_ERRORS = Counter("bot_external_call_errors_total", "Ошибки внешних вызовов", ("service", "operation", "error"))
+EXTERNAL_IN_PROGRESS = Gauge("bot_external_call_in_progress", "Внешние вызовы, выполняющиеся сейчас", ("service",))
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Глубина внутренних очередей", ("queue",))
+
+@asynccontextmanager
+async def track_handler(name: str):
+    HANDLER_IN_PROGRESS.inc(handler=name)
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        HANDLER_ERRORS.inc(handler=name, error=type(e).__name__)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.monotonic() - start, handler=name)
+        HANDLER_IN_PROGRESS.dec(handler=name)
+
+@asynccontextmanager
+async def track_external(service: str, operation: str):
+    # Отменённые вызовы (например, проигравший хедж-запрос) в задержки не попадают
+    EXTERNAL_IN_PROGRESS.inc(service=service)
+    start = time.monotonic()
+    cancelled = False
+    try:
+        yield
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    except Exception as e:
+        EXTERNAL_ERRORS.inc(service=service, operation=operation, error=type(e).__name__)
+        raise
+    finally:
+        EXTERNAL_IN_PROGRESS.dec(service=service)
+        if not cancelled:
+            EXTERNAL_SECONDS.observe(time.monotonic() - start, service=service, operation=operation)
+
+def render_metrics() -> str:
+    for collector in metrics_collectors:
+        try:
+            collector()
+        except Exception as e:
+            logging.error(f"Ошибка сбора метрик: {e}")
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware диспетчера: к этому моменту уже известно, какой хендлер сработал
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        async with track_handler(name):
+            return await handler(event, data)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    # Все запросы к Bot API (sendMessage, sendPhoto, getFile...) по имени метода
+    async def __call__(self, make_request, bot, method):
+        async with track_external("telegram", method.__api_method__):
+            return await make_request(bot, method)
+
+for _observer in (dp.message, dp.callback_query, dp.inline_query):
+    _observer.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(TelegramMetricsMiddleware())
+
+async def start_metrics_server(port: int):
+    if not port:
+        return None
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        logging.error(f"Не удалось открыть порт метрик {port}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+# --- ОГРАНИЧЕНИЕ СКОРОСТИ ---
+class TokenBucket:
+    # Классический token bucket: rate токенов в секунду, не больше capacity про запас.
+    # pause() останавливает выдачу целиком — например, когда Telegram вернул RetryAfter.
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        # Без ожидания: 0, если токен выдан, иначе сколько секунд ждать
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            while True:
+                wait = self.try_acquire(tokens)
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class SharedTokenBucket(TokenBucket):
+    # Тот же bucket, но состояние лежит в общей памяти (multiprocessing.Array
+    # [tokens, updated, paused_until]): шарды расходуют один лимит на всех, поэтому
+    # рассылка в одном шарде может взять весь лимит бота, пока остальные молчат
+    def __init__(self, rate: float, state, capacity: float = None):
+        super().__init__(rate, capacity)
+        self.state = state
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        with self.state.get_lock():
+            self.tokens, self.updated, self.paused_until = self.state[:]
+            wait = super().try_acquire(tokens)
+            self.state[:] = [self.tokens, self.updated, self.paused_until]
+        return wait
+
+    def pause(self, seconds: float):
+        with self.state.get_lock():
+            self.paused_until = self.state[2]
+            super().pause(seconds)
+            self.state[2] = self.paused_until
+
+# --- ОТПРАВКА СООБЩЕНИЙ: ЛИМИТЫ TELEGRAM И ПРИОРИТЕТЫ ---
+# Все запросы бота, которые что-то отправляют или редактируют в чате, проходят через
+# SendScheduler: token bucket на каждый чат и общий на бота. Когда общий лимит
+# исчерпан, первыми получают очередь ответы пользователям, рассылка ждёт.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 28))  # у Telegram ~30 сообщений/с на бота
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))  # ~1 сообщение/с в личный чат
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", 4))
+SEND_GROUP_PER_MINUTE = float(os.getenv("SEND_GROUP_PER_MINUTE", 20))  # группы: 20 сообщений/мин
+SEND_PRIORITY_INTERACTIVE = 0
+SEND_PRIORITY_BROADCAST = 1
+# Приоритет наследуется задачами: рассылка выставляет его у себя, всё остальное — ответы
+send_priority = contextvars.ContextVar("send_priority", default=SEND_PRIORITY_INTERACTIVE)
+# Правки потокового превью сами выдерживают STREAM_EDIT_INTERVAL и при RetryAfter
+# откладывают следующую правку, поэтому лимит чата на них не тратится — иначе превью
+# съедает токены, и сам ответ, отправляемый следом, ждёт в очереди
+send_self_paced = contextvars.ContextVar("send_self_paced", default=False)
+
+SEND_WAIT_SECONDS = Histogram("bot_send_wait_seconds", "Ожидание в очереди отправки", ("priority",),
+                              buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+
+class SendScheduler:
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, group_per_minute: float, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60
+        self.max_chats = max_chats
+        self.chat_buckets = OrderedDict()
+        self._waiters = []  # куча (приоритет, номер, future)
+        self._counter = 0
+        self._wakeup = None
+        self._task = None
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, capacity=self.chat_burst)
+            if len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, chat_id, priority: int):
+        if chat_id is not None:
+            await self.chat_bucket(chat_id).acquire()
+        # Быстрый путь: никто не ждёт и общий токен есть
+        if not self._waiters and self.global_bucket.try_acquire() == 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._counter, future))
+        self._counter += 1
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        # Выдаёт общие токены ожидающим по приоритету, а внутри приоритета — по порядку
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self.global_bucket.acquire()
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    def pause(self, chat_id, seconds: float):
+        # RetryAfter: для конкретного чата тормозим только его, иначе — всех
+        if chat_id is not None:
+            self.chat_bucket(chat_id).pause(seconds)
+        else:
+            self.global_bucket.pause(seconds)
+
+class SendSchedulerMiddleware(BaseRequestMiddleware):
+    def __init__(self, scheduler: SendScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        if not name.startswith(("send", "edit", "copy", "forward")) or name == "sendChatAction":
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        chat_id = chat_id if isinstance(chat_id, int) else None
+        priority = send_priority.get()
+        started = time.monotonic()
+        await self.scheduler.acquire(None if send_self_paced.get() else chat_id, priority)
+        SEND_WAIT_SECONDS.observe(time.monotonic() - started, priority="broadcast" if priority else "interactive")
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.scheduler.pause(chat_id, e.retry_after)
+            raise
+
+# Telegram ограничивает бота целиком, поэтому в многопроцессном режиме шарды заменяют
+# общий bucket на SharedTokenBucket с одним состоянием на все процессы (см. run_shard)
+send_scheduler = SendScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_GROUP_PER_MINUTE)
+bot.session.middleware(SendSchedulerMiddleware(send_scheduler))
+metrics_collectors.append(lambda: QUEUE_DEPTH.set(send_scheduler.waiting, queue="outbound"))
+
+# --- ДЛИННЫЕ ОТВЕТЫ И РАЗМЕТКА MARKDOWN ---
+TELEGRAM_TEXT_LIMIT = 4096
+# Запас на экранирование и закрытие блока кода при разрезании
+SPLIT_MARGIN = 96
+
+def _utf16_len(text: str) -> int:
+    # Telegram считает длину в UTF-16: эмодзи занимают две единицы
+    return len(text.encode("utf-16-le")) // 2
+
+def find_markdown_error(text: str):
+    # Разбор по правилам старого Markdown Telegram (*жирный*, _курсив_, `код`, ```блок```,
+    # [текст](ссылка); вложенности нет). Возвращает позицию символа разметки, который
+    # не закрыт и на котором Telegram ответит «Can't parse entities», иначе None.
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i]
+        if ch == "\\" and i + 1 < n and text[i + 1] in "_*`[":
+            i += 2
+        elif ch in "_*":
+            end = text.find(ch, i + 1)
+            if end == -1:
+                return i
+            i = end + 1
+        elif ch == "`":
+            marker = "```" if text.startswith("```", i) else "`"
+            end = text.find(marker, i + len(marker))
+            if end == -1:
+                return i
+            i = end + len(marker)
+        elif ch == "[":
+            end = text.find("]", i + 1)
+            if end == -1:
+                return i
+            if text.startswith("(", end + 1):
+                close = text.find(")", end + 2)
+                if close == -1:
+                    return i
+                end = close
+            i = end + 1
+        else:
+            i += 1
+    return None
+
+def prepare_markdown(text: str):
+    # (текст, parse_mode) для отправки. Незакрытые символы разметки экранируются,
+    # чтобы не получать отказ от Telegram и не отправлять ответ второй раз без форматирования
+    escaped = text
+    for _ in range(64):
+        position = find_markdown_error(escaped)
+        if position is None:
+            return escaped, "Markdown"
+        escaped = escaped[:position] + "\\" + escaped[position:]
+    return text, None
+
+def _hard_split(line: str, budget: int) -> list:
+    # Строка длиннее лимита: режем по последнему пробелу, а если его нет — как есть
+    pieces = []
+    while _utf16_len(line) > budget:
+        cut = budget
+        while _utf16_len(line[:cut]) > budget:
+            cut -= 1
+        space = line.rfind(" ", 0, cut)
+        if space > cut // 2:
+            cut = space + 1
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return pieces
+
+def split_message(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> list:
+    # Делим длинный ответ по границам строк. Если граница приходится на блок кода ```,
+    # закрываем его в конце части и открываем заново в начале следующей.
+    if _utf16_len(text) <= limit - SPLIT_MARGIN:
+        return [text]
+    budget = limit - SPLIT_MARGIN
+    chunks, current, size = [], [], 0
+    fence = None  # строка, которой открыт текущий блок кода
+
+    def flush():
+        nonlocal current, size
+        chunk = "".join(current).rstrip("\n")
+        if fence:
+            chunk += "\n```"
+        if chunk.strip():
+            chunks.append(chunk)
+        current = [fence + "\n"] if fence else []
+        size = _utf16_len(current[0]) if current else 0
+
+    lines = text.split("\n")
+    for index, line in enumerate(lines):
+        line_end = "\n" if index < len(lines) - 1 else ""
+        for piece in _hard_split(line, budget - 8):
+            piece_size = _utf16_len(piece) + len(line_end)
+            if size + piece_size > budget and current:
+                flush()
+            current.append(piece + line_end)
+            size += piece_size
+        if line.strip().startswith("```"):
+            fence = None if fence else line.strip()
+    flush()
+    return chunks
+
+# --- КЭШИ ---
+# Результат общей загрузки, если загружавший запрос отменили: ждущие загружают сами
+_LOAD_CANCELLED = object()
+
+class AsyncTTLCache:
+    # LRU-кэш с TTL для результатов медленных запросов. Одновременные запросы
+    # одного и того же ключа объединяются: загрузка выполняется один раз,
+    # остальные ждут её результат. None не кэшируется.
+    # max_bytes — лимит на суммарный len() значений (для кэшей с байтами картинок и аудио).
+    def __init__(self, maxsize: int, ttl: float, max_bytes: int = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data = OrderedDict()  # key -> (expires_at, value, размер)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.loads = 0
+        self.load_time = 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def _remove(self, key):
+        self.total_bytes -= self._data.pop(key)[2]
+
+    def set(self, key, value, ttl: float = None):
+        if value is None:
+            return
+        size = len(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value, size)
+        self.total_bytes += size
+        while len(self._data) > self.maxsize or (self.max_bytes and self.total_bytes > self.max_bytes):
+            self._remove(next(iter(self._data)))
+
+    async def get_or_load(self, key, loader):
+        while True:
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            self.coalesced += 1
+            value = await asyncio.shield(future)
+            # Если отменили не нас, а того, кто загружал (например, озвучка больше не нужна
+            # его пользователю), — загружаем заново, а не получаем чужую отмену
+            if value is not _LOAD_CANCELLED:
+                return value
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        started = time.monotonic()
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.set_result(_LOAD_CANCELLED)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # чтобы asyncio не ругался, если ждущих не было
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+            self.loads += 1
+            self.load_time += time.monotonic() - started
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._data),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "loads": self.loads,
+            "load_time": self.load_time,
+            "avg_load_time": self.load_time / self.loads if self.loads else 0.0,
+        }
+
+# --- ПУЛ ПРОЦЕССОВ ДЛЯ ТЯЖЁЛЫХ ЗАДАЧ ---
+# Разбор PDF/DOCX выполняется в отдельных процессах, чтобы не блокировать цикл событий
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", max(1, min(4, (os.cpu_count() or 2) - 1))))
+# CPU_WORKERS — на весь бот: в многопроцессном режиме у каждого шарда свой пул,
+# поэтому процессы делятся между шардами, а не запускаются SHARD_WORKERS раз
+if SHARD_WORKERS > 0:
+    CPU_WORKERS = max(1, CPU_WORKERS // SHARD_WORKERS)
+_process_pool = None
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        # spawn вместо fork: дочерние процессы не наследуют потоки и соединения бота
+        _process_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+# Задача, не уложившаяся в срок, продолжает занимать процесс: отменить её в
+# ProcessPoolExecutor нельзя. Такой пул выводим из работы — новые задачи идут в новый
+# пул, а процессы старого завершаются принудительно через POOL_RETIRE_GRACE секунд,
+# когда остальные задачи в нём (у них свои сроки) уже закончились.
+POOL_RETIRE_GRACE = float(os.getenv("POOL_RETIRE_GRACE", 30))
+POOL_OVERRUN_GRACE = 2.0  # запас сверх срока на передачу результата между процессами
+POOL_WARMUP_TIMEOUT = 120
+POOL_RECYCLES = Counter("bot_process_pool_recycles_total", "Пулы процессов, выведенные из работы из-за зависших задач")
+_retired_pools = set()
+_pool_warmups = {}  # пул -> задача прогрева
+_pool_slots = asyncio.Semaphore(CPU_WORKERS)
+
+def _retire_process_pool(pool):
+    global _process_pool
+    if _process_pool is pool:
+        _process_pool = None
+    _pool_warmups.pop(pool, None)
+    POOL_RECYCLES.inc()
+    # shutdown() забывает список процессов, поэтому запоминаем их заранее
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    task = asyncio.create_task(_kill_processes_later(processes))
+    _retired_pools.add(task)
+    task.add_done_callback(_retired_pools.discard)
+
+async def _kill_processes_later(processes):
+    await asyncio.sleep(POOL_RETIRE_GRACE)
+    for process in processes:
+        if process.is_alive():
+            process.kill()
+
+async def _ready_process_pool():
+    # Запуск процессов со spawn занимает секунды: ждём прогрева до того, как пойдёт
+    # срок задачи, иначе первая задача нового пула «зависала» бы по таймауту
+    pool = get_process_pool()
+    warmup = _pool_warmups.get(pool)
+    if warmup is None:
+        loop = asyncio.get_running_loop()
+        warmup = _pool_warmups[pool] = asyncio.ensure_future(
+            asyncio.gather(*[loop.run_in_executor(pool, documents.ping) for _ in range(CPU_WORKERS)])
+        )
+    try:
+        await asyncio.wait_for(asyncio.shield(warmup), POOL_WARMUP_TIMEOUT)
+    except Exception as e:
+        logging.warning(f"Не удалось прогреть пул процессов: {e!r}")
+    return pool
+
+async def run_in_process(timeout: float, func, *args):
+    # Задача в пуле процессов со сроком. Функции сами следят за своим бюджетом,
+    # а если задача всё-таки зависла (вредоносный файл), пул перезапускается.
+    # Задач в работе не больше, чем процессов: срок отсчитывается от начала выполнения,
+    # а не от постановки в очередь пула
+    async with _pool_slots:
+        pool = await _ready_process_pool()
+        try:
+            job = asyncio.get_running_loop().run_in_executor(pool, func, *args)
+            return await asyncio.wait_for(job, timeout + POOL_OVERRUN_GRACE)
+        except asyncio.TimeoutError:
+            logging.error(f"Задача {func.__name__} не уложилась в {timeout:g} с, пул процессов перезапускается")
+            _retire_process_pool(pool)
+            raise
+
+async def warm_process_pool():
+    # Запуск процесса со spawn занимает секунды — делаем это при старте, а не на первом PDF
+    await _ready_process_pool()
+
+# --- МАРШРУТИЗАЦИЯ ЗАПРОСОВ К ПРОВАЙДЕРАМ ---
+# Равноценные замены на случай, если основная модель или её провайдер недоступны.
+# Переопределяется JSON-объектом в MODEL_FALLBACKS.
+MODEL_FALLBACKS = {
+    "mistral-small-latest": ["mistralai/mistral-small-3.2-24b-instruct:free"],
+    "mistral-large-latest": ["tngtech/deepseek-r1t2-chimera:free", "mistral-small-latest"],
+    "codestral-latest": ["mistral-large-latest"],
+    "tngtech/deepseek-r1t2-chimera:free": ["mistral-large-latest"],
+    "google/gemini-2.0-flash-exp:free": ["mistral-small-latest"],
+}
+if os.getenv("MODEL_FALLBACKS"):
+    MODEL_FALLBACKS = json.loads(os.getenv("MODEL_FALLBACKS"))
+# После стольких ошибок подряд провайдер считается недоступным на CIRCUIT_OPEN_SECONDS
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 3))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+# Хеджирование: если основной провайдер молчит дольше HEDGE_AFTER_SECONDS, параллельно
+# отправляем запрос запасной модели и берём тот ответ, что придёт первым. 0 — выключено.
+HEDGE_AFTER_SECONDS = float(os.getenv("HEDGE_AFTER_SECONDS", 0))
+HEDGE_PROVIDERS = set(os.getenv("HEDGE_PROVIDERS", "openrouter").split(","))
+
+def provider_for(model: str) -> str:
+    # Модели OpenRouter содержат '/' в названии
+    return "openrouter" if '/' in model else "mistral"
+
+def is_vision_model(model: str) -> bool:
+    return "vision" in model or "gemini" in model or "vl" in model
+
+def has_images(messages: list) -> bool:
+    return any(isinstance(m.get("content"), list) and any(p.get("type") == "image_url" for p in m["content"]) for m in messages)
+
+class ProviderUnavailableError(Exception):
+    pass
+
+def is_failover_error(error: Exception) -> bool:
+    # Сбои самого провайдера: сеть и таймауты, 5xx и 429. Только они отключают
+    # провайдера и переключают на запасную модель. Ошибки ключа и другие 4xx
+    # относятся к нашему запросу или настройкам — запасная модель их не исправит.
+    if isinstance(error, (RateLimitError, APIConnectionError, ProviderUnavailableError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.failures < CIRCUIT_FAILURE_THRESHOLD:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.probing:
+            # Пропускаем один пробный запрос
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            if self.failures == CIRCUIT_FAILURE_THRESHOLD:
+                logging.warning(f"Провайдер {self.name} временно отключён после {self.failures} ошибок подряд")
+            self.open_until = time.monotonic() + CIRCUIT_OPEN_SECONDS
+
+PROVIDER_FAILOVERS = Counter("bot_provider_failovers_total", "Ответы запасной моделью вместо запрошенной", ("requested", "used"))
+PROVIDER_HEDGES = Counter("bot_provider_hedges_total", "Дублированные (хедж) запросы к провайдерам", ("model",))
+
+class ProviderRouter:
+    def __init__(self, clients: dict):
+        self.clients = {name: client for name, client in clients.items() if client is not None}
+        self.breakers = {name: CircuitBreaker(name) for name in self.clients}
+        self.failovers = 0
+        self.hedges = 0
+
+    def candidates(self, model: str, messages: list) -> list:
+        chain = [model] + [m for m in MODEL_FALLBACKS.get(model, []) if m != model]
+        if has_images(messages):
+            # Запасная модель для запроса с фото тоже должна понимать изображения
+            chain = [model] + [m for m in chain[1:] if is_vision_model(m)]
+        return [m for m in chain if provider_for(m) in self.clients]
+
+    async def _attempt(self, model: str, call, operation: str):
+        provider = provider_for(model)
+        breaker = self.breakers[provider]
+        # Отключённый провайдер пропускаем; в полуоткрытом состоянии проходит один пробный запрос
+        if not breaker.allow():
+            raise ProviderUnavailableError(f"провайдер {provider} временно недоступен")
+        try:
+            # Для stream это время до первого фрагмента текста
+            async with track_external(provider, operation):
+                result = await call(self.clients[provider], model)
+        except asyncio.CancelledError:
+            breaker.probing = False
+            raise
+        except Exception as e:
+            if is_failover_error(e):
+                breaker.record_failure()
+            else:
+                # Провайдер ответил (пусть и ошибкой в запросе) — значит, он доступен
+                breaker.record_success()
+            raise
+        breaker.record_success()
+        return result
+
+    async def _run(self, model: str, messages: list, call, operation: str, discard=None):
+        candidates = self.candidates(model, messages)
+        if not candidates:
+            raise RuntimeError(f"Нет доступного провайдера для модели {model}")
+        pending = {}
+        next_index = 0
+        hedged = False
+        last_error = None
+
+        def launch():
+            nonlocal next_index
+            candidate = candidates[next_index]
+            next_index += 1
+            pending[asyncio.create_task(self._attempt(candidate, call, operation))] = candidate
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if (HEDGE_AFTER_SECONDS and not hedged and next_index < len(candidates)
+                        and provider_for(candidates[0]) in HEDGE_PROVIDERS):
+                    timeout = HEDGE_AFTER_SECONDS
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.hedges += 1
+                    PROVIDER_HEDGES.inc(model=candidates[0])
+                    logging.info(f"{candidates[0]} не ответила за {HEDGE_AFTER_SECONDS} с, дублируем запрос в {candidates[next_index]}")
+                    launch()
+                    continue
+                for task in done:
+                    candidate = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if candidate != model:
+                            self.failovers += 1
+                            PROVIDER_FAILOVERS.inc(requested=model, used=candidate)
+                            logging.info(f"Запрос к {model} выполнен запасной моделью {candidate}")
+                        return task.result(), candidate
+                    if not is_failover_error(error):
+                        # Ошибка запроса у хеджа не должна обрывать основную модель, которая ещё отвечает
+                        if candidate == model or not pending:
+                            raise error
+                        logging.warning(f"Модель {candidate} отклонила запрос: {error}")
+                    else:
+                        logging.warning(f"Модель {candidate} недоступна: {error}")
+                    last_error = error
+                if not pending and next_index < len(candidates):
+                    launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+            if discard:
+                # Проигравший в гонке запрос мог успеть открыть поток — закрываем его
+                def discard_result(task):
+                    if not task.cancelled() and task.exception() is None:
+                        asyncio.ensure_future(discard(task.result()))
+                for task in pending:
+                    task.add_done_callback(discard_result)
+
+    async def complete(self, model: str, messages: list, **kwargs):
+        # Возвращает (ответ API, модель, которая на самом деле ответила)
+        async def call(client, candidate):
+            return await client.chat.completions.create(model=candidate, messages=messages, **kwargs)
+        return await self._run(model, messages, call, "chat")
+
+    async def stream(self, model: str, messages: list, **kwargs):
+        # Возвращает (первый фрагмент текста, async-итератор по остальным, модель).
+        # Переключение и хеджирование происходят до первого фрагмента текста.
+        async def call(client, candidate):
+            stream = await client.chat.completions.create(model=candidate, messages=messages, stream=True, **kwargs)
+            iterator = stream.__aiter__()
+            async for chunk in iterator:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    return stream, iterator, chunk.choices[0].delta.content
+            return stream, iterator, ""
+
+        async def discard(result):
+            await result[0].close()
+
+        (stream, iterator, first), used_model = await self._run(model, messages, call, "stream", discard=discard)
+        return first, iterator, used_model
+
+    def stats(self):
+        return {name: breaker.state for name, breaker in self.breakers.items()}
+
+router = ProviderRouter({"mistral": client_mistral, "openrouter": client_openrouter})
+
+# --- ИЗОБРАЖЕНИЯ В ИСТОРИИ ---
+# В истории хранится не ссылка на файл Telegram (в ней токен бота), а короткая запись
+# {"type": "image_ref", "sha256": ..., "caption": ...}. Сами фото лежат в локальном кэше
+# уменьшенных JPEG, адресуемом по хэшу содержимого. В запрос к модели целиком уходят
+# только последние IMAGE_INLINE_LAST фото, более старые заменяются подписью.
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(USER_DATA_DIR, "images"))
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 1024))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+IMAGE_INLINE_LAST = int(os.getenv("IMAGE_INLINE_LAST", 2))
+IMAGE_CAPTION_CHARS = int(os.getenv("IMAGE_CAPTION_CHARS", 300))
+IMAGE_CACHE_MAX_MB = float(os.getenv("IMAGE_CACHE_MAX_MB", 500))
+IMAGE_DOWNSCALE_TIMEOUT = 20
+# Размер кэша проверяем не на каждом сохранении, а раз в столько новых файлов
+IMAGE_PRUNE_EVERY = 50
+_images_stored = 0
+
+def image_path(sha256: str) -> str:
+    return os.path.join(IMAGE_CACHE_DIR, sha256[:2], f"{sha256}.jpg")
+
+def _write_image(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def prune_image_cache(max_bytes: int):
+    # Удаляем самые давно использованные файлы; ссылки на них в истории превратятся в подписи
+    files = []
+    for root, _, names in os.walk(IMAGE_CACHE_DIR):
+        for name in names:
+            if name.endswith(".jpg"):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+async def store_image(data: bytes) -> str:
+    # Кладёт фото в кэш (уменьшенным до IMAGE_MAX_SIDE) и возвращает его хэш
+    global _images_stored
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = image_path(sha256)
+    if os.path.exists(path):
+        os.utime(path)
+        return sha256
+    if pillow:
+        data = await run_in_process(IMAGE_DOWNSCALE_TIMEOUT, documents.downscale_image, data, IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY)
+    await asyncio.to_thread(_write_image, path, data)
+    _images_stored += 1
+    if _images_stored % IMAGE_PRUNE_EVERY == 0:
+        await asyncio.to_thread(prune_image_cache, int(IMAGE_CACHE_MAX_MB * 1024 * 1024))
+    return sha256
+
+@functools.lru_cache(maxsize=16)
+def _image_data_url(sha256: str) -> str:
+    # Последние фото уходят почти в каждом запросе — не читаем файл заново каждый раз.
+    # Если файла нет, lru_cache исключение не запоминает.
+    with open(image_path(sha256), "rb") as f:
+        return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
+
+def image_ref_count(msg: dict) -> int:
+    content = msg.get("content")
+    if not isinstance(content, list):
+        return 0
+    return sum(1 for part in content if part.get("type") == "image_ref")
+
+def mark_history_rewrite(user_id, data: dict, msg: dict):
+    # Сообщение истории изменено на месте: при записи по частям его строку нужно переписать,
+    # иначе в хранилище останется версия, попавшая туда до изменения
+    history = data["history"]
+    for index in range(len(history) - 1, -1, -1):
+        if history[index] is msg:
+            _history_rewrites.setdefault(user_id, set()).add(data.get("history_base", 0) + index)
+            return
+
+def set_image_caption(msg: dict, caption: str):
+    # Подпись — начало ответа модели о фото: её видят следующие запросы, когда само фото уже не отправляется
+    caption = " ".join((caption or "").split())
+    if len(caption) > IMAGE_CAPTION_CHARS:
+        caption = caption[:IMAGE_CAPTION_CHARS].rsplit(" ", 1)[0] + "…"
+    for part in msg.get("content") or []:
+        if part.get("type") == "image_ref" and caption:
+            part["caption"] = caption
+    msg.pop("_tokens", None)
+
+def _image_part(part: dict, inline: bool) -> dict:
+    if inline and part.get("sha256"):
+        try:
+            return {"type": "image_url", "image_url": {"url": _image_data_url(part["sha256"])}}
+        except OSError:
+            pass
+    return {"type": "text", "text": f"[Изображение: {part.get('caption') or 'без описания'}]"}
+
+# --- КОНТЕКСТ ДИАЛОГА (БЮДЖЕТ ТОКЕНОВ) ---
+# Сколько токенов истории отправлять каждой модели (вместе с системным промптом)
+MODEL_TOKEN_BUDGETS = {
+    "mistral-small-latest": 16000,
+    "mistral-large-latest": 24000,
+    "codestral-latest": 24000,
+    "google/gemini-2.0-flash-exp:free": 32000,
+    "tngtech/deepseek-r1t2-chimera:free": 24000,
+}
+DEFAULT_TOKEN_BUDGET = int(os.getenv("DEFAULT_TOKEN_BUDGET", 12000))
+# Дешёвая модель для сжатия старой части диалога в краткое содержание
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "mistral-small-latest")
+# Сжимаем историю, только когда за бюджет вышло хотя бы столько сообщений
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", 6))
+IMAGE_TOKEN_ESTIMATE = 1000
+
+def estimate_tokens(content) -> int:
+    # Без токенизатора: ~3 символа на токен для смеси кириллицы, латиницы и кода
+    if isinstance(content, str):
+        return len(content) // 3 + 4
+    tokens = 4
+    for part in content or []:
+        if part.get("type") == "text":
+            tokens += len(part.get("text", "")) // 3
+        elif part.get("type") == "image_ref":
+            # Само фото учитывается в build_context, только если оно уйдёт в запрос
+            tokens += len(part.get("caption") or "") // 3 + 8
+        else:
+            tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+def message_tokens(msg: dict) -> int:
+    # Оценка кэшируется в самом сообщении и сохраняется вместе с историей
+    tokens = msg.get("_tokens")
+    if tokens is None:
+        tokens = estimate_tokens(msg.get("content"))
+        msg["_tokens"] = tokens
+    return tokens
+
+def _api_message(msg: dict, max_tokens: int = None, inline_images: int = 0) -> dict:
+    # В API уходят только role и content — служебные поля Mistral не принимает.
+    # inline_images — сколько последних фото сообщения отправить целиком, остальные станут подписями.
+    content = msg.get("content")
+    if max_tokens is not None and isinstance(content, str) and message_tokens(msg) > max_tokens:
+        content = content[:max_tokens * 3] + "\n…(текст обрезан)"
+    elif isinstance(content, list) and image_ref_count(msg):
+        skip = image_ref_count(msg) - inline_images
+        parts = []
+        for part in content:
+            if part.get("type") == "image_ref":
+                parts.append(_image_part(part, skip <= 0))
+                skip -= 1
+            else:
+                parts.append(part)
+        if all(part.get("type") == "text" for part in parts):
+            content = "\n".join(part.get("text", "") for part in parts)
+        else:
+            content = parts
+    return {"role": msg["role"], "content": content}
+
+def build_context(user_id, data: dict, extra_messages: list = None) -> list:
+    model = data["model"]
+    budget = MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+    system_content = data.get("system_prompt", DEFAULT_SYSTEM_PROMPT) + HIDDEN_SYSTEM_PROMPT
+    if data.get("summary"):
+        system_content += f"\n\nКраткое содержание предыдущей части диалога:\n{data['summary']}"
+    extra_messages = extra_messages or []
+    used = estimate_tokens(system_content) + sum(estimate_tokens(m["content"]) for m in extra_messages)
+
+    # Набираем сообщения с конца, пока помещаемся в бюджет
+    history = data["history"]
+    start = len(history)
+    inline = []  # сколько фото отправить целиком, для каждого выбранного сообщения с конца
+    # Модели без зрения получают вместо фото только подписи
+    images_left = IMAGE_INLINE_LAST if is_vision_model(model) else 0
+    while start > 0 and len(history) - start < MAX_HISTORY_LENGTH:
+        msg = history[start - 1]
+        msg_inline = min(image_ref_count(msg), images_left)
+        tokens = message_tokens(msg) + msg_inline * IMAGE_TOKEN_ESTIMATE
+        if used + tokens > budget and start < len(history):
+            break
+        used += tokens
+        images_left -= msg_inline
+        inline.append(msg_inline)
+        start -= 1
+    inline.reverse()
+
+    if start >= SUMMARY_MIN_MESSAGES:
+        schedule_history_compaction(user_id, data, start)
+
+    selected = [_api_message(m, inline_images=n) for m, n in zip(history[start:], inline)]
+    if selected and used > budget:
+        # Даже одно последнее сообщение не влезает (например, большой PDF) — обрезаем его
+        selected[0] = _api_message(history[start], max_tokens=max(budget - (used - message_tokens(history[start])), 500),
+                                   inline_images=inline[0])
+    return [{"role": "system", "content": system_content}] + selected + extra_messages
+
+_compaction_tasks = {}
+
+def schedule_history_compaction(user_id, data: dict, count: int):
+    if user_id in _compaction_tasks:
+        return
+    task = asyncio.create_task(_compact_history(user_id, data, count))
+    _compaction_tasks[user_id] = task
+    # Сжатие переживает хендлер и сохраняет данные в конце — они не должны быть вытеснены
+    user_context.pin(user_id)
+    task.add_done_callback(lambda _: _compaction_done(user_id))
+
+def _compaction_done(user_id):
+    _compaction_tasks.pop(user_id, None)
+    user_context.unpin(user_id)
+
+def _format_for_summary(msg: dict) -> str:
+    role = "Пользователь" if msg.get("role") == "user" else "Ассистент"
+    content = msg.get("content")
+    if not isinstance(content, str):
+        content = " ".join(p.get("text", "") if p.get("type") == "text" else f"[изображение: {p.get('caption') or 'без описания'}]"
+                           for p in content or [])
+    if len(content) > 1500:
+        content = content[:1500] + "…"
+    return f"{role}: {content}"
+
+async def _compact_history(user_id, data: dict, count: int):
+    # Старые сообщения, не влезающие в бюджет, сворачиваем в краткое содержание
+    history = data["history"]
+    old_messages = history[:count]
+    previous_summary = data.get("summary", "")
+    dialog = "\n\n".join(_format_for_summary(m) for m in old_messages)
+    try:
+        response, _ = await router.complete(
+            SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "Ты сжимаешь переписку пользователя с ассистентом. Составь краткое содержание (не более 200 слов): ключевые факты о пользователе, его цели, принятые решения и незакрытые вопросы. Пиши только краткое содержание."},
+                {"role": "user", "content": f"Предыдущее краткое содержание:\n{previous_summary or '—'}\n\nНовая часть диалога:\n{dialog}"},
+            ]
+        )
+        summary = response.choices[0].message.content.strip()
+    except Exception as e:
+        logging.error(f"Ошибка сжатия истории пользователя {user_id}: {e}")
+        return
+
+    # Пока шёл запрос, история могла быть очищена или заменена
+    if data["history"] is not history or history[:count] != old_messages:
+        return
+    archive_history_front(user_id, data, count)
+    data["summary"] = summary
+    save_user_data(user_id)
+    logging.info(f"История пользователя {user_id}: {count} сообщений свёрнуто в краткое содержание")
 
 def get_model_keyboard():
     keyboard = []
@@ -154,6 +2084,24 @@ def get_model_keyboard():
         keyboard.append(row)
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+_bot_me = None
+_bot_me_lock = asyncio.Lock()
+
+async def get_bot_me() -> types.User:
+    # Данные бота (username для ссылок) не меняются, пока он запущен — запрашиваем один раз
+    global _bot_me
+    if _bot_me is None:
+        async with _bot_me_lock:
+            if _bot_me is None:
+                _bot_me = await bot.get_me()
+    return _bot_me
+
+async def warm_bot_me():
+    try:
+        await get_bot_me()
+    except Exception as e:
+        logging.warning(f"Не удалось заранее получить данные бота: {e}")
+
 async def set_main_menu(bot: Bot):
     main_menu_commands = [
         BotCommand(command='/start', description='👋 Перезапуск'),
@@ -162,6 +2110,7 @@ async def set_main_menu(bot: Bot):
         BotCommand(command='/search', description='🌍 Поиск в сети'),
         BotCommand(command='/donate', description='☕ Поддержать'),
         BotCommand(command='/clear', description='🧹 Очистка'),
+        BotCommand(command='/export', description='📜 Экспорт истории'),
         BotCommand(command='/system', description='🤖 Настройка роли'),
         BotCommand(command='/tts', description='🗣 Голосовые ответы'),
         BotCommand(command='/profile', description='👤 Профиль'),
@@ -171,21 +2120,35 @@ async def set_main_menu(bot: Bot):
 
 # --- ХЕНДЛЕРЫ ---
 
+async def credit_referral(referrer_id, new_user_name: str):
+    # Данные пригласившего принадлежат его шарду — изменяем их только там
+    if SHARD_INDEX is not None and owner_shard(referrer_id) != SHARD_INDEX:
+        await forward_to_shard(referrer_id, {"_internal": "referral", "referrer_id": referrer_id, "name": new_user_name})
+        return
+    ref_data = get_user_data(referrer_id)
+    ref_data["referrals"] = ref_data.get("referrals", 0) + 1
+    save_user_data(referrer_id)
+    usage_stats.add_total("referrals")
+    await bot.send_message(referrer_id, f"🎉 **У вас новый реферал!**\nПользователь {new_user_name} присоединился по вашей ссылке.", parse_mode="Markdown")
+
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     user_id = message.from_user.id
     
     # Проверка реферала
     args = message.text.split(maxsplit=1)
-    if user_id not in user_context and len(args) > 1 and args[1].isdigit():
+    is_new_user = user_id not in user_context and not get_storage().exists(user_id)
+    if is_new_user and len(args) > 1 and args[1].isdigit():
         referrer_id = int(args[1])
         if referrer_id != user_id:
-            ref_data = get_user_data(referrer_id)
-            ref_data["referrals"] = ref_data.get("referrals", 0) + 1
-            save_user_data(referrer_id)
-            await bot.send_message(referrer_id, f"🎉 **У вас новый реферал!**\nПользователь {message.from_user.full_name} присоединился по вашей ссылке.", parse_mode="Markdown")
+            await credit_referral(referrer_id, message.from_user.full_name)
 
-    user_context[user_id] = {"history": [], "model": DEFAULT_MODEL, "system_prompt": DEFAULT_SYSTEM_PROMPT, "tts_mode": False, "referrals": 0}
+    user_context[user_id] = default_user_data()
+    if is_new_user:
+        _new_users.add(user_id)
+    else:
+        # Нумерация истории начинается заново — старый архив с теми же seq смешался бы с новым
+        drop_history_archive(user_id)
     save_user_data(user_id)
     await message.answer("Привет! Я ваш ИИ-ассистент. Распознаю голос, отвечаю на вопросы и рисую. Используйте /mode для выбора модели.", reply_markup=get_model_keyboard())
 
@@ -202,6 +2165,7 @@ async def cmd_help(message: types.Message):
         "⚙️ **Команды:**\n"
         "/mode — Выбор нейросети\n"
         "/clear — Очистить память\n"
+        "/export — Скачать историю диалога\n"
         "/search — Поиск в интернете\n"
         "/system — Настройка роли\n"
         "/tts — Вкл/Выкл озвучку ответов\n"
@@ -214,10 +2178,36 @@ async def cmd_help(message: types.Message):
 @dp.message(Command("clear"))
 async def cmd_clear(message: types.Message):
     user_id = message.from_user.id
-    get_user_data(user_id)["history"] = []
+    data = get_user_data(user_id)
+    data["history"] = []
+    data.pop("summary", None)
+    drop_history_archive(user_id)
     save_user_data(user_id)
     await message.answer("🧹 Память очищена.")
 
+def _format_for_export(msg: dict) -> str:
+    role = "Пользователь" if msg.get("role") == "user" else "Ассистент"
+    content = msg.get("content")
+    if not isinstance(content, str):
+        content = "\n".join(p.get("text", "") if p.get("type") == "text" else f"[Изображение: {p.get('caption') or 'без описания'}]"
+                            for p in content or [])
+    return f"{role}:\n{content}"
+
+@dp.message(Command("export"))
+async def cmd_export(message: types.Message):
+    user_id = message.from_user.id
+    data = get_user_data(user_id)
+    # Сначала сбрасываем на диск то, что ещё ждёт записи в архив
+    await flush_user_data()
+    archived = await asyncio.to_thread(read_history_archive, user_id)
+    messages = archived + list(data["history"])
+    if not messages:
+        await message.answer("История пуста — экспортировать нечего.")
+        return
+    text = "\n\n".join(_format_for_export(m) for m in messages)
+    input_file = types.BufferedInputFile(text.encode("utf-8"), filename=f"history_{user_id}.txt")
+    await message.answer_document(input_file, caption=f"📜 История диалога: {len(messages)} сообщений.")
+
 @dp.message(Command("mode"))
 async def cmd_mode(message: types.Message):
     await message.answer("Выберите режим:", reply_markup=get_model_keyboard())
@@ -252,7 +2242,7 @@ async def cmd_tts(message: types.Message):
 async def cmd_profile(message: types.Message):
     user_id = message.from_user.id
     data = get_user_data(user_id)
-    bot_username = (await bot.get_me()).username
+    bot_username = (await get_bot_me()).username
     ref_link = f"https://t.me/{bot_username}?start={user_id}"
     await message.answer(f"👤 **Ваш профиль**\n\n🆔 ID: `{user_id}`\n👥 Приглашено друзей: **{data.get('referrals', 0)}**\n\n🔗 **Ваша реферальная ссылка:**\n`{ref_link}`", parse_mode="Markdown")
 
@@ -289,6 +2279,33 @@ async def process_donate_sent(callback: CallbackQuery):
     await callback.answer("Спасибо большое! Руслан получил уведомление. ❤️", show_alert=True)
     await callback.message.edit_reply_markup(reply_markup=None)
 
+# --- ПОИСК: КЭШ И ОГРАНИЧЕНИЕ ПОТОКОВ ---
+SEARCH_LANG = "ru"
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 600))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 2000))
+# Сколько запросов к Google может выполняться одновременно (каждый занимает поток)
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", 4))
+
+search_cache = AsyncTTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+_search_semaphore = asyncio.Semaphore(SEARCH_MAX_CONCURRENCY)
+
+def normalize_search_query(query: str) -> str:
+    # «Погода  в Москве?» и «погода в москве» — один и тот же запрос
+    return re.sub(r"\s+", " ", query.lower()).strip(" .,!?;:\"'«»")
+
+async def cached_google_search(query: str, lang: str = SEARCH_LANG):
+    async def load():
+        async with _search_semaphore, track_external("google", "search"):
+            # Запускаем синхронный поиск в отдельном потоке
+            results = await asyncio.to_thread(lambda: list(google_search(query, num_results=5, advanced=True, lang=lang)))
+        # Пустой результат не кэшируем — возможно, Google временно ограничил запросы
+        return [(r.title, r.url, r.description) for r in results] or None
+
+    started = time.monotonic()
+    results = await search_cache.get_or_load((normalize_search_query(query), lang), load)
+    logging.info(f"Поиск «{query}»: {time.monotonic() - started:.2f} с, кэш: {search_cache.stats()['hit_ratio']:.0%} попаданий")
+    return results or []
+
 @dp.message(Command("search"))
 async def cmd_search(message: types.Message):
     if not google_search:
@@ -300,7 +2317,11 @@ async def cmd_search(message: types.Message):
         await message.answer("🔎 **Поиск в интернете**\n\nВведите команду и ваш вопрос:\n`/search погода в Москве`\n`/search кто такой капибара`", parse_mode="Markdown")
         return
 
-    query = args[1]
+    usage_stats.record("search", get_user_data(message.from_user.id)["model"])
+    # Поиск меняет историю, поэтому идёт через ту же очередь, что и обычные сообщения
+    enqueue_user_job(message.from_user.id, message, process_search, args[1])
+
+async def process_search(message: Message, query: str):
     user_id = message.from_user.id
     data = get_user_data(user_id)
     current_model = data["model"]
@@ -310,15 +2331,14 @@ async def cmd_search(message: types.Message):
 
     try:
         results_text = ""
-        # Запускаем синхронный поиск в отдельном потоке
-        search_results = await asyncio.to_thread(lambda: list(google_search(query, num_results=5, advanced=True, lang="ru")))
+        search_results = await cached_google_search(query)
         
         if search_results:
-            for res in search_results:
-                results_text += f"🔹 {res.title}\n🔗 {res.url}\n{res.description}\n\n"
+            for title, url, description in search_results:
+                results_text += f"🔹 {title}\n🔗 {url}\n{description}\n\n"
             
         if not results_text:
-            await status_msg.edit_text("😔 Ничего не найдено по вашему запросу.")
+            await _answer_or_edit(message, "😔 Ничего не найдено по вашему запросу.", status_msg)
             return
 
         # Формируем контекст для ИИ
@@ -333,17 +2353,16 @@ async def cmd_search(message: types.Message):
         # Мы не добавляем сам текст результатов в историю пользователя, чтобы не засорять её,
         # а отправляем его как часть текущего запроса.
         
-        system_prompt = data.get("system_prompt", DEFAULT_SYSTEM_PROMPT)
-        messages = [{"role": "system", "content": system_prompt + HIDDEN_SYSTEM_PROMPT}] + history + [{"role": "user", "content": prompt}]
+        messages = build_context(user_id, data, extra_messages=[{"role": "user", "content": prompt}])
 
-        if '/' in current_model and client_openrouter:
-             response = await client_openrouter.chat.completions.create(model=current_model, messages=messages)
-        else:
-             response = await client_mistral.chat.completions.create(model=current_model, messages=messages)
-        
-        bot_answer = response.choices[0].message.content
+        cache_key, bot_answer = response_cache_lookup(current_model, messages)
+        if bot_answer is None:
+            response, used_model = await router.complete(current_model, messages)
+            bot_answer = response.choices[0].message.content
+            response_cache_store(cache_key, bot_answer, current_model, used_model)
         
-        await status_msg.edit_text(f"🔎 **Результаты поиска:**\n\n{results_text}\n⏳ _Анализирую информацию..._", parse_mode=None)
+        # Результаты могут не влезть в одно сообщение — режем так же, как ответы модели
+        await _answer_or_edit(message, f"🔎 **Результаты поиска:**\n\n{results_text}\n⏳ _Анализирую информацию..._", status_msg)
         
         # Сохраняем в историю только вопрос и ответ (без сырых результатов поиска)
         history.append({"role": "user", "content": f"Поиск: {query}"})
@@ -354,7 +2373,7 @@ async def cmd_search(message: types.Message):
 
     except Exception as e:
         logging.error(f"Search error: {e}")
-        await status_msg.edit_text(f"⚠️ Ошибка при поиске: {e}")
+        await _answer_or_edit(message, f"⚠️ Ошибка при поиске: {e}", status_msg)
 
 @dp.message(Command("feedback"))
 async def cmd_feedback(message: types.Message):
@@ -366,48 +2385,344 @@ async def cmd_feedback(message: types.Message):
     else:
         await message.answer("ℹ️ Чтобы написать разработчику, введите команду и текст через пробел:\n\n`/feedback У меня есть идея...`", parse_mode="Markdown")
 
-@dp.message(Command("admin"))
-async def cmd_admin(message: types.Message):
-    if message.from_user.id != ADMIN_ID:
+# --- СТАТИСТИКА ДЛЯ /admin ---
+def collect_local_stats():
+    # Сырые счётчики этого процесса; доли и средние считаются в _finalize_stats,
+    # чтобы их можно было корректно сложить со счётчиками других шардов
+    return {
+        "cache": user_context.stats(),
+        "dirty": len(_dirty_users) + len(_evicted_dirty),
+        "search": search_cache.stats(),
+        "translation": translation_cache.stats(),
+        "voice": transcription_queue.stats(),
+        "providers": router.stats(),
+        "failovers": router.failovers,
+        "hedges": router.hedges,
+        "usage": usage_stats.summary(),
+        "response_cache": {"size": len(response_cache), "models": response_cache_by_model},
+        "renders": render_stats,
+    }
+
+_STATE_SEVERITY = {"closed": 0, "half-open": 1, "open": 2}
+
+def _merge_stats(total: dict, part: dict) -> dict:
+    for key, value in part.items():
+        if isinstance(value, dict):
+            _merge_stats(total.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)):
+            total[key] = total.get(key, 0) + value
+        elif _STATE_SEVERITY.get(value, 0) >= _STATE_SEVERITY.get(total.get(key), 0):
+            # Состояние провайдера: показываем худшее по всем шардам
+            total[key] = value
+    return total
+
+def _ratio(numerator, denominator):
+    return numerator / denominator if denominator else 0.0
+
+def _finalize_stats(stats: dict) -> dict:
+    cache = stats["cache"]
+    cache["hit_ratio"] = _ratio(cache["hits"], cache["hits"] + cache["misses"])
+    for name in ("search", "translation"):
+        s = stats[name]
+        s["hit_ratio"] = _ratio(s["hits"] + s["coalesced"], s["hits"] + s["misses"] + s["coalesced"])
+        s["avg_load_time"] = _ratio(s["load_time"], s["loads"])
+    for counters in stats["response_cache"]["models"].values():
+        counters["hit_ratio"] = _ratio(counters["hits"], counters["hits"] + counters["misses"])
+    for counters in stats.setdefault("renders", {}).values():
+        counters["avg_time"] = _ratio(counters["seconds"], counters["count"])
+    voice = stats["voice"]
+    voice["avg_wait"] = _ratio(voice["total_wait"], voice["completed"])
+    voice["avg_latency"] = _ratio(voice["total_latency"], voice["completed"])
+    return stats
+
+@dp.message(Command("admin"))
+async def cmd_admin(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    stats, shard_count = gather_stats()
+    usage = stats["usage"]
+    events = usage["events"]
+    top_models = sorted(usage["models"].items(), key=lambda item: item[1], reverse=True)[:5]
+    models_text = "\n".join(f"  • {model}: {count}" for model, count in top_models) or "  —"
+    cache = stats["cache"]
+    search = stats["search"]
+    translation = stats["translation"]
+    voice = stats["voice"]
+    providers = ", ".join(f"{name} — {state}" for name, state in stats["providers"].items())
+    if RESPONSE_CACHE_ENABLED:
+        cached_models = "; ".join(
+            f"{model} {c['hit_ratio']:.0%} из {c['hits'] + c['misses']}" for model, c in stats["response_cache"]["models"].items()
+        ) or "запросов ещё не было"
+        response_cache_text = f"\n♻️ Кэш ответов: {stats['response_cache']['size']}, попадания: {cached_models}"
+    else:
+        response_cache_text = "\n♻️ Кэш ответов выключен"
+    renders_text = "; ".join(
+        f"{ext} {r['count']} шт., в среднем {r['avg_time']:.2f} с" + (f", ошибок {r['errors']}" if r["errors"] else "")
+        for ext, r in sorted(stats["renders"].items())
+    ) or "файлов ещё не было"
+    await message.answer(
+        f"👑 **Панель администратора**\n\n👥 Пользователей: {usage['users']}\n"
+        f"📈 Активных за день: {usage['dau']}, за неделю: {usage['wau']}\n"
+        f"🤝 Приглашено по рефералам: {usage['referrals']}\n"
+        f"💬 Сообщений: {events.get('text', 0)}, 🎤 голосовых: {events.get('voice', 0)}, "
+        f"📄 файлов: {events.get('document', 0)}, 🖼 фото: {events.get('photo', 0)}, 🌍 поисков: {events.get('search', 0)}\n"
+        f"🧠 Запросы по моделям:\n{models_text}\n\n"
+        f"💾 Хранилище: {STORAGE_BACKEND}\n✏️ Ожидают записи: {stats['dirty']}\n"
+        f"🧩 Процессов-шардов: {shard_count}\n\n"
+        f"🗂 Кэш пользователей: {cache['size']}, ~{cache['bytes'] / 1024 / 1024:.1f} МБ\n"
+        f"🎯 Попадания: {cache['hits']}, промахи: {cache['misses']} ({cache['hit_ratio']:.0%}), вытеснено: {cache['evictions']}\n\n"
+        f"🌍 Кэш поиска: {search['size']} запросов, попаданий {search['hit_ratio']:.0%}, "
+        f"поиск в среднем {search['avg_load_time']:.1f} с\n"
+        f"🈯 Кэш переводов: {translation['size']}, попаданий {translation['hit_ratio']:.0%}\n"
+        f"🎤 Распознавание: в очереди {voice['depth']}, готово {voice['completed']}, ошибок {voice['errors']}, "
+        f"в среднем {voice['avg_latency']:.1f} с (ожидание {voice['avg_wait']:.1f} с)\n"
+        f"🔀 Провайдеры: {providers}; переключений: {stats['failovers']}, хеджей: {stats['hedges']}"
+        f"{response_cache_text}\n📄 Вёрстка файлов: {renders_text}"
+    )
+
+# --- РАССЫЛКА ---
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))
+# Общий лимит Telegram — около 30 сообщений в секунду, оставляем запас
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_STATE_PATH = os.path.join(USER_DATA_DIR, "broadcast_state.json")
+BROADCAST_PAGE_SIZE = 1000
+BROADCAST_CHECKPOINT_INTERVAL = 2.0
+BROADCAST_REPORT_INTERVAL = 5.0
+
+class BroadcastJob:
+    # Фоновая рассылка: пул воркеров под общим token bucket. Прогресс периодически
+    # сохраняется в BROADCAST_STATE_PATH, поэтому после перезапуска рассылка продолжается
+    # с места остановки. cursor — наибольший user_id, до которого всё уже обработано.
+    def __init__(self, state: dict):
+        self.state = state
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self.task = None
+        self.cancelled = False
+        self._pending = deque()  # выданные воркерам user_id в порядке возрастания
+        self._done = set()
+        self._started = time.monotonic()
+        self._processed_at_start = self.processed
+
+    @classmethod
+    def create(cls, text: str, admin_chat_id: int):
+        return cls({
+            "text": text,
+            "admin_chat_id": admin_chat_id,
+            "status_message_id": None,
+            "cursor": None,
+            # Столько же, сколько обойдёт run(): заблокировавших бота рассылка пропускает
+            "total": get_storage().count_users(include_blocked=False),
+            "delivered": 0,
+            "blocked": 0,
+            "failed": 0,
+            "started_at": time.time(),
+        })
+
+    @classmethod
+    def load(cls):
+        if not os.path.exists(BROADCAST_STATE_PATH):
+            return None
+        try:
+            with open(BROADCAST_STATE_PATH, "r", encoding="utf-8") as f:
+                return cls(json.load(f))
+        except Exception as e:
+            logging.error(f"Не удалось прочитать состояние рассылки: {e}")
+            return None
+
+    @property
+    def processed(self):
+        return self.state["delivered"] + self.state["blocked"] + self.state["failed"]
+
+    def _save_state(self):
+        tmp_path = BROADCAST_STATE_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, BROADCAST_STATE_PATH)
+
+    def _mark_done(self, user_id):
+        self._done.add(user_id)
+        while self._pending and self._pending[0] in self._done:
+            self._done.discard(self._pending[0])
+            self.state["cursor"] = self._pending.popleft()
+
+    def progress_text(self, finished=False):
+        s = self.state
+        elapsed = max(time.monotonic() - self._started, 0.001)
+        rate = (self.processed - self._processed_at_start) / elapsed
+        total = max(s["total"], self.processed)
+        percent = self.processed / total * 100 if total else 100
+        header = "✅ Рассылка завершена" if finished else "🚀 Рассылка идёт"
+        text = (
+            f"{header}: {self.processed}/{total} ({percent:.0f}%)\n"
+            f"📬 Доставлено: {s['delivered']}\n"
+            f"🚫 Заблокировали бота: {s['blocked']}\n"
+            f"⚠️ Ошибки: {s['failed']}\n"
+            f"⚡ Скорость: {rate:.1f} сообщ./с"
+        )
+        if not finished and rate > 0:
+            text += f"\n⏱ Осталось: ~{(total - self.processed) / rate / 60:.0f} мин"
+        return text
+
+    async def _report(self, finished=False):
+        chat_id = self.state["admin_chat_id"]
+        text = self.progress_text(finished)
+        try:
+            if self.state["status_message_id"] and not finished:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=self.state["status_message_id"])
+            else:
+                msg = await bot.send_message(chat_id, text)
+                self.state["status_message_id"] = msg.message_id
+        except TelegramBadRequest:
+            pass
+        except Exception as e:
+            logging.warning(f"Не удалось обновить прогресс рассылки: {e}")
+
+    async def _send(self, user_id):
+        text, parse_mode = prepare_markdown(f"📢 **Новости бота:**\n\n{self.state['text']}")
+        while True:
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=user_id, text=text, parse_mode=parse_mode)
+                self.state["delivered"] += 1
+                return
+            except TelegramRetryAfter as e:
+                # Притормаживаем всех воркеров, а не только текущего
+                logging.warning(f"Рассылка: Telegram просит подождать {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                self.state["blocked"] += 1
+                await asyncio.to_thread(get_storage().set_blocked, user_id, True)
+                return
+            except Exception as e:
+                logging.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                self.state["failed"] += 1
+                return
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            try:
+                if user_id is None:
+                    return
+                await self._send(user_id)
+                self._mark_done(user_id)
+            finally:
+                queue.task_done()
+
+    async def _checkpoint_loop(self):
+        last_report = 0.0
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            await asyncio.to_thread(self._save_state)
+            if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                last_report = time.monotonic()
+                await self._report()
+
+    async def run(self):
+        # Сообщения рассылки пропускают вперёд ответы пользователям (см. SendScheduler)
+        send_priority.set(SEND_PRIORITY_BROADCAST)
+        queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 4)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(BROADCAST_WORKERS)]
+        checkpoint = asyncio.create_task(self._checkpoint_loop())
+        try:
+            if not self.state["status_message_id"]:
+                await self._report()
+            cursor = self.state["cursor"]
+            while True:
+                # Читаем пользователей страницами, а не весь список разом
+                page = get_storage().list_user_ids(after=cursor, limit=BROADCAST_PAGE_SIZE, include_blocked=False)
+                if not page:
+                    break
+                for user_id in page:
+                    self._pending.append(user_id)
+                    await queue.put(user_id)
+                cursor = page[-1]
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            for worker in workers:
+                worker.cancel()
+            # Отменена администратором — забываем; остановлена вместе с ботом — сохраняем для продолжения
+            if self.cancelled:
+                if os.path.exists(BROADCAST_STATE_PATH):
+                    os.remove(BROADCAST_STATE_PATH)
+            else:
+                await asyncio.to_thread(self._save_state)
+            raise
+        finally:
+            checkpoint.cancel()
+        if os.path.exists(BROADCAST_STATE_PATH):
+            os.remove(BROADCAST_STATE_PATH)
+        await self._report(finished=True)
+        logging.info(f"Рассылка завершена: {self.state}")
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def cancel(self):
+        self.cancelled = True
+        self.task.cancel()
+
+_broadcast_job = None
+
+def broadcast_running():
+    return _broadcast_job is not None and _broadcast_job.task is not None and not _broadcast_job.task.done()
+
+async def resume_broadcast():
+    # Вызывается при старте: если рассылка прервалась перезапуском, продолжаем её
+    global _broadcast_job
+    job = BroadcastJob.load()
+    if job is None:
         return
-    
-    # Подсчет пользователей
-    user_files = [f for f in os.listdir(USER_DATA_DIR) if f.endswith('.json')]
-    user_count = len(user_files)
-    
-    await message.answer(f"👑 **Панель администратора**\n\n👥 Пользователей: {user_count}\n📂 Файлов данных: {len(user_files)}")
+    logging.info(f"Продолжаем прерванную рассылку с user_id > {job.state['cursor']}")
+    job.state["status_message_id"] = None
+    _broadcast_job = job
+    job.start()
 
 @dp.message(Command("broadcast"))
 async def cmd_broadcast(message: types.Message):
+    global _broadcast_job
     if message.from_user.id != ADMIN_ID:
         return
 
+    if broadcast_running():
+        await message.answer(_broadcast_job.progress_text())
+        return
+
     args = message.text.split(maxsplit=1)
     if len(args) < 2:
-        await message.answer("⚠️ Использование: `/broadcast Текст рассылки`", parse_mode="Markdown")
+        await message.answer("⚠️ Использование: `/broadcast Текст рассылки`\nОстановить: /broadcast\\_cancel", parse_mode="Markdown")
         return
 
     text = args[1]
-    user_files = [f for f in os.listdir(USER_DATA_DIR) if f.endswith('.json')]
-    count = 0
-
-    await message.answer(f"🚀 Начинаю рассылку для {len(user_files)} пользователей...")
+    # Сначала показываем рассылку администратору: так ошибка разметки всплывёт до отправки всем
+    try:
+        await message.answer(f"📢 **Новости бота:**\n\n{text}", parse_mode="Markdown")
+    except TelegramBadRequest as e:
+        await message.answer(f"⚠️ Telegram не принял разметку сообщения: {e}\nИсправьте текст и попробуйте снова.")
+        return
 
-    for filename in user_files:
-        user_id = filename.split('.')[0]
-        try:
-            await bot.send_message(chat_id=user_id, text=f"📢 **Новости бота:**\n\n{text}", parse_mode="Markdown")
-            count += 1
-            await asyncio.sleep(0.05) # Небольшая задержка, чтобы не получить бан от Telegram
-        except Exception as e:
-            logging.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+    _broadcast_job = BroadcastJob.create(text, message.chat.id)
+    await asyncio.to_thread(_broadcast_job._save_state)
+    _broadcast_job.start()
 
-    await message.answer(f"✅ Рассылка завершена. Доставлено: {count} из {len(user_files)}")
+@dp.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not broadcast_running():
+        await message.answer("ℹ️ Сейчас рассылка не идёт.")
+        return
+    _broadcast_job.cancel()
+    await message.answer(f"🛑 Рассылка остановлена.\n\n{_broadcast_job.progress_text()}")
 
 @dp.inline_query()
 async def inline_query_handler(query: InlineQuery):
     user_id = query.from_user.id
-    bot_username = (await bot.get_me()).username
+    bot_username = (await get_bot_me()).username
     results = [
         InlineQueryResultArticle(
             id="1",
@@ -426,8 +2741,11 @@ async def process_model_selection(callback: CallbackQuery):
     new_model_code = callback.data.split(":", 1)[1]
     data = get_user_data(user_id)
     data["model"] = new_model_code
-    # Очищаем историю при смене модели, чтобы избежать путаницы контекста
+    # Очищаем историю при смене модели, чтобы избежать путаницы контекста;
+    # сам диалог остаётся в архиве и попадёт в /export
+    archive_history_front(user_id, data, len(data["history"]))
     data["history"] = []
+    data.pop("summary", None)
     save_user_data(user_id)
 
     model_name = "Неизвестная модель"
@@ -439,32 +2757,206 @@ async def process_model_selection(callback: CallbackQuery):
     await callback.answer()
     await callback.message.edit_text(f"✅ Режим изменен на: **{model_name}**", parse_mode="Markdown")
     # --- ОБРАБОТКА ГОЛОСОВЫХ (ЧЕРЕЗ GROQ) ---
+# Сколько запросов к Whisper выполняется одновременно и сколько разрешено в минуту
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", 4))
+GROQ_REQUESTS_PER_MINUTE = float(os.getenv("GROQ_REQUESTS_PER_MINUTE", 20))
+TRANSCRIBE_QUEUE_SIZE = int(os.getenv("TRANSCRIBE_QUEUE_SIZE", 200))
+# Длинные голосовые режутся на куски такой длины и распознаются параллельно
+VOICE_SEGMENT_SECONDS = int(os.getenv("VOICE_SEGMENT_SECONDS", 120))
+OPUS_SAMPLE_RATE = 48000
+
+def _ogg_crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+_OGG_CRC_TABLE = _ogg_crc_table()
+
+def ogg_crc(data: bytes) -> int:
+    # CRC-32 страницы OGG: полином 0x04C11DB7, без отражения битов, начальное значение 0
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _OGG_CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+def _rewrite_ogg_page(page: bytes, sequence: int, granule: int, eos: bool) -> bytes:
+    page = bytearray(page)
+    page[5] = (page[5] & ~0x04) | (0x04 if eos else 0)
+    page[6:14] = granule.to_bytes(8, "little", signed=True)
+    page[18:22] = sequence.to_bytes(4, "little")
+    page[22:26] = b"\0\0\0\0"
+    page[22:26] = ogg_crc(page).to_bytes(4, "little")
+    return bytes(page)
+
+def split_ogg_opus(data: bytes, segment_seconds: int) -> list:
+    # Делим OGG/Opus по границам страниц, не декодируя звук. Каждому куску
+    # добавляются заголовочные страницы (OpusHead/OpusTags), чтобы он был самостоятельным файлом:
+    # страницы звука перенумеровываются после заголовков, granule position отсчитывается
+    # от начала куска, последняя страница помечается концом потока, CRC пересчитывается.
+    pages = []
+    pos = 0
+    while pos + 27 <= len(data):
+        if data[pos:pos + 4] != b"OggS":
+            raise ValueError("повреждённый OGG-поток")
+        header_type = data[pos + 5]
+        granule = int.from_bytes(data[pos + 6:pos + 14], "little", signed=True)
+        segment_count = data[pos + 26]
+        length = 27 + segment_count + sum(data[pos + 27:pos + 27 + segment_count])
+        pages.append((data[pos:pos + length], granule, header_type & 0x01))
+        pos += length
+
+    headers = []
+    while pages and pages[0][1] == 0:
+        headers.append(pages.pop(0)[0])
+    if not headers:
+        raise ValueError("в OGG-потоке нет заголовков Opus")
+
+    groups = []
+    current = []
+    segment_end = segment_seconds * OPUS_SAMPLE_RATE
+    for page in pages:
+        _, granule, continued = page
+        # Режем только перед страницей, которая начинается с нового пакета
+        if current and not continued and granule > segment_end:
+            groups.append(current)
+            current = []
+            segment_end += segment_seconds * OPUS_SAMPLE_RATE
+        current.append(page)
+    if current:
+        groups.append(current)
+
+    segments = []
+    base = 0  # granule конца предыдущего куска
+    for group in groups:
+        out = list(headers)
+        for index, (page, granule, _) in enumerate(group):
+            # -1 — на странице не заканчивается ни один пакет, такую позицию не меняем
+            new_granule = granule - base if granule >= 0 else -1
+            out.append(_rewrite_ogg_page(page, len(headers) + index, new_granule, index == len(group) - 1))
+        segments.append(b"".join(out))
+        base = max((granule for _, granule, _ in group), default=base)
+    return segments
+
+class TranscriptionQueue:
+    # Очередь запросов к Groq Whisper: ограниченное число воркеров и token bucket
+    # под лимит запросов в минуту. Воркеры запускаются при первом обращении.
+    def __init__(self, workers: int, requests_per_minute: float, maxsize: int):
+        self.workers_count = workers
+        self.bucket = TokenBucket(requests_per_minute / 60, capacity=max(1.0, requests_per_minute / 10))
+        self.maxsize = maxsize
+        self.queue = None
+        self.workers = []
+        self.completed = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.total_wait = 0.0
+
+    @property
+    def depth(self):
+        return self.queue.qsize() if self.queue else 0
+
+    def _ensure_started(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.maxsize)
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def transcribe(self, filename: str, audio: bytes) -> str:
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((filename, audio, future, time.monotonic()))
+        return await future
+
+    async def _worker(self):
+        while True:
+            filename, audio, future, enqueued_at = await self.queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                await self.bucket.acquire()
+                started = time.monotonic()
+                try:
+                    text = await self._request(filename, audio)
+                except Exception as e:
+                    self.errors += 1
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                self.completed += 1
+                self.total_wait += started - enqueued_at
+                self.total_latency += time.monotonic() - enqueued_at
+                if not future.done():
+                    future.set_result(text)
+            finally:
+                self.queue.task_done()
+
+    async def _request(self, filename: str, audio: bytes) -> str:
+        for attempt in range(3):
+            try:
+                # Groq сам умеет работать с файлами Telegram, конвертация не нужна!
+                async with track_external("groq", "transcription"):
+                    transcription = await get_groq_client().audio.transcriptions.create(
+                        file=(filename, audio),
+                        model="whisper-large-v3", # Самая мощная модель
+                        response_format="json",
+                        language="ru",            # Подсказываем, что язык русский
+                        temperature=0.0
+                    )
+                return transcription.text
+            except groq.RateLimitError as e:
+                if attempt == 2:
+                    raise
+                retry_after = float(e.response.headers.get("retry-after", 5 * (attempt + 1)))
+                logging.warning(f"Groq: лимит запросов, ждём {retry_after} с")
+                self.bucket.pause(retry_after)
+                await self.bucket.acquire()
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "completed": self.completed,
+            "errors": self.errors,
+            "total_wait": self.total_wait,
+            "total_latency": self.total_latency,
+            "avg_wait": self.total_wait / self.completed if self.completed else 0.0,
+            "avg_latency": self.total_latency / self.completed if self.completed else 0.0,
+        }
+
+transcription_queue = TranscriptionQueue(TRANSCRIBE_WORKERS, GROQ_REQUESTS_PER_MINUTE, TRANSCRIBE_QUEUE_SIZE)
+
+async def transcribe_voice(audio: bytes, duration: int) -> str:
+    segments = [audio]
+    if duration and duration > VOICE_SEGMENT_SECONDS:
+        try:
+            segments = await asyncio.to_thread(split_ogg_opus, audio, VOICE_SEGMENT_SECONDS)
+        except ValueError as e:
+            logging.warning(f"Не удалось разрезать голосовое, распознаём целиком: {e}")
+    texts = await asyncio.gather(*[
+        transcription_queue.transcribe(f"voice_{index}.ogg", segment) for index, segment in enumerate(segments)
+    ])
+    return " ".join(t.strip() for t in texts if t)
+
 @dp.message(F.voice)
 async def handle_voice(message: Message):
-    user_id = message.from_user.id
+    if not groq:
+        await message.answer("⚠️ Распознавание голоса недоступно: библиотека `groq` не установлена.", parse_mode="Markdown")
+        return
+    usage_stats.record("voice")
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
-    filename = f"voice_{user_id}.ogg"
-    
     try:
-        # 1. Скачиваем файл от Telegram
-        file_id = message.voice.file_id
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        await bot.download_file(file_path, filename)
+        # 1. Скачиваем файл от Telegram сразу в память
+        audio = BytesIO()
+        await bot.download(message.voice.file_id, destination=audio)
         
-        # 2. Отправляем файл в Groq (Whisper)
-        # Groq сам умеет работать с файлами Telegram, конвертация не нужна!
-        with open(filename, "rb") as file:
-            transcription = await client_groq.audio.transcriptions.create(
-                file=(filename, file.read()),
-                model="whisper-large-v3", # Самая мощная модель
-                response_format="json",
-                language="ru",            # Подсказываем, что язык русский
-                temperature=0.0
-            )
+        # 2. Отправляем файл в Groq (Whisper) через общую очередь
+        started = time.monotonic()
+        text = await transcribe_voice(audio.getvalue(), message.voice.duration)
+        logging.info(f"Голосовое {message.voice.duration} с распознано за {time.monotonic() - started:.2f} с, в очереди: {transcription_queue.depth}")
         
-        text = transcription.text
         await message.reply(f"🎤 <b>Вы сказали:</b> «{text}»", parse_mode="HTML")
         
         # 3. Передаем распознанный текст дальше для обработки
@@ -473,59 +2965,86 @@ async def handle_voice(message: Message):
     except Exception as e:
         logging.error(f"Ошибка Groq: {e}")
         await message.answer(f"⚠️ Ошибка распознавания: {e}\nПроверьте GROQ_API_KEY.")
-    
-    finally:
-        # Удаляем файл
-        if os.path.exists(filename):
-            os.remove(filename)
 
 # --- ОБРАБОТКА ФАЙЛОВ (ЧТЕНИЕ ТЕКСТА/КОДА) ---
+# Telegram Bot API отдаёт ботам файлы до 20 МБ
+MAX_DOCUMENT_SIZE_MB = float(os.getenv("MAX_DOCUMENT_SIZE_MB", 20))
+# Бюджеты на один файл: время разбора, число страниц PDF и объём текста
+DOCUMENT_TIMEOUT = float(os.getenv("DOCUMENT_TIMEOUT", 30))
+DOCUMENT_MAX_PAGES = int(os.getenv("DOCUMENT_MAX_PAGES", 300))
+DOCUMENT_MAX_CHARS = int(os.getenv("DOCUMENT_MAX_CHARS", 200000))
+TEXT_EXTENSIONS = ('.txt', '.py', '.html', '.md', '.json')
+
+def _read_text_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return f.read(DOCUMENT_MAX_CHARS * 4).decode('utf-8', errors='replace')
+
+async def extract_document_text(file_name: str, path: str):
+    # Возвращает (текст, примечание об обрезке или None). Файл лежит во временном
+    # каталоге — процессу пула передаётся только путь, а не до 20 МБ байтов.
+    if file_name.endswith(TEXT_EXTENSIONS):
+        text = await asyncio.to_thread(_read_text_file, path)
+        if len(text) > DOCUMENT_MAX_CHARS:
+            return text[:DOCUMENT_MAX_CHARS], f"прочитано первых {DOCUMENT_MAX_CHARS} символов"
+        return text, None
+
+    if file_name.endswith('.docx'):
+        text = await run_in_process(DOCUMENT_TIMEOUT, documents.extract_docx, path)
+        if len(text) > DOCUMENT_MAX_CHARS:
+            return text[:DOCUMENT_MAX_CHARS], f"прочитано первых {DOCUMENT_MAX_CHARS} символов"
+        return text, None
+
+    # PDF: цикл по страницам и проверка бюджетов выполняются в процессе пула
+    text, pages_read, page_count, reason = await run_in_process(
+        DOCUMENT_TIMEOUT, documents.extract_pdf_text, path, DOCUMENT_MAX_PAGES, DOCUMENT_MAX_CHARS, DOCUMENT_TIMEOUT
+    )
+    notes = {
+        "time": f"прочитано {pages_read} из {page_count} страниц, закончилось время",
+        "chars": f"прочитано {pages_read} страниц, достигнут лимит {DOCUMENT_MAX_CHARS} символов",
+        "pages": f"прочитано {DOCUMENT_MAX_PAGES} из {page_count} страниц",
+    }
+    return text, notes.get(reason)
+
 @dp.message(F.document)
 async def handle_document(message: Message):
+    usage_stats.record("document")
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
-    # Проверяем размер (не более 1 МБ для текста)
-    if message.document.file_size > 1024 * 1024:
-        await message.reply("⚠️ Файл слишком большой. Присылайте текстовые файлы до 1 МБ.")
+    # Проверяем размер
+    if message.document.file_size > MAX_DOCUMENT_SIZE_MB * 1024 * 1024:
+        await message.reply(f"⚠️ Файл слишком большой. Присылайте файлы до {MAX_DOCUMENT_SIZE_MB:g} МБ.")
+        return
+
+    file_name = (message.document.file_name or "").lower()
+    if file_name.endswith('.docx') and not docx:
+        await message.reply("⚠️ Чтение .docx файлов отключено, так как не установлена библиотека `python-docx`.")
+        return
+    if file_name.endswith('.pdf') and not fitz:
+        await message.reply("⚠️ Чтение .pdf файлов отключено, так как не установлена библиотека `PyMuPDF`.")
+        return
+    if not file_name.endswith(TEXT_EXTENSIONS + ('.docx', '.pdf')):
+        await message.reply("⚠️ Этот формат файлов не поддерживается. Я умею читать .txt, .py, .html, .docx и .pdf.")
         return
 
     try:
-        # Скачиваем файл в память
-        file = await bot.get_file(message.document.file_id)
-        file_content = BytesIO()
-        await bot.download(file=file.file_id, destination=file_content)
-        file_content.seek(0)
-        
-        text_content = ""
-        file_name = message.document.file_name.lower()
-
-        if file_name.endswith('.txt') or file_name.endswith('.py') or file_name.endswith('.html') or file_name.endswith('.md') or file_name.endswith('.json'):
-            text_content = file_content.getvalue().decode('utf-8')
-        elif file_name.endswith('.docx'):
-            if docx:
-                doc = docx.Document(file_content)
-                text_content = "\n".join([para.text for para in doc.paragraphs])
-            else:
-                await message.reply("⚠️ Чтение .docx файлов отключено, так как не установлена библиотека `python-docx`.")
-                return
-        elif file_name.endswith('.pdf'):
-            if fitz:
-                pdf_document = fitz.open(stream=file_content, filetype="pdf")
-                for page in pdf_document:
-                    text_content += page.get_text()
-                pdf_document.close()
-            else:
-                await message.reply("⚠️ Чтение .pdf файлов отключено, так как не установлена библиотека `PyMuPDF`.")
-                return
-        else:
-            await message.reply("⚠️ Этот формат файлов не поддерживается. Я умею читать .txt, .py, .html, .docx и .pdf.")
-            return
+        # Скачиваем файл во временный каталог
+        with tempfile.TemporaryDirectory(prefix="bot-doc-") as tmp_dir:
+            path = os.path.join(tmp_dir, "document" + os.path.splitext(file_name)[1])
+            await bot.download(message.document.file_id, destination=path)
+
+            started = time.monotonic()
+            text_content, note = await extract_document_text(file_name, path)
+        logging.info(f"Файл {file_name} ({message.document.file_size} байт) разобран за {time.monotonic() - started:.2f} с, символов: {len(text_content)}")
+        if note:
+            await message.reply(f"ℹ️ Файл большой, поэтому я прочитал только его часть ({note}).")
         
         user_caption = message.caption or "Проанализируй этот файл."
         full_text = f"📄 **Файл:** {message.document.file_name}\n\n{user_caption}\n\n---\n{text_content}"
         
         await handle_text_message(message, text_from_voice=full_text)
         
+    except asyncio.TimeoutError:
+        await message.reply("⚠️ Не удалось прочитать файл: разбор занял слишком много времени.")
     except Exception as e:
         logging.error(f"Ошибка чтения файла: {e}")
         await message.reply(f"⚠️ Ошибка при чтении файла: {e}")
@@ -538,7 +3057,7 @@ async def handle_photo_message(message: Message):
     current_model = data["model"]
 
     # Проверяем, выбрана ли модель с поддержкой зрения
-    if "vision" not in current_model and "gemini" not in current_model and "vl" not in current_model:
+    if not is_vision_model(current_model):
         await message.reply(
             "Чтобы анализировать изображения, выберите модель с поддержкой зрения (например, ✨ Gemini 2.0 Flash) через команду /mode."
         )
@@ -548,189 +3067,583 @@ async def handle_photo_message(message: Message):
         await message.answer("⚠️ Модели через OpenRouter недоступны. Проверьте, правильно ли указан API-ключ.")
         return
 
+    usage_stats.record("photo", current_model)
+    # Фото дописывается в историю — ставим его в очередь пользователя вместе с текстом
+    enqueue_user_job(user_id, message, process_photo_message)
+
+async def process_photo_message(message: Message):
+    user_id = message.from_user.id
+    data = get_user_data(user_id)
+    current_model = data["model"]
+
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     processing_msg = await message.answer("⏳ Размышляю...")
 
     try:
-        # Получаем URL изображения в лучшем качестве
+        # Скачиваем фото в лучшем качестве и кладём в локальный кэш: ссылка на файл
+        # Telegram содержит токен бота, её нельзя ни хранить, ни отправлять провайдеру
         photo = message.photo[-1]
-        file_info = await bot.get_file(photo.file_id)
-        file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
+        photo_data = BytesIO()
+        await bot.download(photo.file_id, destination=photo_data)
+        sha256 = await store_image(photo_data.getvalue())
 
         text_prompt = message.caption if message.caption else "Что на этом изображении?"
 
         history = data["history"]
         
         # Формируем мультимодальный запрос, как в вашем примере
-        history.append({
+        user_message = {
             "role": "user",
             "content": [
                 {"type": "text", "text": text_prompt},
-                {"type": "image_url", "image_url": {"url": file_url}}
+                {"type": "image_ref", "sha256": sha256, "caption": message.caption or ""}
             ]
-        })
+        }
+        history.append(user_message)
 
         # Отправляем запрос в OpenRouter
-        chat_response = await client_openrouter.chat.completions.create(
-            model=current_model,
-            messages=history[-MAX_HISTORY_LENGTH:] # Отправляем только последнюю часть истории
+        chat_response, _ = await router.complete(
+            current_model,
+            build_context(user_id, data) # Отправляем только то, что влезает в бюджет токенов
         )
         
-        await processing_msg.delete()
+        await delete_quietly(processing_msg)
         bot_answer = chat_response.choices[0].message.content if chat_response.choices else "Не удалось получить ответ."
+        set_image_caption(user_message, bot_answer)
+        # Пока модель отвечала, сообщение с пустой подписью могло уже попасть на диск
+        mark_history_rewrite(user_id, data, user_message)
         history.append({"role": "assistant", "content": bot_answer})
         save_user_data(user_id)
         
         await process_model_response(message, bot_answer)
 
     except AuthenticationError:
-        await processing_msg.delete()
+        await delete_quietly(processing_msg)
         logging.error("Ошибка аутентификации OpenRouter: неверный API ключ.")
         await message.answer("⚠️ **Ошибка**: API-ключ для OpenRouter недействителен. Пожалуйста, проверьте ваш ключ.")
     except RateLimitError:
-        await processing_msg.delete()
+        await delete_quietly(processing_msg)
         logging.warning("Достигнут лимит запросов для модели (фото).")
         await message.answer("⏳ Модель для анализа фото сейчас перегружена. Пожалуйста, попробуйте снова через несколько минут.")
     except Exception as e:
-        await processing_msg.delete()
+        await delete_quietly(processing_msg)
         logging.error(f"Ошибка при обработке изображения: {e}")
         await message.answer(f"⚠️ Произошла ошибка при обработке изображения: {e}")
 
-async def generate_and_send_file(message: Message, filename: str, content: str):
-    ext = os.path.splitext(filename)[1].lower()
-    file_io = BytesIO()
-    
+# --- СОЗДАНИЕ ФАЙЛОВ ---
+# Шрифт для PDF ищется один раз при запуске; путь можно задать явно через PDF_FONT_PATH
+PDF_FONT_PATH = documents.find_cyrillic_font(os.getenv("PDF_FONT_PATH"))
+if reportlab and not PDF_FONT_PATH:
+    logging.warning("Не найден TTF-шрифт с кириллицей (DejaVu/Liberation/Noto). PDF будут без русских букв. Установите: apt install fonts-dejavu-core")
+# Ограничения на один сгенерированный файл
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", 30))
+GENERATED_FILE_MAX_CHARS = int(os.getenv("GENERATED_FILE_MAX_CHARS", 300000))
+GENERATED_FILE_MAX_MB = float(os.getenv("GENERATED_FILE_MAX_MB", 20))
+
+# Несколько файлов в одном ответе верстаются параллельно, но не больше RENDER_CONCURRENCY
+# одновременно: таймаут считается с начала вёрстки, а не с постановки в очередь пула
+RENDER_CONCURRENCY = int(os.getenv("RENDER_CONCURRENCY", CPU_WORKERS))
+# До стольких файлов отправляем альбомом, больше — одним ZIP-архивом (в альбоме не больше 10)
+GENERATED_FILES_ZIP_THRESHOLD = min(int(os.getenv("GENERATED_FILES_ZIP_THRESHOLD", 5)), 10)
+GENERATE_FILE_RE = re.compile(r'<GENERATE_FILE\s+filename="([^"]*)"\s*>(.*?)</GENERATE_FILE>', re.DOTALL)
+FILE_CAPTIONS = {".docx": "✅ Вот ваш документ!", ".pdf": "✅ Вот ваш PDF!"}
+
+_render_semaphore = asyncio.Semaphore(RENDER_CONCURRENCY)
+render_stats = {}  # расширение -> {"count", "errors", "seconds"}
+RENDER_SECONDS = Histogram("bot_file_render_seconds", "Время вёрстки сгенерированных файлов", ("format",))
+
+def parse_generated_files(text: str):
+    # Один проход по ответу: текст без тегов и список (имя файла, содержимое)
+    files = []
+    parts = []
+    position = 0
+    for match in GENERATE_FILE_RE.finditer(text):
+        parts.append(text[position:match.start()])
+        files.append((match.group(1), match.group(2).strip()))
+        position = match.end()
+    parts.append(text[position:])
+    return "".join(parts).strip(), files
+
+def _unique_filenames(names: list) -> list:
+    # Имя из ответа модели: без каталогов и без повторов внутри альбома или архива
+    seen = set()
+    result = []
+    for name in names:
+        name = os.path.basename(name.strip().replace("\\", "/")) or "file.txt"
+        stem, ext = os.path.splitext(name)
+        candidate, index = name, 2
+        while candidate.lower() in seen:
+            candidate = f"{stem} ({index}){ext}"
+            index += 1
+        seen.add(candidate.lower())
+        result.append(candidate)
+    return result
+
+async def render_document(ext: str, content: str) -> bytes:
+    # Вёрстка выполняется в пуле процессов с ограничением по времени; зависшая
+    # вёрстка не держит процесс — run_in_process перезапускает пул
     if ext == '.docx':
-        if not docx:
-            await message.answer("⚠️ Создание .docx невозможно: библиотека python-docx не установлена.")
-            return
-        doc = docx.Document()
-        for line in content.split('\n'):
-            doc.add_paragraph(line)
-        doc.save(file_io)
-        file_io.seek(0)
-        input_file = types.BufferedInputFile(file_io.getvalue(), filename=filename)
-        await message.answer_document(input_file, caption="✅ Вот ваш документ!")
-        
-    elif ext == '.pdf':
-        if not reportlab_available:
-            await message.answer("⚠️ Создание .pdf невозможно: библиотека reportlab не установлена. (pip install reportlab)")
-            return
-        
+        file_bytes = await run_in_process(RENDER_TIMEOUT, documents.render_docx, content)
+    else:
+        file_bytes = await run_in_process(RENDER_TIMEOUT, documents.render_pdf, content, PDF_FONT_PATH)
+    if len(file_bytes) > GENERATED_FILE_MAX_MB * 1024 * 1024:
+        raise ValueError(f"файл получился больше {GENERATED_FILE_MAX_MB:g} МБ")
+    return file_bytes
+
+async def build_generated_file(filename: str, content: str) -> bytes:
+    # Байты одного файла; ошибки — с текстом, понятным пользователю
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.docx' and not docx:
+        raise RuntimeError("библиотека python-docx не установлена")
+    if ext == '.pdf' and not reportlab:
+        raise RuntimeError("библиотека reportlab не установлена (pip install reportlab)")
+    fmt = ext or "none"
+    stats = render_stats.setdefault(fmt, {"count": 0, "errors": 0, "seconds": 0.0})
+    async with _render_semaphore:
+        started = time.monotonic()
         try:
-            c = canvas.Canvas(file_io, pagesize=A4)
-            width, height = A4
-            
-            # Настройка шрифта для кириллицы
-            font_name = "Helvetica"
+            if ext in ('.docx', '.pdf'):
+                file_bytes = await render_document(ext, content)
+            else:
+                file_bytes = content.encode('utf-8')
+        except Exception:
+            stats["errors"] += 1
+            raise
+        elapsed = time.monotonic() - started
+    stats["count"] += 1
+    stats["seconds"] += elapsed
+    RENDER_SECONDS.observe(elapsed, format=fmt)
+    return file_bytes
+
+def _zip_files(files: list) -> bytes:
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        for filename, file_bytes in files:
+            zf.writestr(filename, file_bytes)
+    return archive.getvalue()
+
+async def generate_and_send_files(message: Message, files: list):
+    # Все файлы ответа верстаются одновременно и уходят одним сообщением:
+    # документом, альбомом или ZIP-архивом
+    names = _unique_filenames([name for name, _ in files])
+    contents = []
+    for _, content in files:
+        if len(content) > GENERATED_FILE_MAX_CHARS:
+            content = content[:GENERATED_FILE_MAX_CHARS]
+            await message.answer(f"ℹ️ Текст файла слишком длинный, сохраняю первые {GENERATED_FILE_MAX_CHARS} символов.")
+        contents.append(content)
+
+    status = await message.answer("⏳ Создаю файл..." if len(files) == 1 else f"⏳ Создаю файлы ({len(files)})...")
+    results = await asyncio.gather(*[build_generated_file(name, content) for name, content in zip(names, contents)],
+                                   return_exceptions=True)
+    ready = []
+    for name, result in zip(names, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Ошибка создания файла {name}: {result!r}")
+            await message.answer(f"⚠️ Ошибка при создании {name}: {error_text(result)}")
+        else:
+            ready.append((name, result))
+    await delete_quietly(status)
+
+    if len(ready) == 1:
+        name, file_bytes = ready[0]
+        caption = FILE_CAPTIONS.get(os.path.splitext(name)[1].lower(), "✅ Файл готов!")
+        await message.answer_document(types.BufferedInputFile(file_bytes, filename=name), caption=caption)
+    elif 1 < len(ready) <= GENERATED_FILES_ZIP_THRESHOLD:
+        # Подпись альбома — у последнего документа
+        media = [
+            types.InputMediaDocument(media=types.BufferedInputFile(file_bytes, filename=name),
+                                     caption=f"✅ Файлы готовы: {len(ready)}" if index == len(ready) - 1 else None)
+            for index, (name, file_bytes) in enumerate(ready)
+        ]
+        await message.answer_media_group(media)
+    elif ready:
+        archive = await asyncio.to_thread(_zip_files, ready)
+        await message.answer_document(types.BufferedInputFile(archive, filename="files.zip"),
+                                      caption=f"✅ Файлы готовы: {len(ready)} (в архиве)")
+
+# --- ОЗВУЧКА ОТВЕТОВ (TTS) ---
+TTS_VOICE = "ru-RU-DmitryNeural"
+# Ограничиваем длину текста для озвучки (чтобы не ждать вечность)
+TTS_MAX_CHARS = 4000
+# Первая часть короче остальных, чтобы первое голосовое пришло как можно раньше
+TTS_FIRST_PART_CHARS = int(os.getenv("TTS_FIRST_PART_CHARS", 250))
+TTS_PART_CHARS = int(os.getenv("TTS_PART_CHARS", 800))
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", 4))
+TTS_CACHE_SIZE = int(os.getenv("TTS_CACHE_SIZE", 200))
+
+tts_cache = AsyncTTLCache(TTS_CACHE_SIZE, ttl=6 * 3600)
+_tts_semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+
+def split_for_tts(text: str) -> list:
+    # Режем по границам предложений и собираем из них части нужной длины
+    sentences = [s for s in re.split(r'(?<=[.!?…])\s+|\n+', text) if s.strip()]
+    parts = []
+    current = ""
+    for sentence in sentences:
+        limit = TTS_FIRST_PART_CHARS if not parts else TTS_PART_CHARS
+        while len(sentence) > limit:
+            # Слишком длинное предложение делим по последнему пробелу
+            cut = sentence.rfind(" ", 0, limit)
+            cut = cut if cut > 0 else limit
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+            limit = TTS_PART_CHARS
+        if current and len(current) + len(sentence) + 1 > limit:
+            parts.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        parts.append(current)
+    return parts
+
+async def synthesize_speech(text: str) -> bytes:
+    # Аудио собирается в памяти; одинаковые фрагменты берутся из кэша по хешу текста
+    async def load():
+        async with _tts_semaphore, track_external("edge-tts", "synthesize"):
+            audio = BytesIO()
+            async for chunk in edge_tts.Communicate(text, TTS_VOICE).stream():
+                if chunk["type"] == "audio":
+                    audio.write(chunk["data"])
+            return audio.getvalue() or None
+
+    key = hashlib.sha256(f"{TTS_VOICE}\n{text}".encode("utf-8")).hexdigest()
+    return await tts_cache.get_or_load(key, load)
+
+async def send_tts_reply(message: Message, response_text: str):
+    text_to_speak = GENERATE_FILE_RE.sub('', response_text)
+    text_to_speak = re.sub(r'[*_`]', '', text_to_speak)[:TTS_MAX_CHARS]
+    parts = split_for_tts(text_to_speak)
+    # Все части синтезируются параллельно, а отправляются по порядку по мере готовности
+    tasks = [asyncio.create_task(synthesize_speech(part)) for part in parts]
+    try:
+        for index, task in enumerate(tasks, start=1):
+            audio = await task
+            if audio:
+                await message.answer_voice(types.BufferedInputFile(audio, filename=f"answer_{index}.mp3"))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def delete_quietly(msg: Message = None):
+    # Служебное сообщение могли уже удалить или заменить (стриминг, ответ по частям) —
+    # повторная ошибка Telegram не должна скрывать исходную
+    if msg is None:
+        return
+    with contextlib.suppress(TelegramBadRequest):
+        await msg.delete()
+
+def error_text(error: BaseException) -> str:
+    # Текст ошибки для пользователя: у таймаута str() пустой, а исключение всегда истинно,
+    # поэтому «{e or '...'}» подсказку никогда не показывал
+    if isinstance(error, asyncio.TimeoutError):
+        return "превышено время ожидания"
+    return str(error) or type(error).__name__
+
+async def _answer_or_edit(message: Message, text: str, status_msg: Message = None):
+    # Длинный ответ уходит несколькими сообщениями. Если есть сообщение-заглушка
+    # (например, с потоковым превью), первая часть заменяет её.
+    for index, chunk in enumerate(split_message(text)):
+        body, parse_mode = prepare_markdown(chunk)
+        if index == 0 and status_msg is not None:
             try:
-                # Пробуем стандартный шрифт Windows
-                pdfmetrics.registerFont(TTFont('Arial', 'arial.ttf'))
-                font_name = 'Arial'
-            except:
-                try:
-                    # Пробуем прямой путь (Windows)
-                    pdfmetrics.registerFont(TTFont('Arial', 'C:\\Windows\\Fonts\\arial.ttf'))
-                    font_name = 'Arial'
-                except:
-                    pass # Если не вышло, останется Helvetica (без кириллицы)
-
-            c.setFont(font_name, 12)
-            y = height - 50
-            margin = 50
-            max_width = width - 2 * margin
-            
-            for line in content.split('\n'):
-                try:
-                    wrapped_lines = simpleSplit(line, font_name, 12, max_width)
-                except:
-                    wrapped_lines = [line]
-                    
-                for wrapped_line in wrapped_lines:
-                    if y < 50:
-                        c.showPage()
-                        c.setFont(font_name, 12)
-                        y = height - 50
-                    c.drawString(margin, y, wrapped_line)
-                    y -= 15
-                y -= 5 
-                
-            c.save()
-            file_io.seek(0)
-            input_file = types.BufferedInputFile(file_io.getvalue(), filename=filename)
-            await message.answer_document(input_file, caption="✅ Вот ваш PDF!")
-        except Exception as e:
-            logging.error(f"PDF generation error: {e}")
-            await message.answer(f"⚠️ Ошибка при создании PDF: {e}")
-            
-    else:
-        # Текстовый файл
-        file_io.write(content.encode('utf-8'))
-        file_io.seek(0)
-        input_file = types.BufferedInputFile(file_io.getvalue(), filename=filename)
-        await message.answer_document(input_file, caption="✅ Файл готов!")
-
-async def process_model_response(message: Message, response_text: str):
-    # Ищем тег генерации файла
-    pattern = r'<GENERATE_FILE filename="(.*?)">(.*?)</GENERATE_FILE>'
-    match = re.search(pattern, response_text, re.DOTALL)
+                await status_msg.edit_text(body, parse_mode=parse_mode)
+                continue
+            except TelegramBadRequest as e:
+                if "not modified" in str(e):
+                    continue
+                logging.warning(f"Не удалось отредактировать сообщение: {e}")
+            await delete_quietly(status_msg)
+        try:
+            await message.answer(body, parse_mode=parse_mode)
+        except TelegramBadRequest as e:
+            if not parse_mode:
+                raise
+            # Разметку, которую не распознала проверка, отправляем как обычный текст
+            logging.warning(f"Telegram не принял разметку: {e}")
+            await message.answer(chunk)
+
+async def process_model_response(message: Message, response_text: str, status_msg: Message = None):
+    # Теги генерации файлов вырезаем из текста, который показываем пользователю
+    clean_text, files = parse_generated_files(response_text)
     
-    if match:
-        filename = match.group(1)
-        content = match.group(2).strip()
-        
-        # Убираем тег из текста, который показываем пользователю
-        clean_text = re.sub(pattern, '', response_text, flags=re.DOTALL).strip()
+    if files:
         if clean_text:
-            try:
-                await message.answer(clean_text, parse_mode="Markdown")
-            except TelegramBadRequest:
-                await message.answer(clean_text)
+            await _answer_or_edit(message, clean_text, status_msg)
+        elif status_msg is not None:
+            await delete_quietly(status_msg)
         
-        await message.answer("⏳ Создаю файл...")
-        await generate_and_send_file(message, filename, content)
+        await generate_and_send_files(message, files)
     else:
         # Обычный ответ
-        try:
-            await message.answer(response_text, parse_mode="Markdown")
-        except TelegramBadRequest:
-            await message.answer(response_text)
+        await _answer_or_edit(message, response_text, status_msg)
             
     # --- ГЕНЕРАЦИЯ ГОЛОСОВОГО ОТВЕТА (TTS) ---
     user_id = message.chat.id
     data = get_user_data(user_id)
     if data.get("tts_mode", False) and edge_tts and response_text:
         try:
-            # Ограничиваем длину текста для озвучки (чтобы не ждать вечность)
-            text_to_speak = re.sub(r'[*_`]', '', response_text)[:4000] 
-            voice_filename = f"tts_{user_id}_{random.randint(1000,9999)}.mp3"
-            communicate = edge_tts.Communicate(text_to_speak, "ru-RU-DmitryNeural")
-            await communicate.save(voice_filename)
-            await message.answer_voice(types.FSInputFile(voice_filename))
-            os.remove(voice_filename)
+            await send_tts_reply(message, response_text)
         except Exception as e:
             logging.error(f"Ошибка TTS: {e}")
 
-async def _handle_image_generation(message: Message, text: str, model: str = "flux"):
-    await bot.send_chat_action(chat_id=message.chat.id, action="upload_photo")
-    try:
+# --- ПЕРЕВОД ПРОМПТОВ ДЛЯ КАРТИНОК ---
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", 5000))
+translation_cache = AsyncTTLCache(TRANSLATION_CACHE_SIZE, ttl=24 * 3600)
+
+def looks_english(text: str) -> bool:
+    # Быстрая локальная проверка: если почти все буквы латинские, перевод не нужен
+    letters = [c for c in text if c.isalpha()]
+    if not letters:
+        return True
+    latin = sum(1 for c in letters if c.isascii())
+    return latin / len(letters) >= 0.9
+
+async def translate_prompt(text: str) -> str:
+    if looks_english(text):
+        return text.strip()
+
+    async def load():
         # Переводим промпт на английский для лучшего результата
-        translation_response = await client_mistral.chat.completions.create(
-            model="mistral-small-latest",
-            messages=[
+        translation_response, _ = await router.complete(
+            "mistral-small-latest",
+            [
                 {"role": "system", "content": "You are a helpful assistant that translates text to English for an image generation model. Output only the translated text and nothing else."},
                 {"role": "user", "content": text}
             ]
         )
-        translated_prompt = translation_response.choices[0].message.content.strip()
-        
-        prompt_for_url = urllib.parse.quote(translated_prompt)
-        seed = random.randint(0, 100000)
-        url = f"https://image.pollinations.ai/prompt/{prompt_for_url}?model={model}&seed={seed}&width=1024&height=1024&nologo=true"
-        await message.answer_photo(url, caption=f"🎨 {text}")
+        return translation_response.choices[0].message.content.strip() or None
+
+    key = re.sub(r"\s+", " ", text).strip().lower()
+    return await translation_cache.get_or_load(key, load) or text
+
+# --- ГЕНЕРАЦИЯ КАРТИНОК ---
+# Картинки скачиваем сами, а не отдаём Telegram ссылку: так можно запросить несколько
+# вариантов параллельно, ограничить общее время и при медленной модели переключиться
+# на запасную. Seed зависит от запроса, поэтому повтор того же запроса берётся из кэша.
+IMAGE_GEN_URL = os.getenv("IMAGE_GEN_URL", "https://image.pollinations.ai")
+IMAGE_VARIANTS = max(1, min(int(os.getenv("IMAGE_VARIANTS", 2)), 10))
+# Общий срок на все варианты, с
+IMAGE_GEN_DEADLINE = float(os.getenv("IMAGE_GEN_DEADLINE", 60))
+# Если вариант не готов за столько секунд, параллельно запрашиваем его у запасной модели
+IMAGE_FALLBACK_AFTER = float(os.getenv("IMAGE_FALLBACK_AFTER", 20))
+IMAGE_FALLBACK_MODELS = {"flux": "turbo"}
+# Отдельно от PROVIDER_HEDGES: там только хеджирование LLM-провайдеров роутером
+IMAGE_FALLBACKS = Counter("bot_image_fallbacks_total", "Запросы картинок к запасной модели", ("model", "reason"))
+IMAGE_HTTP_CONNECTIONS = int(os.getenv("IMAGE_HTTP_CONNECTIONS", 16))
+IMAGE_BYTES_CACHE_SIZE = int(os.getenv("IMAGE_BYTES_CACHE_SIZE", 64))
+# Картинка может весить до 10 МБ, поэтому кроме числа записей ограничиваем и объём
+IMAGE_BYTES_CACHE_MB = float(os.getenv("IMAGE_BYTES_CACHE_MB", 64))
+IMAGE_MAX_BYTES = 10 * 1024 * 1024  # лимит Telegram на фото
+
+image_bytes_cache = AsyncTTLCache(IMAGE_BYTES_CACHE_SIZE, ttl=24 * 3600, max_bytes=int(IMAGE_BYTES_CACHE_MB * 1024 * 1024))
+_image_http = None
+
+def get_image_http():
+    # Общий пул соединений: TLS-рукопожатие с сервером картинок не повторяется на каждый запрос
+    global _image_http
+    if _image_http is None or _image_http.closed:
+        _image_http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=IMAGE_HTTP_CONNECTIONS, ttl_dns_cache=300))
+    return _image_http
+
+async def close_image_http():
+    if _image_http is not None and not _image_http.closed:
+        await _image_http.close()
+
+def image_seeds(prompt: str) -> list:
+    base = int.from_bytes(hashlib.blake2b(prompt.encode("utf-8"), digest_size=4).digest(), "big") % 100000
+    return [base + i for i in range(IMAGE_VARIANTS)]
+
+async def fetch_image(prompt: str, model: str, seed: int, deadline: float) -> bytes:
+    async def load():
+        url = (f"{IMAGE_GEN_URL}/prompt/{urllib.parse.quote(prompt)}"
+               f"?model={model}&seed={seed}&width=1024&height=1024&nologo=true")
+        timeout = aiohttp.ClientTimeout(total=max(deadline - time.monotonic(), 0.1))
+        async with track_external("pollinations", model):
+            async with get_image_http().get(url, timeout=timeout) as response:
+                response.raise_for_status()
+                if not response.content_type.startswith("image/"):
+                    raise ValueError(f"вместо картинки пришёл {response.content_type}")
+                data = await response.content.read(IMAGE_MAX_BYTES + 1)
+                if len(data) > IMAGE_MAX_BYTES:
+                    raise ValueError("картинка больше 10 МБ")
+                return data
+
+    return await image_bytes_cache.get_or_load((prompt, model, seed), load)
+
+def _consume_result(task: asyncio.Task):
+    # Проигравший запрос не отменяем: он ограничен тем же сроком и заполнит кэш
+    if not task.cancelled():
+        task.exception()
+
+async def fetch_image_variant(prompt: str, model: str, seed: int, deadline: float):
+    # Возвращает (байты, модель). Запасная модель подключается, если основная
+    # не уложилась в IMAGE_FALLBACK_AFTER или завершилась ошибкой; берём первый успех.
+    fallback = IMAGE_FALLBACK_MODELS.get(model)
+    tasks = {asyncio.create_task(fetch_image(prompt, model, seed, deadline)): model}
+    error = None
+    try:
+        while tasks:
+            timeout = deadline - time.monotonic()
+            if fallback:
+                timeout = min(timeout, IMAGE_FALLBACK_AFTER)
+            done, _ = await asyncio.wait(tasks, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task_model = tasks.pop(task)
+                if not task.cancelled() and task.exception() is None:
+                    return task.result(), task_model
+                error = asyncio.TimeoutError("запрос отменён") if task.cancelled() else task.exception()
+                logging.warning(f"Картинка {task_model} (seed {seed}) не получена: {error!r}")
+            if time.monotonic() >= deadline:
+                raise asyncio.TimeoutError("превышено время ожидания")
+            if fallback:
+                IMAGE_FALLBACKS.inc(model=fallback, reason="error" if done else "slow")
+                tasks[asyncio.create_task(fetch_image(prompt, fallback, seed, deadline))] = fallback
+                fallback = None
+        raise error
+    finally:
+        for task in tasks:
+            task.add_done_callback(_consume_result)
+
+async def _handle_image_generation(message: Message, text: str, model: str = "flux"):
+    await bot.send_chat_action(chat_id=message.chat.id, action="upload_photo")
+    try:
+        translated_prompt = await translate_prompt(text)
+        deadline = time.monotonic() + IMAGE_GEN_DEADLINE
+        results = await asyncio.gather(
+            *[fetch_image_variant(translated_prompt, model, seed, deadline) for seed in image_seeds(translated_prompt)],
+            return_exceptions=True
+        )
+        images = [result for result in results if not isinstance(result, BaseException)]
+        if not images:
+            raise results[0]
+        caption = f"🎨 {text}"
+        if any(used_model != model for _, used_model in images):
+            caption += f"\n(модель {model} не успела, часть вариантов от {IMAGE_FALLBACK_MODELS.get(model)})"
+        caption = caption[:1024]
+        if len(images) == 1:
+            await message.answer_photo(types.BufferedInputFile(images[0][0], filename="image.jpg"), caption=caption)
+        else:
+            # Подпись альбома — у первой фотографии
+            await message.answer_media_group([
+                types.InputMediaPhoto(media=types.BufferedInputFile(data, filename=f"image_{index}.jpg"),
+                                      caption=caption if index == 0 else None)
+                for index, (data, _) in enumerate(images)
+            ])
     except Exception as e:
-        logging.error(f"Ошибка при генерации изображения: {e}")
-        await message.answer(f"⚠️ Не удалось создать изображение. Ошибка: {e}")
+        logging.error(f"Ошибка при генерации изображения: {e!r}")
+        await message.answer(f"⚠️ Не удалось создать изображение. Ошибка: {error_text(e)}")
+
+# --- КЭШ ОТВЕТОВ НА ТИПОВЫЕ ЗАПРОСЫ ---
+# Новые пользователи часто спрашивают одно и то же («привет», «что ты умеешь»).
+# Если контекст пустой или очень короткий, одинаковый запрос к той же модели
+# с тем же системным промптом можно не отправлять повторно. Включается явно.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 2000))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 6 * 3600))
+# Сколько сообщений диалога (без системных) допускается, чтобы запрос ещё считался типовым
+RESPONSE_CACHE_MAX_TURNS = int(os.getenv("RESPONSE_CACHE_MAX_TURNS", 1))
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", 4000))
+
+response_cache = AsyncTTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+response_cache_by_model = {}  # model -> {"hits": ..., "misses": ...}
+RESPONSE_CACHE_LOOKUPS = Counter("bot_response_cache_lookups_total", "Обращения к кэшу ответов", ("model", "result"))
+
+def response_cache_key(model: str, messages: list):
+    # None — запрос в кэш не попадает: кэш выключен, диалог длинный или есть картинки
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    dialog = [m for m in messages if m["role"] != "system"]
+    if len(dialog) > RESPONSE_CACHE_MAX_TURNS:
+        return None
+    if not all(isinstance(m["content"], str) for m in messages):
+        return None
+    if sum(len(m["content"]) for m in dialog) > RESPONSE_CACHE_MAX_CHARS:
+        return None
+    trimmed = [[m["role"], m["content"].strip()] for m in messages]
+    return hashlib.sha256(json.dumps([model, trimmed], ensure_ascii=False).encode()).hexdigest()
+
+def response_cache_lookup(model: str, messages: list):
+    # Возвращает (ключ, ответ из кэша или None); ключ потом передаётся в response_cache_store
+    key = response_cache_key(model, messages)
+    if key is None:
+        return None, None
+    answer = response_cache.get(key)
+    result = "hits" if answer is not None else "misses"
+    counters = response_cache_by_model.setdefault(model, {"hits": 0, "misses": 0})
+    counters[result] += 1
+    RESPONSE_CACHE_LOOKUPS.inc(model=model, result="hit" if answer is not None else "miss")
+    return key, answer
+
+def response_cache_store(key, answer: str, model: str, used_model: str):
+    # Ответ запасной модели (после переключения) под ключом запрошенной не сохраняем:
+    # иначе пользователь получал бы его из кэша и после восстановления основной модели
+    if key and answer and used_model == model:
+        response_cache.set(key, answer)
+
+# --- ПОТОКОВЫЕ ОТВЕТЫ (STREAMING) ---
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+# Не чаще одного редактирования сообщения за столько секунд (лимиты Telegram на edit)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+
+def _stream_preview(text: str) -> str:
+    # Содержимое будущего файла в превью не показываем
+    tag_pos = text.find("<GENERATE_FILE")
+    if tag_pos != -1:
+        text = text[:tag_pos].rstrip() + "\n\n📄 Готовлю файл..."
+    if len(text) > TELEGRAM_TEXT_LIMIT - 10:
+        text = text[:TELEGRAM_TEXT_LIMIT - 10] + "…"
+    return text
+
+async def _stream_deltas(first: str, iterator):
+    if first:
+        yield first
+    async for chunk in iterator:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def stream_chat_completion(model: str, messages: list, processing_msg: Message):
+    # Читаем ответ по частям и периодически обновляем сообщение «⏳ Размышляю...».
+    # Возвращает (текст ответа, модель, которая на самом деле ответила)
+    started = time.monotonic()
+    first_token_at = None
+    next_edit_at = started + STREAM_EDIT_INTERVAL
+    last_preview = ""
+    parts = []
+
+    first, iterator, used_model = await router.stream(model, messages)
+    async for delta in _stream_deltas(first, iterator):
+        if first_token_at is None:
+            first_token_at = time.monotonic()
+        parts.append(delta)
+
+        now = time.monotonic()
+        if now < next_edit_at:
+            continue
+        next_edit_at = now + STREAM_EDIT_INTERVAL
+        preview = _stream_preview("".join(parts))
+        if preview == last_preview:
+            continue
+        self_paced = send_self_paced.set(True)
+        try:
+            await processing_msg.edit_text(preview + " ▌")
+            last_preview = preview
+        except TelegramRetryAfter as e:
+            # Telegram попросил подождать — просто откладываем следующее обновление
+            next_edit_at = time.monotonic() + e.retry_after
+        except TelegramBadRequest:
+            pass
+        finally:
+            send_self_paced.reset(self_paced)
+
+    total = time.monotonic() - started
+    ttft = (first_token_at - started) if first_token_at else total
+    logging.info(f"Стриминг {used_model}: первый токен через {ttft:.2f} с, всего {total:.2f} с, символов: {sum(map(len, parts))}")
+    return "".join(parts), used_model
 
 async def _handle_openrouter_chat(message: Message, text: str, data: dict):
     if not client_openrouter:
@@ -743,27 +3656,41 @@ async def _handle_openrouter_chat(message: Message, text: str, data: dict):
     history.append({"role": "user", "content": text})
     
     try:
-        system_prompt_content = data.get("system_prompt", DEFAULT_SYSTEM_PROMPT)
-        system_message = {"role": "system", "content": system_prompt_content + HIDDEN_SYSTEM_PROMPT}
-        chat_response = await client_openrouter.chat.completions.create(
-            model=data["model"], # e.g., "deepseek-chat"
-            messages=[system_message] + history[-MAX_HISTORY_LENGTH:]
-        )
-        await processing_msg.delete()
-        bot_answer = chat_response.choices[0].message.content if chat_response.choices else "Извините, я не смог сгенерировать ответ."
+        messages = build_context(message.from_user.id, data)
+        cache_key, bot_answer = response_cache_lookup(data["model"], messages)
+        if bot_answer is not None:
+            status_msg = processing_msg
+        elif STREAM_RESPONSES:
+            bot_answer, used_model = await stream_chat_completion(data["model"], messages, processing_msg)
+            response_cache_store(cache_key, bot_answer, data["model"], used_model)
+            bot_answer = bot_answer or "Извините, я не смог сгенерировать ответ."
+            status_msg = processing_msg
+        else:
+            started = time.monotonic()
+            chat_response, used_model = await router.complete(data["model"], messages) # e.g., "deepseek-chat"
+            logging.info(f"Ответ {data['model']} получен за {time.monotonic() - started:.2f} с")
+            await delete_quietly(processing_msg)
+            processing_msg = None
+            bot_answer = chat_response.choices[0].message.content if chat_response.choices else None
+            response_cache_store(cache_key, bot_answer, data["model"], used_model)
+            bot_answer = bot_answer or "Извините, я не смог сгенерировать ответ."
+            status_msg = None
         history.append({"role": "assistant", "content": bot_answer})
         save_user_data(message.from_user.id)
-        await process_model_response(message, bot_answer)
+        # Дальше заглушкой распоряжается process_model_response (она станет ответом) —
+        # при ошибке удалять её уже нельзя
+        processing_msg = None
+        await process_model_response(message, bot_answer, status_msg=status_msg)
     except AuthenticationError:
-        await processing_msg.delete()
+        await delete_quietly(processing_msg)
         logging.error("Ошибка аутентификации OpenRouter: неверный API ключ.")
         await message.answer("⚠️ **Ошибка**: API-ключ для OpenRouter недействителен. Пожалуйста, проверьте ваш ключ.")
     except RateLimitError:
-        await processing_msg.delete()
+        await delete_quietly(processing_msg)
         logging.warning("Достигнут лимит запросов для модели.")
         await message.answer("⏳ Модель сейчас перегружена. Пожалуйста, попробуйте снова через несколько минут или выберите другую модель через /mode.")
     except Exception as e:
-        await processing_msg.delete()
+        await delete_quietly(processing_msg)
         logging.error(f"Ошибка при общении с OpenRouter: {e}")
         await message.answer(f"⚠️ К сожалению, я не смог обработать ваш запрос через OpenRouter. **Ошибка:** {e}")
 
@@ -774,25 +3701,119 @@ async def _handle_mistral_chat(message: Message, text: str, data: dict):
     history.append({"role": "user", "content": text})
     
     try:
-        system_prompt_content = data.get("system_prompt", DEFAULT_SYSTEM_PROMPT)
-        system_message = {
-            "role": "system",
-            "content": system_prompt_content + HIDDEN_SYSTEM_PROMPT
-        }
-        chat_response = await client_mistral.chat.completions.create(
-            model=data["model"],
-            messages=[system_message] + history[-MAX_HISTORY_LENGTH:]
-        )
-        await processing_msg.delete()
-        bot_answer = chat_response.choices[0].message.content
+        messages = build_context(message.from_user.id, data)
+        cache_key, bot_answer = response_cache_lookup(data["model"], messages)
+        if bot_answer is not None:
+            status_msg = processing_msg
+        elif STREAM_RESPONSES:
+            bot_answer, used_model = await stream_chat_completion(data["model"], messages, processing_msg)
+            response_cache_store(cache_key, bot_answer, data["model"], used_model)
+            bot_answer = bot_answer or "Извините, я не смог сгенерировать ответ."
+            status_msg = processing_msg
+        else:
+            started = time.monotonic()
+            chat_response, used_model = await router.complete(data["model"], messages)
+            logging.info(f"Ответ {data['model']} получен за {time.monotonic() - started:.2f} с")
+            await delete_quietly(processing_msg)
+            processing_msg = None
+            bot_answer = chat_response.choices[0].message.content
+            response_cache_store(cache_key, bot_answer, data["model"], used_model)
+            status_msg = None
         history.append({"role": "assistant", "content": bot_answer})
         save_user_data(message.from_user.id)
         
-        await process_model_response(message, bot_answer)
+        processing_msg = None
+        await process_model_response(message, bot_answer, status_msg=status_msg)
     except Exception as e:
-        await processing_msg.delete()
+        await delete_quietly(processing_msg)
         await message.answer(f"Ошибка Mistral: {e}", parse_mode=None)
 
+# --- ОЧЕРЕДЬ СООБЩЕНИЙ ПОЛЬЗОВАТЕЛЯ ---
+# Всё, что меняет историю (текст, голос, фото, /search), обрабатывается строго по очереди.
+# Если очередь пуста, сообщение уходит в работу сразу; текстовые сообщения, пришедшие,
+# пока предыдущее ещё обрабатывается, склеиваются в один следующий запрос.
+MESSAGE_DEBOUNCE_SECONDS = float(os.getenv("MESSAGE_DEBOUNCE_SECONDS", 1.0))
+MESSAGE_DEBOUNCE_MAX_SECONDS = float(os.getenv("MESSAGE_DEBOUNCE_MAX_SECONDS", 4.0))
+# Длинный текст клиент Telegram сам режет на части по 4096 символов — такую часть
+# не отправляем сразу, а ждём продолжения до MESSAGE_DEBOUNCE_SECONDS
+MESSAGE_SPLIT_MIN_CHARS = int(os.getenv("MESSAGE_SPLIT_MIN_CHARS", 4000))
+# Сколько пользователей обслуживается одновременно. У каждого пользователя не больше
+# одного ожидающего запроса, а семафор пропускает ждущих по порядку — получается
+# честная очередь по кругу, и один активный чат не занимает все слоты.
+MAX_CONCURRENT_USERS = int(os.getenv("MAX_CONCURRENT_USERS", 32))
+
+class UserInbox:
+    def __init__(self):
+        self.items = deque()  # (message, text, можно ли склеивать, задача с аргументами)
+        self.arrived = asyncio.Event()
+        self.task = None
+
+_inboxes = {}
+_processing_slots = asyncio.Semaphore(MAX_CONCURRENT_USERS)
+
+def _enqueue(user_id, item):
+    inbox = _inboxes.get(user_id)
+    if inbox is None:
+        inbox = _inboxes[user_id] = UserInbox()
+    inbox.items.append(item)
+    inbox.arrived.set()
+    if inbox.task is None:
+        inbox.task = asyncio.create_task(_inbox_worker(user_id, inbox))
+
+def enqueue_user_message(user_id, message: Message, text: str, coalesce: bool):
+    _enqueue(user_id, (message, text, coalesce, None))
+
+def enqueue_user_job(user_id, message: Message, job, *args):
+    # job(message, *args) выполняется в очереди пользователя и никогда не склеивается
+    _enqueue(user_id, (message, None, False, (job, args)))
+
+async def _wait_for_burst(inbox: UserInbox):
+    # Ждём, пока придёт продолжение: каждое новое сообщение продлевает окно,
+    # но не дольше MESSAGE_DEBOUNCE_MAX_SECONDS в сумме
+    deadline = time.monotonic() + MESSAGE_DEBOUNCE_MAX_SECONDS
+    while True:
+        inbox.arrived.clear()
+        timeout = min(MESSAGE_DEBOUNCE_SECONDS, deadline - time.monotonic())
+        if timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(inbox.arrived.wait(), timeout)
+        except asyncio.TimeoutError:
+            return
+
+async def _inbox_worker(user_id, inbox: UserInbox):
+    # Очередь обрабатывается уже после выхода из хендлера — закрепляем данные на всё время работы
+    try:
+        with user_context.pinned(user_id):
+            while inbox.items:
+                message, text, coalesce, job = inbox.items.popleft()
+                if coalesce:
+                    texts = [text]
+                    while True:
+                        # Последняя часть разрезанного клиентом текста — подождём следующую
+                        if not inbox.items and len(texts[-1]) >= MESSAGE_SPLIT_MIN_CHARS and MESSAGE_DEBOUNCE_SECONDS > 0:
+                            await _wait_for_burst(inbox)
+                        if not (inbox.items and inbox.items[0][2]):
+                            break
+                        message, next_text, _, _ = inbox.items.popleft()
+                        texts.append(next_text)
+                    if len(texts) > 1:
+                        logging.info(f"Пользователь {user_id}: {len(texts)} сообщений объединены в один запрос")
+                    text = "\n".join(texts)
+                async with _processing_slots:
+                    try:
+                        if job:
+                            func, args = job
+                            async with track_handler(func.__name__):
+                                await func(message, *args)
+                        else:
+                            async with track_handler("process_text_message"):
+                                await process_text_message(message, text)
+                    except Exception as e:
+                        logging.error(f"Ошибка обработки сообщения пользователя {user_id}: {e}")
+    finally:
+        _inboxes.pop(user_id, None)
+
 @dp.message(F.text)
 async def handle_text_message(message: Message, text_from_voice: str = None):
     text = text_from_voice or message.text
@@ -803,9 +3824,16 @@ async def handle_text_message(message: Message, text_from_voice: str = None):
     if text.strip().startswith('/'):
         return
 
+    if text_from_voice is None:
+        usage_stats.record("text")
+    # Голосовые и файлы не склеиваем с соседними сообщениями, но ставим в ту же очередь
+    enqueue_user_message(message.from_user.id, message, text, coalesce=text_from_voice is None)
+
+async def process_text_message(message: Message, text: str):
     user_id = message.from_user.id
     data = get_user_data(user_id)
     current_model = data["model"]
+    usage_stats.record("request", current_model)
     
     if current_model.startswith("image-gen:") or current_model == "image-generation-mode":
         model_type = "flux"
@@ -817,12 +3845,474 @@ async def handle_text_message(message: Message, text_from_voice: str = None):
     else: # По умолчанию используем Mistral
         await _handle_mistral_chat(message, text, data)
 
+CACHE_ENTRIES = Gauge("bot_cache_entries", "Размер кэшей в памяти", ("cache",))
+
+def collect_queue_depths():
+    QUEUE_DEPTH.set(len(_inboxes), queue="user_inboxes")
+    QUEUE_DEPTH.set(sum(len(inbox.items) for inbox in _inboxes.values()), queue="inbox_messages")
+    QUEUE_DEPTH.set(transcription_queue.depth, queue="transcription")
+    QUEUE_DEPTH.set(len(_dirty_users) + len(_evicted_dirty), queue="dirty_users")
+    for name, cache in (("users", user_context), ("search", search_cache), ("translation", translation_cache), ("tts", tts_cache),
+                        ("images", image_bytes_cache)):
+        CACHE_ENTRIES.set(cache.stats()["size"], cache=name)
+
+metrics_collectors.append(collect_queue_depths)
+
+# --- РЕЖИМ ЗАПУСКА: POLLING ИЛИ WEBHOOK ---
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Отбрасывать ли накопившиеся обновления при старте (раньше отбрасывались всегда)
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "false").lower() in ("1", "true", "yes")
+# Публичный https-адрес для Telegram. Если не задан, сервер просто слушает порт —
+# так удобно проверять локально, отправляя сохранённые обновления:
+#   curl -X POST -H 'Content-Type: application/json' -d @update.json http://127.0.0.1:8080/webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Очередь принятых, но ещё не обработанных обновлений и число её обработчиков
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 16))
+# Сколько секунд при остановке дообрабатывать уже принятые обновления
+WEBHOOK_DRAIN_SECONDS = float(os.getenv("WEBHOOK_DRAIN_SECONDS", 20))
+
+class UpdateQueue:
+    # Ограниченная очередь обновлений и обработчики, передающие их в диспетчер.
+    # offer() не ждёт: если очередь заполнена, вызывающий сам решает, что делать
+    # (webhook отвечает 503, поток шарда ждёт освобождения места).
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, maxsize=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS, done=None):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        # Общий с главным процессом счётчик обработанных обновлений (только для шардов)
+        self.done = done
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.worker_count = workers
+        self.workers = []
+
+    def offer(self, payload) -> bool:
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, payload):
+        await self.queue.put(payload)
+
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+    async def _worker(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                update = types.Update.model_validate(payload, context={"bot": self.bot})
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка обработки обновления: {e}")
+            finally:
+                self.queue.task_done()
+                if self.done is not None:
+                    self.done.value += 1
+
+    def start(self):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+        metrics_collectors.append(lambda: QUEUE_DEPTH.set(self.qsize(), queue="updates"))
+
+    async def stop(self):
+        # Дообрабатываем то, что уже в очереди, но не дольше WEBHOOK_DRAIN_SECONDS
+        try:
+            await asyncio.wait_for(self.queue.join(), WEBHOOK_DRAIN_SECONDS)
+        except asyncio.TimeoutError:
+            logging.warning(f"При остановке не обработано обновлений: {self.queue.qsize()}")
+        for worker in self.workers:
+            worker.cancel()
+
+class WebhookServer:
+    # HTTP-сервер на aiohttp: кладёт обновления в очередь (sink) и сразу отвечает
+    # Telegram. Если очередь заполнена, отвечает 503 — Telegram доставит
+    # обновление повторно позже (обратное давление вместо потери данных).
+    # sink — локальная UpdateQueue или ShardRouter в многопроцессном режиме.
+    def __init__(self, sink):
+        self.sink = sink
+        self.rejected = 0
+        self.runner = None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="invalid json")
+        if not self.sink.offer(payload):
+            self.rejected += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return web.Response(status=200)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"queue": self.sink.qsize(), "rejected": self.rejected})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logging.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    async def stop(self):
+        # Перестаём принимать; дообработка очереди — забота её владельца
+        if self.runner:
+            await self.runner.cleanup()
+
+async def register_webhook():
+    if WEBHOOK_URL:
+        # Обновления, пришедшие во время перезапуска, Telegram доставит после старта
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+    else:
+        logging.warning("WEBHOOK_URL не задан: webhook в Telegram не регистрируется, сервер принимает обновления только локально")
+
+async def run_webhook():
+    updates = UpdateQueue(dp, bot)
+    updates.start()
+    server = WebhookServer(updates)
+    await server.start()
+    await register_webhook()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        await updates.stop()
+
+# --- НЕСКОЛЬКО ПРОЦЕССОВ (ШАРДЫ ПО USER_ID) ---
+# SHARD_WORKERS > 0 включает многопроцессный режим: главный процесс только получает
+# обновления (polling или webhook) и раскладывает их по процессам-шардам, каждый
+# пользователь всегда попадает в один и тот же шард. Поэтому кэш пользователя,
+# его очередь сообщений и отложенная запись живут ровно в одном процессе и не
+# конфликтуют между собой. Хранилище (SQLite/JSON) общее.
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 1000))
+SHARD_STATS_DIR = os.path.join(USER_DATA_DIR, "shards")
+SHARD_STATS_INTERVAL = float(os.getenv("SHARD_STATS_INTERVAL", 15))
+# Статистика шарда, который давно не обновлял свой файл, в /admin не учитывается
+SHARD_STATS_MAX_AGE = 4 * SHARD_STATS_INTERVAL
+# Номер текущего шарда (None — обычный однопроцессный режим) и очереди всех шардов
+SHARD_INDEX = None
+_shard_queues = []
+# Шард ведёт в общей памяти два счётчика: сколько обновлений забрал из очереди и сколько
+# обработал. Если он упал, разница — обновления, которые пропали вместе с процессом.
+SHARD_LOST_UPDATES = Counter("bot_shard_lost_updates_total", "Обновления, потерянные при падении шарда", ("shard",))
+
+class HashRing:
+    # Консистентное хеширование с виртуальными узлами: при изменении числа шардов
+    # переезжает только часть пользователей, а не почти все, как при user_id % N
+    def __init__(self, nodes: int, replicas: int = 64):
+        self.points = sorted(
+            (self._hash(f"{node}:{replica}"), node)
+            for node in range(nodes) for replica in range(replicas)
+        )
+        self.keys = [point for point, _ in self.points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def node_for(self, key) -> int:
+        index = bisect(self.keys, self._hash(str(key))) % len(self.points)
+        return self.points[index][1]
+
+_shard_ring = HashRing(SHARD_WORKERS) if SHARD_WORKERS > 0 else None
+
+def owner_shard(user_id) -> int:
+    return _shard_ring.node_for(user_id) if _shard_ring else 0
+
+def is_admin_shard() -> bool:
+    return SHARD_INDEX is None or owner_shard(ADMIN_ID) == SHARD_INDEX
+
+def update_user_id(payload: dict):
+    # Кому принадлежит обновление: автор сообщения/нажатия/запроса, иначе чат
+    for key, event in payload.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user and "id" in user:
+            return user["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    return None
+
+async def forward_to_shard(user_id, payload: dict):
+    # Служебное сообщение шарду, которому принадлежит user_id (например, начисление реферала)
+    await asyncio.to_thread(_shard_queues[owner_shard(user_id)].put, payload)
+
+async def handle_internal(payload: dict):
+    if payload["_internal"] == "referral":
+        await credit_referral(payload["referrer_id"], payload["name"])
+    else:
+        logging.warning(f"Неизвестное служебное сообщение шарду: {payload['_internal']}")
+
+def _shard_stats_path(index: int) -> str:
+    return os.path.join(SHARD_STATS_DIR, f"shard_{index}.json")
+
+def write_shard_stats():
+    stats = collect_local_stats()
+    stats["written_at"] = time.time()
+    path = _shard_stats_path(SHARD_INDEX)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(stats, f)
+    os.replace(tmp_path, path)
+
+async def shard_stats_loop():
+    while True:
+        await asyncio.sleep(SHARD_STATS_INTERVAL)
+        try:
+            write_shard_stats()
+        except OSError as e:
+            logging.error(f"Не удалось записать статистику шарда {SHARD_INDEX}: {e}")
+
+def gather_stats():
+    # Статистика для /admin: в многопроцессном режиме складываем файлы всех шардов
+    if SHARD_INDEX is None:
+        return _finalize_stats(collect_local_stats()), 1
+    total, shard_count = {}, 0
+    for index in range(SHARD_WORKERS):
+        if index == SHARD_INDEX:
+            part = collect_local_stats()
+        else:
+            try:
+                with open(_shard_stats_path(index), "r", encoding="utf-8") as f:
+                    part = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if time.time() - part.pop("written_at", 0) > SHARD_STATS_MAX_AGE:
+                continue
+        _merge_stats(total, part)
+        shard_count += 1
+    return _finalize_stats(total), shard_count
+
+def _shard_get(shard_queue):
+    # Блокирующее чтение с таймаутом, чтобы поток не висел вечно при остановке
+    try:
+        return shard_queue.get(timeout=1)
+    except QueueEmpty:
+        return QueueEmpty
+
+async def shard_main(index: int, taken, done):
+    flush_task = asyncio.create_task(user_data_flush_loop())
+    stats_task = asyncio.create_task(shard_stats_loop())
+    warm_task = asyncio.create_task(warm_process_pool())
+    updates = UpdateQueue(dp, bot, done=done)
+    updates.start()
+    internal_tasks = set()
+
+    def internal_done(task):
+        internal_tasks.discard(task)
+        done.value += 1
+    metrics_runner = await start_metrics_server(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    # Итоги по всем пользователям при первом запуске берёт на себя шард 0
+    usage_stats.load(os.path.join(SHARD_STATS_DIR, f"usage_{index}.json"),
+                     bootstrap=get_storage().usage_totals if index == 0 else None)
+    logging.info(f"Шард {index} запущен (pid {os.getpid()})")
+    try:
+        await warm_bot_me()
+        if is_admin_shard():
+            await resume_broadcast()
+        while True:
+            payload = await asyncio.to_thread(_shard_get, _shard_queues[index])
+            if payload is QueueEmpty:
+                continue
+            if payload is None:
+                break
+            taken.value += 1
+            if "_internal" in payload:
+                # Держим ссылку на задачу, иначе сборщик мусора может прервать её на полпути
+                task = asyncio.create_task(handle_internal(payload))
+                internal_tasks.add(task)
+                task.add_done_callback(internal_done)
+            else:
+                # Ждём места в локальной очереди — обратное давление до главного процесса
+                await updates.put(payload)
+    finally:
+        await updates.stop()
+        if internal_tasks:
+            await asyncio.wait(internal_tasks, timeout=WEBHOOK_DRAIN_SECONDS)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        flush_task.cancel()
+        stats_task.cancel()
+        warm_task.cancel()
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+        await close_image_http()
+        await flush_user_data()
+        await usage_stats.save(force=True)
+        write_shard_stats()
+        close_storage()
+        await bot.session.close()
+
+def run_shard(index: int, queues, taken, done, send_budget):
+    global SHARD_INDEX, _shard_queues
+    # Ctrl+C обрабатывает главный процесс: он пришлёт шарду None и дождётся дообработки
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    SHARD_INDEX = index
+    _shard_queues = queues
+    send_scheduler.global_bucket = SharedTokenBucket(SEND_GLOBAL_RATE, send_budget)
+    asyncio.run(shard_main(index, taken, done))
+
+class ShardRouter:
+    # Раскладывает обновления по очередям шардов; для WebhookServer выглядит как UpdateQueue
+    def __init__(self, queues):
+        self.queues = queues
+
+    def _queue_for(self, payload):
+        user_id = update_user_id(payload)
+        return self.queues[owner_shard(user_id) if user_id is not None else 0]
+
+    def offer(self, payload) -> bool:
+        try:
+            self._queue_for(payload).put_nowait(payload)
+        except QueueFull:
+            return False
+        return True
+
+    async def put(self, payload):
+        await asyncio.to_thread(self._queue_for(payload).put, payload)
+
+    def qsize(self) -> int:
+        try:
+            return sum(q.qsize() for q in self.queues)
+        except NotImplementedError:  # macOS
+            return -1
+
+async def poll_into_shards(router_sink: ShardRouter):
+    # Свой long polling вместо dp.start_polling: обновления не обрабатываются здесь,
+    # а пересылаются шардам. offset сдвигается только после того, как обновление
+    # принято в очередь шарда, так что при заполненных очередях Telegram их придержит.
+    await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            batch = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates, request_timeout=60)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Exception as e:
+            logging.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in batch:
+            await router_sink.put(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+async def run_sharded():
+    os.makedirs(SHARD_STATS_DIR, exist_ok=True)
+    # Хранилище (и перенос старых JSON в SQLite) открываем до запуска шардов: иначе шард,
+    # открывший базу во время миграции, принял бы ещё не перенесённых пользователей за новых
+    await asyncio.to_thread(get_storage)
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(SHARD_WORKERS)]
+    # Счётчики пишет только сам шард из своего цикла событий, поэтому блокировка не нужна
+    taken = [ctx.Value("q", 0, lock=False) for _ in range(SHARD_WORKERS)]
+    done = [ctx.Value("q", 0, lock=False) for _ in range(SHARD_WORKERS)]
+    # Общий на все шарды лимит отправки: [токены, время пополнения, пауза до]
+    send_budget = ctx.Array("d", [send_scheduler.global_bucket.capacity, time.monotonic(), 0.0])
+    processes = []
+
+    def spawn(index):
+        taken[index].value = done[index].value = 0
+        process = ctx.Process(target=run_shard, args=(index, queues, taken[index], done[index], send_budget),
+                              name=f"shard-{index}", daemon=False)
+        process.start()
+        return process
+
+    async def watchdog():
+        while True:
+            await asyncio.sleep(5)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    # Обновления, ещё лежащие в очереди шарда, дождутся нового процесса;
+                    # пропадают только те, что шард уже забрал, но не успел обработать
+                    lost = max(0, taken[index].value - done[index].value)
+                    if lost:
+                        SHARD_LOST_UPDATES.inc(lost, shard=str(index))
+                    logging.error(f"Шард {index} завершился (код {process.exitcode}), потеряно обновлений: {lost}, перезапускаем")
+                    processes[index] = spawn(index)
+
+    processes.extend(spawn(index) for index in range(SHARD_WORKERS))
+    watchdog_task = asyncio.create_task(watchdog())
+    sink = ShardRouter(queues)
+    metrics_collectors.append(lambda: QUEUE_DEPTH.set(sink.qsize(), queue="shards"))
+    metrics_runner = await start_metrics_server(METRICS_PORT)
+    logging.info(f"Запущено шардов: {SHARD_WORKERS}, режим {BOT_MODE}")
+    try:
+        await set_main_menu(bot)
+        if BOT_MODE == "webhook":
+            server = WebhookServer(sink)
+            await server.start()
+            await register_webhook()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await server.stop()
+        else:
+            await poll_into_shards(sink)
+    finally:
+        watchdog_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        for shard_queue in queues:
+            shard_queue.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, WEBHOOK_DRAIN_SECONDS + 10)
+            if process.is_alive():
+                logging.warning(f"Шард {process.name} не остановился вовремя, завершаем принудительно")
+                process.terminate()
+        close_storage()
+
 async def main():
-    await set_main_menu(bot)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if SHARD_WORKERS > 0:
+        await run_sharded()
+        return
+    flush_task = asyncio.create_task(user_data_flush_loop())
+    warm_task = asyncio.create_task(warm_process_pool())
+    metrics_runner = await start_metrics_server(METRICS_PORT)
+    usage_stats.load(USAGE_STATS_PATH, bootstrap=get_storage().usage_totals)
+    try:
+        await asyncio.gather(set_main_menu(bot), warm_bot_me())
+        await resume_broadcast()
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            await dp.start_polling(bot)
+    finally:
+        flush_task.cancel()
+        warm_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+        await close_image_http()
+        # Дописываем на диск всё, что не успел сбросить фоновый цикл
+        await flush_user_data()
+        await usage_stats.save(force=True)
+        close_storage()
 
 if __name__ == "__main__":
+    if "--migrate-json" in sys.argv:
+        migrate_json_to_sqlite(USER_DATA_DIR, SQLITE_PATH)
+        sys.exit(0)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,16 @@
+# main.py настраивается переменными окружения и при импорте создаёт user_data
+# в текущем каталоге — поэтому тесты работают во временном каталоге с фиктивными ключами.
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("BOT_TOKEN", "123456789:TEST-token-for-unit-tests")
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ["METRICS_PORT"] = "0"
+os.environ["SHARD_WORKERS"] = "0"
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
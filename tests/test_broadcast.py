@@ -0,0 +1,84 @@
+# Фоновая рассылка: заблокировавшие бота пропускаются и не входят в итог,
+# прогресс сохраняется, и прерванная рассылка продолжается с места остановки.
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramForbiddenError
+
+import main
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    storage = main.SQLiteUserStorage(str(tmp_path / "users.db"))
+    storage.write_batch([{"user_id": uid, "settings": json.dumps({"model": "m"}), "history_reset": True, "history_rows": []}
+                         for uid in range(1, 7)])
+    storage.set_blocked(3)
+    monkeypatch.setattr(main, "_storage", storage)
+    monkeypatch.setattr(main, "BROADCAST_STATE_PATH", str(tmp_path / "broadcast_state.json"))
+    monkeypatch.setattr(main, "BROADCAST_RATE", 1000)
+    monkeypatch.setattr(main, "BROADCAST_PAGE_SIZE", 2)
+    yield storage
+    storage.close()
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+
+    async def send_message(chat_id, text, **kwargs):
+        if chat_id == 5:
+            raise TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")
+        sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(sent))
+
+    async def edit_message_text(text, **kwargs):
+        sent.append(("edit", text))
+
+    monkeypatch.setattr(main.bot, "send_message", send_message)
+    monkeypatch.setattr(main.bot, "edit_message_text", edit_message_text)
+    return sent
+
+
+def test_total_counts_only_recipients(storage, sent):
+    job = main.BroadcastJob.create("новости", admin_chat_id=1000)
+    assert job.state["total"] == 5
+
+    asyncio.run(job.run())
+    recipients = sorted(chat_id for chat_id, _ in sent if chat_id not in ("edit", 1000))
+    assert recipients == [1, 2, 4, 6]
+    assert job.state["delivered"] == 4 and job.state["blocked"] == 1
+    assert "5/5 (100%)" in job.progress_text(finished=True)
+    # Пользователь 5 заблокировал бота — следующая рассылка его не посчитает
+    assert storage.count_users(include_blocked=False) == 4
+    assert not main.os.path.exists(main.BROADCAST_STATE_PATH)
+
+
+def test_resume_continues_after_cursor(storage, sent):
+    job = main.BroadcastJob.create("новости", admin_chat_id=1000)
+    # Бот остановился, успев обработать пользователей 1 и 2
+    job.state.update({"cursor": 2, "delivered": 2, "status_message_id": 77})
+    job._save_state()
+
+    resumed = main.BroadcastJob.load()
+    assert resumed.state["cursor"] == 2
+    asyncio.run(resumed.run())
+    recipients = sorted(chat_id for chat_id, _ in sent if chat_id not in ("edit", 1000))
+    assert recipients == [4, 6]
+    assert resumed.state["delivered"] == 4
+    assert resumed.state["blocked"] == 1
+    assert "5/5 (100%)" in resumed.progress_text(finished=True)
+
+
+def test_cursor_advances_only_past_contiguous_done_users():
+    job = main.BroadcastJob({"text": "", "admin_chat_id": 0, "status_message_id": None, "cursor": None,
+                             "total": 3, "delivered": 0, "blocked": 0, "failed": 0, "started_at": 0})
+    job._pending.extend([10, 20, 30])
+    job._mark_done(20)
+    assert job.state["cursor"] is None
+    job._mark_done(10)
+    assert job.state["cursor"] == 20
+    job._mark_done(30)
+    assert job.state["cursor"] == 30
@@ -0,0 +1,84 @@
+# Кэш медленных запросов (поиск, перевод, озвучка): одновременные одинаковые запросы
+# выполняются один раз, None и устаревшие записи не отдаются, отмена загружавшего
+# не передаётся остальным.
+import asyncio
+
+import main
+
+
+def test_async_ttl_cache_coalesces_concurrent_loads():
+    cache = main.AsyncTTLCache(maxsize=10, ttl=60)
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.05)
+        return "значение"
+
+    async def run():
+        return await asyncio.gather(*[cache.get_or_load("ключ", loader) for _ in range(5)])
+
+    assert asyncio.run(run()) == ["значение"] * 5
+    assert len(loads) == 1
+    assert cache.coalesced == 4
+    assert cache.get("ключ") == "значение"
+
+
+def test_async_ttl_cache_does_not_keep_none_or_expired():
+    cache = main.AsyncTTLCache(maxsize=2, ttl=60)
+
+    async def nothing():
+        return None
+
+    assert asyncio.run(cache.get_or_load("пусто", nothing)) is None
+    assert len(cache) == 0
+    cache.set("старое", 1, ttl=-1)
+    assert cache.get("старое") is None
+    for key in "abc":
+        cache.set(key, key)
+    assert cache.get("a") is None and cache.get("c") == "c"
+
+
+def test_cancelled_loader_does_not_cancel_waiters():
+    cache = main.AsyncTTLCache(maxsize=10, ttl=60)
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.1)
+        return f"загрузка {len(loads)}"
+
+    async def run():
+        first = asyncio.create_task(cache.get_or_load("ключ", loader))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.create_task(cache.get_or_load("ключ", loader)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        first.cancel()
+        results = await asyncio.gather(*waiters)
+        return first, results
+
+    first, results = asyncio.run(run())
+    assert first.cancelled()
+    # Загрузку повторил один из ждущих, остальные получили его результат
+    assert results == ["загрузка 2"] * 3
+    assert len(loads) == 2
+    assert cache.get("ключ") == "загрузка 2"
+
+
+def test_loader_error_reaches_all_waiters():
+    cache = main.AsyncTTLCache(maxsize=10, ttl=60)
+
+    async def loader():
+        await asyncio.sleep(0.02)
+        raise RuntimeError("поиск недоступен")
+
+    async def run():
+        return await asyncio.gather(*[cache.get_or_load("ключ", loader) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert len(cache) == 0
+
+
+def test_search_query_normalization():
+    assert main.normalize_search_query("  Погода   В Москве ") == main.normalize_search_query("погода в москве")
@@ -0,0 +1,77 @@
+# Файлы из ответа модели: верстаются одновременно, ошибка одного файла не мешает
+# остальным, а текст ошибки зависит от типа исключения.
+import asyncio
+import io
+import zipfile
+
+import pytest
+
+import main
+
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+        self.documents = []
+        self.albums = []
+        self.deleted = 0
+
+    async def answer(self, text, **kwargs):
+        self.texts.append(text)
+        return self
+
+    async def answer_document(self, document, caption=None, **kwargs):
+        self.documents.append((document.filename, document.data, caption))
+
+    async def answer_media_group(self, media, **kwargs):
+        self.albums.append([item.media.filename for item in media])
+
+    async def delete(self):
+        self.deleted += 1
+
+
+@pytest.mark.parametrize("error, expected", [
+    (asyncio.TimeoutError(), "превышено время ожидания"),
+    (ValueError("неверная таблица"), "неверная таблица"),
+    (RuntimeError(), "RuntimeError"),
+])
+def test_error_text_by_exception_type(error, expected):
+    assert main.error_text(error) == expected
+
+
+@pytest.fixture
+def build(monkeypatch):
+    async def build_generated_file(name, content):
+        if content == "timeout":
+            raise asyncio.TimeoutError()
+        if content == "empty":
+            raise RuntimeError()
+        await asyncio.sleep(0)
+        return content.encode()
+
+    monkeypatch.setattr(main, "build_generated_file", build_generated_file)
+
+
+def test_failed_files_report_error_and_rest_are_sent(build):
+    message = FakeMessage()
+    files = [("a.txt", "первый"), ("b.pdf", "timeout"), ("c.docx", "empty")]
+    asyncio.run(main.generate_and_send_files(message, files))
+
+    assert "⚠️ Ошибка при создании b.pdf: превышено время ожидания" in message.texts
+    assert "⚠️ Ошибка при создании c.docx: RuntimeError" in message.texts
+    assert [(name, data) for name, data, _ in message.documents] == [("a.txt", "первый".encode())]
+    assert message.deleted == 1
+
+
+def test_several_files_go_as_album_or_zip(build, monkeypatch):
+    monkeypatch.setattr(main, "GENERATED_FILES_ZIP_THRESHOLD", 2)
+    message = FakeMessage()
+    asyncio.run(main.generate_and_send_files(message, [("a.txt", "1"), ("a.txt", "2")]))
+    assert len(message.albums) == 1 and len(set(message.albums[0])) == 2
+
+    message = FakeMessage()
+    asyncio.run(main.generate_and_send_files(message, [("x.txt", "1"), ("y.txt", "2"), ("z.txt", "3")]))
+    name, data, _ = message.documents[0]
+    assert name == "files.zip"
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert sorted(archive.namelist()) == ["x.txt", "y.txt", "z.txt"]
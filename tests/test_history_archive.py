@@ -0,0 +1,142 @@
+# Архив истории: начало живой истории уходит в сжатый файл со сквозной нумерацией,
+# а сохранение во время сжатия истории не ломает краткое содержание.
+import asyncio
+import gzip
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def archive_settings(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(main, "HISTORY_LIVE_LIMIT", 10)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_BATCH", 2)
+    main._archive_pending.clear()
+    yield
+    main._archive_pending.clear()
+
+
+def dialog(count, start=0):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"сообщение {i}"} for i in range(start, start + count)]
+
+
+def flush_archive(user_id, drop=False):
+    main.write_archive_batch([{"user_id": user_id, "archive_rows": main._archive_pending.pop(user_id, []),
+                               "archive_drop": drop}])
+
+
+def test_archive_front_keeps_sequence_numbers():
+    data = {"history": dialog(6)}
+    main.archive_history_front(1, data, 4)
+    assert data["history_base"] == 4
+    assert [m["content"] for m in data["history"]] == ["сообщение 4", "сообщение 5"]
+    assert [seq for seq, _ in main._archive_pending[1]] == [0, 1, 2, 3]
+
+    data["history"].extend(dialog(3, start=6))
+    main.archive_history_front(1, data, 3)
+    assert [seq for seq, _ in main._archive_pending[1]] == [0, 1, 2, 3, 4, 5, 6]
+
+
+def test_archive_segments_are_read_in_order_without_duplicates():
+    data = {"history": dialog(8)}
+    main.archive_history_front(2, data, 3)
+    flush_archive(2)
+    main.archive_history_front(2, data, 3)
+    # Повторная запись тех же строк (например, после сбоя посреди сброса) не даёт дублей
+    rows = list(main._archive_pending[2])
+    flush_archive(2)
+    main._archive_pending[2] = rows
+    flush_archive(2)
+    assert [m["content"] for m in main.read_history_archive(2)] == [f"сообщение {i}" for i in range(6)]
+
+
+def test_truncated_archive_returns_readable_part():
+    data = {"history": dialog(4)}
+    main.archive_history_front(3, data, 2)
+    flush_archive(3)
+    path = main.archive_path(3)
+    with open(path, "ab") as f:
+        # Сбой во время записи: от нового сегмента остался только заголовок gzip
+        f.write(gzip.compress(b'{"seq":2,"message":{"role":"user","content":"x"}}\n')[:12])
+    assert [m["content"] for m in main.read_history_archive(3)] == ["сообщение 0", "сообщение 1"]
+
+
+def test_drop_removes_archive_file():
+    data = {"history": dialog(4)}
+    main.archive_history_front(4, data, 2)
+    flush_archive(4)
+    flush_archive(4, drop=True)
+    assert main.read_history_archive(4) == []
+
+
+def test_save_during_compaction_keeps_summary(monkeypatch):
+    user_id = 5
+    data = {"history": dialog(20), "model": "mistral-small-latest"}
+    main.user_context[user_id] = data
+
+    async def complete(model, messages, **kwargs):
+        # Пока модель пишет краткое содержание, пользователь продолжает диалог
+        data["history"].extend(dialog(4, start=20))
+        main.save_user_data(user_id)
+        await asyncio.sleep(0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="краткое содержание"))]), model
+
+    monkeypatch.setattr(main.router, "complete", complete)
+
+    async def run():
+        main.schedule_history_compaction(user_id, data, 12)
+        await main._compaction_tasks[user_id]
+        await asyncio.sleep(0)
+
+    try:
+        asyncio.run(run())
+        assert data["summary"] == "краткое содержание"
+        assert data["history_base"] == 12
+        assert data["history"][0]["content"] == "сообщение 12"
+        assert user_id not in main._compaction_tasks
+        # Сжатие закончилось — следующее сохранение догоняет архив до лимита живой истории
+        main.save_user_data(user_id)
+        assert len(data["history"]) == main.HISTORY_LIVE_LIMIT
+        assert [seq for seq, _ in main._archive_pending[user_id]] == list(range(14))
+    finally:
+        main.user_context.pop(user_id)
+        main._dirty_users.discard(user_id)
+
+
+def test_start_drops_old_archive(monkeypatch, tmp_path):
+    storage = main.SQLiteUserStorage(str(tmp_path / "users.db"))
+    monkeypatch.setattr(main, "_storage", storage)
+    user_id = 6
+    answers = []
+
+    async def answer(text, **kwargs):
+        answers.append(text)
+
+    message = SimpleNamespace(from_user=SimpleNamespace(id=user_id, full_name="Тест"), text="/start", answer=answer)
+
+    async def run():
+        data = main.get_user_data(user_id)
+        data["history"].extend(dialog(6))
+        main.archive_history_front(user_id, data, 4)
+        main.save_user_data(user_id)
+        await main.flush_user_data()
+
+        await main.cmd_start(message)
+        data = main.get_user_data(user_id)
+        data["history"].extend(dialog(4, start=100))
+        main.archive_history_front(user_id, data, 2)
+        main.save_user_data(user_id)
+        await main.flush_user_data()
+
+    try:
+        asyncio.run(run())
+        # В архиве только сообщения после /start, без старых с теми же seq
+        assert [m["content"] for m in main.read_history_archive(user_id)] == ["сообщение 100", "сообщение 101"]
+        assert answers
+    finally:
+        main.user_context.pop(user_id)
+        main._persisted_history.pop(user_id, None)
+        storage.close()
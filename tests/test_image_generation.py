@@ -0,0 +1,86 @@
+# Генерация картинок: детерминированные seed для вариантов, переключение на запасную
+# модель, если основная медлит или падает, и кэш байтов с ограничением объёма.
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+def fallbacks(reason):
+    return main.IMAGE_FALLBACKS.values.get(("turbo", reason), 0)
+
+
+@pytest.fixture
+def fake_fetch(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_FALLBACK_AFTER", 0.05)
+    behaviour = {}
+    calls = []
+
+    async def fetch_image(prompt, model, seed, deadline):
+        calls.append(model)
+        delay, error = behaviour.get(model, (0, None))
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return f"{model}:{seed}".encode()
+
+    monkeypatch.setattr(main, "fetch_image", fetch_image)
+    return behaviour, calls
+
+
+def test_seeds_are_stable_and_distinct(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_VARIANTS", 4)
+    seeds = main.image_seeds("a red fox")
+    assert seeds == main.image_seeds("a red fox")
+    assert len(set(seeds)) == 4
+    assert seeds != main.image_seeds("a blue fox")
+
+
+def test_fast_primary_needs_no_fallback(fake_fetch):
+    behaviour, calls = fake_fetch
+    result = asyncio.run(main.fetch_image_variant("кот", "flux", 1, time.monotonic() + 2))
+    assert result == (b"flux:1", "flux")
+    assert calls == ["flux"]
+
+
+def test_slow_primary_falls_back(fake_fetch):
+    behaviour, calls = fake_fetch
+    behaviour["flux"] = (1, None)
+    before = fallbacks("slow")
+    result = asyncio.run(main.fetch_image_variant("кот", "flux", 1, time.monotonic() + 2))
+    assert result == (b"turbo:1", "turbo")
+    assert calls == ["flux", "turbo"]
+    assert fallbacks("slow") == before + 1
+
+
+def test_failed_primary_falls_back(fake_fetch):
+    behaviour, calls = fake_fetch
+    behaviour["flux"] = (0, ValueError("502"))
+    before = fallbacks("error")
+    assert asyncio.run(main.fetch_image_variant("кот", "flux", 1, time.monotonic() + 2)) == (b"turbo:1", "turbo")
+    assert fallbacks("error") == before + 1
+
+
+def test_deadline_raises_timeout(fake_fetch):
+    behaviour, _ = fake_fetch
+    behaviour["flux"] = (1, None)
+    behaviour["turbo"] = (1, None)
+    with pytest.raises(asyncio.TimeoutError) as error:
+        asyncio.run(main.fetch_image_variant("кот", "flux", 1, time.monotonic() + 0.2))
+    assert main.error_text(error.value) == "превышено время ожидания"
+
+
+def test_bytes_cache_respects_byte_limit():
+    cache = main.AsyncTTLCache(maxsize=100, ttl=60, max_bytes=25)
+    cache.set("a", b"x" * 10)
+    cache.set("b", b"y" * 10)
+    cache.set("c", b"z" * 10)
+    assert cache.get("a") is None and cache.get("c") == b"z" * 10
+    assert cache.total_bytes == 20
+    # Значение больше всего лимита не кэшируется и не вытесняет остальные
+    cache.set("big", b"!" * 100)
+    assert cache.get("big") is None and len(cache) == 2
+    cache.set("b", b"y")
+    assert cache.total_bytes == 11
@@ -0,0 +1,81 @@
+# Фото в истории: вместо ссылки Telegram хранится image_ref с подписью, и подпись,
+# заполненная после ответа модели, доходит до хранилища даже при записи по частям.
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def sqlite_storage(monkeypatch, tmp_path):
+    storage = main.SQLiteUserStorage(str(tmp_path / "users.db"))
+    monkeypatch.setattr(main, "_storage", storage)
+    yield storage
+    storage.close()
+
+
+def photo_message(caption=""):
+    return {"role": "user", "content": [{"type": "text", "text": "Что на фото?"},
+                                        {"type": "image_ref", "sha256": "ab" * 32, "caption": caption}]}
+
+
+def test_caption_filled_after_flush_is_persisted(sqlite_storage):
+    user_id = 101
+    data = main.default_user_data()
+    data["history"] = [{"role": "user", "content": "привет"}, {"role": "assistant", "content": "здравствуйте"}]
+    main.user_context[user_id] = data
+    try:
+        main.save_user_data(user_id)
+        asyncio.run(main.flush_user_data())
+
+        # Фото уже в истории, а модель ещё отвечает — в это время проходит сброс
+        user_message = photo_message()
+        data["history"].append(user_message)
+        main.save_user_data(user_id)
+        asyncio.run(main.flush_user_data())
+
+        main.set_image_caption(user_message, "Рыжий кот спит на подоконнике")
+        main.mark_history_rewrite(user_id, data, user_message)
+        data["history"].append({"role": "assistant", "content": "Рыжий кот спит на подоконнике"})
+        main.save_user_data(user_id)
+        asyncio.run(main.flush_user_data())
+
+        stored = sqlite_storage.load(user_id)["history"]
+        assert len(stored) == 4
+        assert stored[2]["content"][1]["caption"] == "Рыжий кот спит на подоконнике"
+        assert user_id not in main._history_rewrites
+    finally:
+        main.user_context.pop(user_id)
+        main._persisted_history.pop(user_id, None)
+
+
+def test_caption_is_trimmed_to_limit(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_CAPTION_CHARS", 20)
+    msg = photo_message()
+    main.set_image_caption(msg, "очень   длинное\nописание фотографии с котом")
+    caption = msg["content"][1]["caption"]
+    assert caption.endswith("…") and len(caption) <= 21
+    assert "  " not in caption
+
+
+def test_legacy_telegram_urls_are_scrubbed():
+    msg = {"role": "user", "content": [
+        {"type": "text", "text": "фото"},
+        {"type": "image_url", "image_url": {"url": "https://api.telegram.org/file/bot123:SECRET/photos/1.jpg"}},
+    ]}
+    assert main.scrub_legacy_image_urls(msg)
+    assert "SECRET" not in repr(msg)
+    assert msg["content"][1]["type"] == "image_ref"
+    assert not main.scrub_legacy_image_urls(msg)
+
+
+def test_image_requests_fail_over_only_to_vision_models(monkeypatch):
+    monkeypatch.setattr(main, "MODEL_FALLBACKS", {
+        "google/gemini-2.0-flash-exp:free": ["mistral-small-latest", "qwen/qwen2.5-vl-72b-instruct:free"],
+    })
+    router = main.ProviderRouter({"mistral": object(), "openrouter": object()})
+    image = [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,"}}]}]
+    assert router.candidates("google/gemini-2.0-flash-exp:free", image) == [
+        "google/gemini-2.0-flash-exp:free", "qwen/qwen2.5-vl-72b-instruct:free"]
+    assert len(router.candidates("google/gemini-2.0-flash-exp:free", [{"role": "user", "content": "текст"}])) == 3
@@ -0,0 +1,40 @@
+# Очередь сообщений пользователя: первое сообщение уходит сразу, пришедшие во время
+# обработки склеиваются, задачи (фото, /search) выполняются по очереди и не склеиваются.
+import asyncio
+import time
+from types import SimpleNamespace
+
+import main
+
+
+def test_idle_dispatch_and_coalescing(monkeypatch):
+    calls = []
+
+    async def process_text_message(message, text):
+        calls.append((round(time.monotonic() - started, 1), text))
+        await asyncio.sleep(0.2)
+
+    async def job(message, name):
+        calls.append((round(time.monotonic() - started, 1), f"задача {name}"))
+
+    monkeypatch.setattr(main, "process_text_message", process_text_message)
+    message = SimpleNamespace()
+
+    async def run():
+        main.enqueue_user_message(1, message, "первое", coalesce=True)
+        await asyncio.sleep(0.05)
+        main.enqueue_user_message(1, message, "второе", coalesce=True)
+        main.enqueue_user_message(1, message, "третье", coalesce=True)
+        main.enqueue_user_job(1, message, job, "поиск")
+        main.enqueue_user_message(1, message, "голосовое", coalesce=False)
+        while 1 in main._inboxes:
+            await asyncio.sleep(0.01)
+
+    started = time.monotonic()
+    asyncio.run(run())
+    assert calls == [
+        (0.0, "первое"),
+        (0.2, "второе\nтретье"),
+        (0.4, "задача поиск"),
+        (0.4, "голосовое"),
+    ]
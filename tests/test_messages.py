@@ -0,0 +1,86 @@
+# Отправка ответов: разрезание длинных сообщений, экранирование Markdown,
+# лимиты отправки и превью потокового ответа.
+import asyncio
+import time
+
+import main
+
+
+def test_short_message_is_not_split():
+    assert main.split_message("коротко") == ["коротко"]
+
+
+def test_split_respects_utf16_limit_and_keeps_text():
+    lines = [f"строка {i} 😀 " + "слово " * 20 for i in range(300)]
+    text = "\n".join(lines)
+    chunks = main.split_message(text)
+    assert len(chunks) > 1
+    assert all(main._utf16_len(chunk) <= main.TELEGRAM_TEXT_LIMIT for chunk in chunks)
+    assert "\n".join(chunks).split() == text.split()
+
+
+def test_split_reopens_code_block():
+    text = "начало\n```python\n" + "\n".join(f"x_{i} = {i}" for i in range(1500)) + "\n```\nконец"
+    chunks = main.split_message(text)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.count("```") % 2 == 0
+    assert chunks[1].startswith("```python\n")
+
+
+def test_split_hard_cuts_line_without_breaks():
+    chunks = main.split_message("a" * 10000)
+    assert "".join(chunks) == "a" * 10000
+    assert all(len(chunk) <= main.TELEGRAM_TEXT_LIMIT for chunk in chunks)
+
+
+def test_prepare_markdown_escapes_unclosed_markup():
+    assert main.prepare_markdown("*жирный* и _курсив_") == ("*жирный* и _курсив_", "Markdown")
+    body, parse_mode = main.prepare_markdown("snake_case и 2*3")
+    assert parse_mode == "Markdown"
+    assert main.find_markdown_error(body) is None
+    assert body.replace("\\", "") == "snake_case и 2*3"
+
+
+class FakeMethod:
+    def __init__(self, api_method, chat_id):
+        self.__api_method__ = api_method
+        self.chat_id = chat_id
+
+
+def test_streaming_edits_bypass_chat_bucket():
+    scheduler = main.SendScheduler(rate=1000, chat_rate=1, chat_burst=1, group_per_minute=20)
+    middleware = main.SendSchedulerMiddleware(scheduler)
+
+    async def make_request(bot, method):
+        return method.__api_method__
+
+    async def run():
+        started = time.monotonic()
+        token = main.send_self_paced.set(True)
+        try:
+            for _ in range(5):
+                await middleware(make_request, None, FakeMethod("editMessageText", 42))
+        finally:
+            main.send_self_paced.reset(token)
+        streaming = time.monotonic() - started
+        # Токен чата не потрачен — ответ уходит сразу
+        started = time.monotonic()
+        await middleware(make_request, None, FakeMethod("sendMessage", 42))
+        answer = time.monotonic() - started
+        # Второе обычное сообщение ждёт пополнения токена чата
+        started = time.monotonic()
+        await middleware(make_request, None, FakeMethod("sendMessage", 42))
+        return streaming, answer, time.monotonic() - started
+
+    streaming, answer, throttled = asyncio.run(run())
+    assert streaming < 0.2
+    assert answer < 0.05
+    assert throttled > 0.5
+
+
+def test_stream_preview_fits_message_limit():
+    preview = main._stream_preview("слово " * 2000)
+    assert len(preview) <= main.TELEGRAM_TEXT_LIMIT
+    assert preview.endswith("…")
+    assert main._stream_preview("ответ <GENERATE_FILE name=\"a.txt\">x") == "ответ\n\n📄 Готовлю файл..."
@@ -0,0 +1,140 @@
+# Маршрутизация запросов к провайдерам: отключение провайдера после серии сбоев,
+# один пробный запрос в полуоткрытом состоянии, ошибки запроса не переключают модель.
+import asyncio
+
+import httpx
+import pytest
+from openai import APIConnectionError, APIStatusError, AuthenticationError, BadRequestError, RateLimitError
+
+import main
+
+REQUEST = httpx.Request("POST", "https://provider.test/v1/chat/completions")
+
+
+def status_error(cls, code):
+    return cls("ошибка", response=httpx.Response(code, request=REQUEST), body=None)
+
+
+class FakeClient:
+    # Минимальная замена AsyncOpenAI: client.chat.completions.create
+    def __init__(self, errors=None, delay=0.01):
+        self.errors = list(errors or [])
+        self.delay = delay
+        self.calls = []
+        self.chat = self.completions = self
+
+    async def create(self, model, messages, **kwargs):
+        self.calls.append(model)
+        await asyncio.sleep(self.delay)
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        return f"ответ {model}"
+
+
+@pytest.fixture(autouse=True)
+def router_settings(monkeypatch):
+    monkeypatch.setattr(main, "MODEL_FALLBACKS", {"mistral-small-latest": ["vendor/fallback"]})
+    monkeypatch.setattr(main, "CIRCUIT_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(main, "CIRCUIT_OPEN_SECONDS", 60)
+    monkeypatch.setattr(main, "HEDGE_AFTER_SECONDS", 0)
+    monkeypatch.setattr(main, "HEDGE_PROVIDERS", {"openrouter"})
+
+
+def test_failover_and_breaker_opens_on_connection_errors():
+    mistral = FakeClient([APIConnectionError(request=REQUEST)] * 2)
+    openrouter = FakeClient()
+    router = main.ProviderRouter({"mistral": mistral, "openrouter": openrouter})
+
+    async def run():
+        results = [await router.complete("mistral-small-latest", []) for _ in range(3)]
+        return results
+
+    results = asyncio.run(run())
+    assert all(used == "vendor/fallback" for _, used in results)
+    assert router.stats()["mistral"] == "open"
+    # Третий запрос к отключённому провайдеру не отправлялся
+    assert mistral.calls == ["mistral-small-latest"] * 2
+    assert router.failovers == 3
+
+
+def test_half_open_admits_single_probe():
+    mistral = FakeClient([APIConnectionError(request=REQUEST)] * 2, delay=0.05)
+    openrouter = FakeClient()
+    router = main.ProviderRouter({"mistral": mistral, "openrouter": openrouter})
+
+    async def run():
+        for _ in range(2):
+            await router.complete("mistral-small-latest", [])
+        router.breakers["mistral"].open_until = 0  # срок отключения истёк
+        assert router.stats()["mistral"] == "half-open"
+        return await asyncio.gather(*[router.complete("mistral-small-latest", []) for _ in range(5)])
+
+    results = asyncio.run(run())
+    # Из пяти одновременных запросов к провайдеру дошёл только пробный
+    assert mistral.calls.count("mistral-small-latest") == 3
+    assert sum(used == "mistral-small-latest" for _, used in results) == 1
+    assert router.stats()["mistral"] == "closed"
+
+
+@pytest.mark.parametrize("error", [
+    status_error(AuthenticationError, 401),
+    status_error(BadRequestError, 400),
+])
+def test_client_errors_neither_fail_over_nor_trip_breaker(error):
+    mistral = FakeClient([error] * 3)
+    openrouter = FakeClient()
+    router = main.ProviderRouter({"mistral": mistral, "openrouter": openrouter})
+
+    async def run():
+        for _ in range(3):
+            with pytest.raises(type(error)):
+                await router.complete("mistral-small-latest", [])
+
+    asyncio.run(run())
+    assert openrouter.calls == []
+    assert router.breakers["mistral"].failures == 0
+    assert router.stats()["mistral"] == "closed"
+
+
+@pytest.mark.parametrize("error, expected", [
+    (APIConnectionError(request=REQUEST), True),
+    (status_error(RateLimitError, 429), True),
+    (status_error(APIStatusError, 503), True),
+    (status_error(AuthenticationError, 401), False),
+    (status_error(BadRequestError, 400), False),
+    (ValueError("не сетевая ошибка"), False),
+])
+def test_failover_error_classification(error, expected):
+    assert main.is_failover_error(error) is expected
+
+
+def test_hedge_client_error_does_not_cancel_primary(monkeypatch):
+    # Основная модель отвечает медленно, хедж сразу отказывает с 400 — ждём основную
+    monkeypatch.setattr(main, "MODEL_FALLBACKS", {"vendor/primary": ["mistral-small-latest"]})
+    monkeypatch.setattr(main, "HEDGE_AFTER_SECONDS", 0.1)
+    openrouter = FakeClient(delay=0.5)
+    mistral = FakeClient([status_error(BadRequestError, 400)])
+    router = main.ProviderRouter({"mistral": mistral, "openrouter": openrouter})
+
+    answer, used = asyncio.run(router.complete("vendor/primary", []))
+    assert (answer, used) == ("ответ vendor/primary", "vendor/primary")
+    assert mistral.calls == ["mistral-small-latest"]
+    assert router.hedges == 1
+
+
+def test_primary_client_error_is_raised_immediately(monkeypatch):
+    monkeypatch.setattr(main, "MODEL_FALLBACKS", {"vendor/primary": ["mistral-small-latest"]})
+    monkeypatch.setattr(main, "HEDGE_AFTER_SECONDS", 0.1)
+    openrouter = FakeClient([status_error(BadRequestError, 400)], delay=0.3)
+    mistral = FakeClient(delay=1)
+    router = main.ProviderRouter({"mistral": mistral, "openrouter": openrouter})
+
+    async def run():
+        started = asyncio.get_running_loop().time()
+        with pytest.raises(BadRequestError):
+            await router.complete("vendor/primary", [])
+        return asyncio.get_running_loop().time() - started
+
+    assert asyncio.run(run()) < 0.9
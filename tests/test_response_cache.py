@@ -0,0 +1,42 @@
+# Кэш ответов: в кэш попадают только короткие текстовые запросы без истории,
+# ответ запасной модели под ключом запрошенной не сохраняется.
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def cache_enabled(monkeypatch):
+    monkeypatch.setattr(main, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(main, "response_cache", main.AsyncTTLCache(10, 60))
+
+
+def ask(text, system="s"):
+    return [{"role": "system", "content": system}, {"role": "user", "content": text}]
+
+
+def test_key_ignores_surrounding_whitespace_and_depends_on_model():
+    key = main.response_cache_key("mistral-small-latest", ask("привет"))
+    assert key == main.response_cache_key("mistral-small-latest", ask("  привет\n"))
+    assert key != main.response_cache_key("mistral-large-latest", ask("привет"))
+    assert key != main.response_cache_key("mistral-small-latest", ask("привет", system="другая роль"))
+
+
+def test_uncacheable_requests_have_no_key(monkeypatch):
+    dialog = ask("привет") + [{"role": "assistant", "content": "здравствуйте"}, {"role": "user", "content": "как дела"}]
+    assert main.response_cache_key("mistral-small-latest", dialog) is None
+    image = [{"role": "user", "content": [{"type": "text", "text": "что здесь"}]}]
+    assert main.response_cache_key("mistral-small-latest", image) is None
+    assert main.response_cache_key("mistral-small-latest", ask("х" * (main.RESPONSE_CACHE_MAX_CHARS + 1))) is None
+    monkeypatch.setattr(main, "RESPONSE_CACHE_ENABLED", False)
+    assert main.response_cache_lookup("mistral-small-latest", ask("привет")) == (None, None)
+
+
+def test_fallback_answer_is_not_cached():
+    messages = ask("привет")
+    key, answer = main.response_cache_lookup("mistral-small-latest", messages)
+    assert key is not None and answer is None
+    main.response_cache_store(key, "ответ запасной", "mistral-small-latest", "vendor/fallback")
+    assert main.response_cache_lookup("mistral-small-latest", messages)[1] is None
+    main.response_cache_store(key, "ответ основной", "mistral-small-latest", "mistral-small-latest")
+    assert main.response_cache_lookup("mistral-small-latest", messages)[1] == "ответ основной"
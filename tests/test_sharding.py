@@ -0,0 +1,45 @@
+# Многопроцессный режим: распределение пользователей по шардам и общий на все шарды
+# лимит отправки.
+import multiprocessing
+import time
+
+import main
+
+
+def test_hash_ring_is_stable_and_moves_few_users():
+    users = range(10000)
+    four = main.HashRing(4)
+    five = main.HashRing(5)
+    assert [four.node_for(u) for u in users] == [main.HashRing(4).node_for(u) for u in users]
+    counts = [sum(1 for u in users if four.node_for(u) == node) for node in range(4)]
+    assert min(counts) > 1500
+    moved = sum(1 for u in users if four.node_for(u) != five.node_for(u))
+    # При добавлении пятого шарда переезжает около пятой части пользователей, а не почти все
+    assert moved < 3000
+
+
+def test_update_user_id_prefers_author():
+    assert main.update_user_id({"update_id": 1, "message": {"from": {"id": 7}, "chat": {"id": -100}}}) == 7
+    assert main.update_user_id({"update_id": 2, "callback_query": {"from": {"id": 8}, "message": {"chat": {"id": 9}}}}) == 8
+    assert main.update_user_id({"update_id": 3, "channel_post": {"chat": {"id": -5}}}) == -5
+    assert main.update_user_id({"update_id": 4}) is None
+
+
+def test_shared_token_bucket_is_one_budget_for_all_shards():
+    state = multiprocessing.Array("d", [2.0, time.monotonic(), 0.0])
+    first = main.SharedTokenBucket(0.001, state, capacity=2)
+    second = main.SharedTokenBucket(0.001, state, capacity=2)
+    assert first.try_acquire() == 0
+    assert second.try_acquire() == 0
+    # Два токена на двоих уже потрачены
+    assert first.try_acquire() > 0
+    assert second.try_acquire() > 0
+
+
+def test_shared_token_bucket_pause_applies_everywhere():
+    state = multiprocessing.Array("d", [5.0, time.monotonic(), 0.0])
+    first = main.SharedTokenBucket(100, state, capacity=5)
+    second = main.SharedTokenBucket(100, state, capacity=5)
+    first.pause(30)
+    wait = second.try_acquire()
+    assert 29 < wait <= 30
@@ -0,0 +1,130 @@
+# Хранилище пользователей: SQLite дописывает только новые строки истории,
+# старые user_data/*.json переносятся в базу один раз и без потерь.
+import asyncio
+import json
+import sqlite3
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = main.SQLiteUserStorage(str(tmp_path / "users.db"))
+    yield storage
+    storage.close()
+
+
+def dialog(count, start=0):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"сообщение {i}"} for i in range(start, start + count)]
+
+
+def item(user_id, rows, reset=False, trim_below=None, **settings):
+    return {"user_id": user_id, "settings": json.dumps({"model": "m", **settings}), "history_reset": reset,
+            "history_trim_below": trim_below, "history_rows": [(seq, json.dumps(msg)) for seq, msg in rows]}
+
+
+def test_rows_are_appended_trimmed_and_reset(storage):
+    storage.write_batch([item(1, enumerate(dialog(3)), reset=True)])
+    storage.write_batch([item(1, [(3, dialog(1, start=3)[0])], referrals=2)])
+    data = storage.load(1)
+    assert data["referrals"] == 2
+    assert [m["content"] for m in data["history"]] == [f"сообщение {i}" for i in range(4)]
+
+    storage.write_batch([item(1, [], trim_below=2)])
+    assert [m["content"] for m in storage.load(1)["history"]] == ["сообщение 2", "сообщение 3"]
+
+    storage.write_batch([item(1, [(0, {"role": "user", "content": "заново"})], reset=True)])
+    assert storage.load(1)["history"] == [{"role": "user", "content": "заново"}]
+    assert storage.load(2) is None and not storage.exists(2)
+
+
+def test_blocked_users_are_skipped_until_they_write_again(storage):
+    storage.write_batch([item(uid, [], reset=True) for uid in (1, 2, 3)])
+    storage.set_blocked(2)
+    assert storage.list_user_ids() == [1, 2, 3]
+    assert storage.list_user_ids(include_blocked=False) == [1, 3]
+    assert storage.list_user_ids(after=1, limit=1) == [2]
+    assert storage.count_users(include_blocked=False) == 2
+    # Новое сообщение от пользователя снимает блокировку
+    storage.write_batch([item(2, [])])
+    assert storage.count_users(include_blocked=False) == 3
+
+
+def test_flush_writes_only_new_history_rows(monkeypatch, storage):
+    monkeypatch.setattr(main, "_storage", storage)
+    written = []
+    write_batch = storage.write_batch
+    monkeypatch.setattr(storage, "write_batch", lambda batch: (written.append(batch), write_batch(batch)))
+    user_id = 7
+    data = main.default_user_data()
+    data["history"] = dialog(4)
+    main.user_context[user_id] = data
+    try:
+        main.save_user_data(user_id)
+        asyncio.run(main.flush_user_data())
+        data["history"].extend(dialog(2, start=4))
+        main.save_user_data(user_id)
+        asyncio.run(main.flush_user_data())
+
+        assert [seq for seq, _ in written[1][0]["history_rows"]] == [4, 5]
+        assert not written[1][0]["history_reset"]
+        assert [m["content"] for m in storage.load(user_id)["history"]] == [f"сообщение {i}" for i in range(6)]
+
+        # Замена истории целиком (/clear) переписывает строки с нуля
+        data["history"] = dialog(1, start=10)
+        main.save_user_data(user_id)
+        asyncio.run(main.flush_user_data())
+        assert written[2][0]["history_reset"]
+        assert [m["content"] for m in storage.load(user_id)["history"]] == ["сообщение 10"]
+    finally:
+        main.user_context.pop(user_id)
+        main._persisted_history.pop(user_id, None)
+
+
+def write_json_user(directory, user_id, data):
+    with open(directory / f"{user_id}.json", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def test_migration_keeps_history_and_skips_migrated_users(tmp_path):
+    json_dir = tmp_path / "user_data"
+    json_dir.mkdir()
+    db_path = str(tmp_path / "users.db")
+    write_json_user(json_dir, 1, {"model": "m", "referrals": 3, "history": dialog(5)})
+    write_json_user(json_dir, 2, {"model": "m", "history": []})
+
+    assert main.migrate_json_to_sqlite(str(json_dir), db_path) == 2
+    # Повторный запуск не трогает уже перенесённых пользователей
+    write_json_user(json_dir, 1, {"model": "другая", "history": []})
+    write_json_user(json_dir, 3, {"model": "m", "history": dialog(1)})
+    assert main.migrate_json_to_sqlite(str(json_dir), db_path) == 1
+
+    storage = main.SQLiteUserStorage(db_path)
+    try:
+        first = storage.load(1)
+        assert first["model"] == "m" and first["referrals"] == 3
+        assert [m["content"] for m in first["history"]] == [f"сообщение {i}" for i in range(5)]
+        assert storage.list_user_ids() == [1, 2, 3]
+        assert storage.usage_totals() == {"users": 3, "referrals": 3}
+    finally:
+        storage.close()
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 1
+
+
+def test_first_sqlite_start_migrates_json_automatically(monkeypatch, tmp_path):
+    json_dir = tmp_path / "user_data"
+    json_dir.mkdir()
+    write_json_user(json_dir, 5, {"model": "m", "history": dialog(2)})
+    monkeypatch.setattr(main, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(main, "USER_DATA_DIR", str(json_dir))
+    monkeypatch.setattr(main, "SQLITE_PATH", str(tmp_path / "users.db"))
+
+    storage = main.create_storage()
+    try:
+        assert isinstance(storage, main.SQLiteUserStorage)
+        assert len(storage.load(5)["history"]) == 2
+    finally:
+        storage.close()
@@ -0,0 +1,85 @@
+# Статистика для /admin: счётчики обновляются по ходу работы, DAU/WAU считаются
+# по последнему дню активности каждого пользователя и переживают перезапуск.
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def today(monkeypatch):
+    day = [20000]
+    monkeypatch.setattr(main.UsageStats, "today", staticmethod(lambda: day[0]))
+    return day
+
+
+def test_active_users_move_between_days(today):
+    stats = main.UsageStats()
+    stats.touch(1)
+    stats.touch(1)
+    stats.touch(2)
+    assert (stats.summary()["dau"], stats.summary()["wau"]) == (2, 2)
+
+    today[0] += 1
+    stats.touch(1)
+    summary = stats.summary()
+    # Пользователь считается один раз — в последний день, когда писал
+    assert (summary["dau"], summary["wau"]) == (1, 2)
+    assert stats.active_by_day == {20000: 1, 20001: 1}
+
+    today[0] += main.ACTIVE_WINDOW_DAYS
+    assert (stats.summary()["dau"], stats.summary()["wau"]) == (0, 0)
+
+
+def test_counters_survive_save_and_load(tmp_path, today):
+    path = str(tmp_path / "usage_stats.json")
+    stats = main.UsageStats()
+    stats.load(path, bootstrap=lambda: {"users": 10, "referrals": 4})
+    stats.add_total("users")
+    stats.add_total("referrals", 2)
+    stats.record("text")
+    stats.record("request", "mistral-small-latest")
+    stats.record("request", "mistral-small-latest")
+    stats.touch(1)
+    stats.touch(2)
+    asyncio.run(stats.save(force=True))
+    assert not stats.dirty
+
+    restored = main.UsageStats()
+    # Файл уже есть — хранилище повторно не обходится
+    restored.load(path, bootstrap=lambda: pytest.fail("bootstrap не должен вызываться"))
+    summary = restored.summary()
+    assert summary["users"] == 11 and summary["referrals"] == 6
+    assert summary["events"] == {"text": 1, "request": 2}
+    assert summary["models"] == {"mistral-small-latest": 2}
+    assert (summary["dau"], summary["wau"]) == (2, 2)
+
+
+def test_load_forgets_users_inactive_for_a_week(tmp_path, today):
+    path = str(tmp_path / "usage_stats.json")
+    stats = main.UsageStats()
+    stats.load(path)
+    stats.touch(1)
+    today[0] += 3
+    stats.touch(2)
+    asyncio.run(stats.save(force=True))
+
+    today[0] += main.ACTIVE_WINDOW_DAYS - 2
+    restored = main.UsageStats()
+    restored.load(path)
+    assert restored.last_seen == {2: 20003}
+    assert restored.summary()["wau"] == 1
+
+
+def test_save_is_throttled_unless_forced(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "USAGE_STATS_SAVE_INTERVAL", 3600)
+    stats = main.UsageStats()
+    stats.load(str(tmp_path / "usage_stats.json"))
+    stats.record("voice")
+    asyncio.run(stats.save(force=True))
+    stats.record("voice")
+    asyncio.run(stats.save())
+    assert stats.dirty
+    asyncio.run(stats.save(force=True))
+    assert not stats.dirty
@@ -0,0 +1,70 @@
+# Кэш пользователей: вытеснение по числу записей, объёму и TTL, закреплённые записи
+# не вытесняются, пока с ними работает обработчик.
+import main
+
+
+def make_cache(max_users=2, max_bytes=10 ** 9, ttl=3600):
+    evicted = []
+    cache = main.UserCache(max_users, max_bytes, ttl, on_evict=lambda uid, data: evicted.append((uid, data)))
+    return cache, evicted
+
+
+def user(text="привет"):
+    return {"history": [{"role": "user", "content": text}], "model": "m"}
+
+
+def test_lru_eviction_calls_on_evict():
+    cache, evicted = make_cache(max_users=2)
+    cache[1] = user()
+    cache[2] = user()
+    cache.get(1)  # 2 становится самым давним
+    cache[3] = user()
+    assert 2 not in cache and 1 in cache and 3 in cache
+    assert [uid for uid, _ in evicted] == [2]
+
+
+def test_pinned_entry_survives_until_unpinned():
+    cache, evicted = make_cache(max_users=1)
+    first = cache[1] = user()
+    with cache.pinned(1):
+        cache[2] = user()
+        cache[3] = user()
+        # Закреплённый пользователь остаётся тем же объектом, сверх лимита
+        assert cache.peek(1) is first
+        assert 1 in cache
+    # После снятия закрепления кэш возвращается в лимит
+    assert 1 not in cache
+    assert len(cache) == 1
+    assert 1 in [uid for uid, _ in evicted]
+
+
+def test_nested_pins_are_counted():
+    cache, _ = make_cache(max_users=1)
+    cache[1] = user()
+    cache.pin(1)
+    cache.pin(1)
+    cache[2] = user()
+    cache.unpin(1)
+    cache[3] = user()
+    assert 1 in cache
+    cache.unpin(1)
+    assert 1 not in cache
+
+
+def test_byte_limit_evicts_oldest():
+    cache, evicted = make_cache(max_users=100, max_bytes=1)
+    cache[1] = user("x" * 1000)
+    cache[2] = user("y" * 1000)
+    # Самую свежую запись не трогаем, даже если она одна больше лимита
+    assert list(cache) == [2]
+    assert [uid for uid, _ in evicted] == [1]
+
+
+def test_evict_expired_skips_pinned():
+    cache, evicted = make_cache(max_users=10, ttl=-1)
+    cache[1] = user()
+    cache[2] = user()
+    with cache.pinned(2):
+        cache.evict_expired()
+    assert 1 not in cache and 2 in cache
+    assert [uid for uid, _ in evicted] == [1]
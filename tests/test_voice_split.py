@@ -0,0 +1,159 @@
+# Разрезание голосовых OGG/Opus: каждый кусок должен быть корректным потоком —
+# нумерация страниц с нуля, granule от начала куска, верные CRC и флаги BOS/EOS.
+import random
+
+import main
+
+SAMPLES_PER_PACKET = 960  # 20 мс при 48 кГц
+SERIAL = 0x1234ABCD
+
+
+def crc_bitwise(data: bytes) -> int:
+    # Независимая от main.ogg_crc (побитовая) реализация CRC страницы OGG
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+            crc &= 0xFFFFFFFF
+    return crc
+
+
+def make_page(lacing, body, granule, sequence, flags):
+    header = (b"OggS" + bytes([0, flags]) + granule.to_bytes(8, "little", signed=True)
+              + SERIAL.to_bytes(4, "little") + sequence.to_bytes(4, "little") + b"\0\0\0\0"
+              + bytes([len(lacing)]) + bytes(lacing))
+    page = bytearray(header + body)
+    page[22:26] = crc_bitwise(bytes(page)).to_bytes(4, "little")
+    return bytes(page)
+
+
+def build_ogg_opus(seconds: int, max_lacing: int = 24, seed: int = 1):
+    # Поток Opus: OpusHead, OpusTags и пакеты по 20 мс (TOC 0xF8 — CELT fullband, один кадр).
+    # Размеры пакетов разные, а страницы маленькие, так что часть пакетов переходит
+    # на следующую страницу, а на некоторых страницах не заканчивается ни один пакет.
+    rng = random.Random(seed)
+    packets = [b"\xf8" + bytes(rng.randrange(256) for _ in range(rng.choice((0, 20, 60, 160, 300) * 40 + (14000,))))
+               for _ in range(seconds * 50)]
+    opus_head = b"OpusHead" + bytes([1, 1]) + (312).to_bytes(2, "little") + (48000).to_bytes(4, "little") + b"\0\0\0"
+    opus_tags = b"OpusTags" + (4).to_bytes(4, "little") + b"test" + (0).to_bytes(4, "little")
+    pages = [make_page([len(opus_head)], opus_head, 0, 0, 0x02),
+             make_page([len(opus_tags)], opus_tags, 0, 1, 0)]
+
+    lacing, body, samples, continued = [], b"", 0, False
+    ended_here = False
+    pending = []  # (lacing, body) ещё не упакованных частей
+
+    def flush(last=False):
+        nonlocal lacing, body, continued, ended_here
+        granule = samples if ended_here else -1
+        flags = (0x01 if continued else 0) | (0x04 if last else 0)
+        pages.append(make_page(lacing, body, granule, len(pages), flags))
+        lacing, body, ended_here = [], b"", False
+
+    for packet in packets:
+        values = [255] * (len(packet) // 255) + [len(packet) % 255]
+        offset = 0
+        for index, value in enumerate(values):
+            if len(lacing) == max_lacing:
+                # Пакет продолжится на следующей странице, если уже начат
+                continued_next = index > 0
+                flush()
+                continued = continued_next
+            lacing.append(value)
+            body += packet[offset:offset + value]
+            offset += value
+        samples += SAMPLES_PER_PACKET
+        ended_here = True
+        if len(lacing) == max_lacing:
+            flush()
+            continued = False
+    flush(last=True)
+    return b"".join(pages), packets
+
+
+def parse_pages(data: bytes):
+    pages = []
+    pos = 0
+    while pos < len(data):
+        assert data[pos:pos + 4] == b"OggS"
+        count = data[pos + 26]
+        lacing = list(data[pos + 27:pos + 27 + count])
+        length = 27 + count + sum(lacing)
+        raw = data[pos:pos + length]
+        pages.append({
+            "flags": raw[5],
+            "granule": int.from_bytes(raw[6:14], "little", signed=True),
+            "serial": int.from_bytes(raw[14:18], "little"),
+            "sequence": int.from_bytes(raw[18:22], "little"),
+            "crc": int.from_bytes(raw[22:26], "little"),
+            "crc_ok": crc_bitwise(raw[:22] + b"\0\0\0\0" + raw[26:]) == int.from_bytes(raw[22:26], "little"),
+            "lacing": lacing,
+            "body": raw[27 + count:],
+        })
+        pos += length
+    return pages
+
+
+def packets_of(pages):
+    packets, current = [], b""
+    for page in pages:
+        offset = 0
+        for value in page["lacing"]:
+            current += page["body"][offset:offset + value]
+            offset += value
+            if value < 255:
+                packets.append(current)
+                current = b""
+    assert current == b""
+    return packets
+
+
+def test_source_stream_is_valid():
+    data, packets = build_ogg_opus(10)
+    pages = parse_pages(data)
+    assert all(page["crc_ok"] for page in pages)
+    assert packets_of(pages[2:]) == packets
+    assert any(page["granule"] == -1 for page in pages)
+    assert any(page["flags"] & 0x01 for page in pages)
+
+
+def test_split_three_minutes_round_trip():
+    data, packets = build_ogg_opus(180)
+    source_pages = parse_pages(data)
+    segments = main.split_ogg_opus(data, 60)
+    assert len(segments) == 3
+
+    restored = []
+    total_samples = 0
+    for segment in segments:
+        pages = parse_pages(segment)
+        # Заголовки повторяются без изменений
+        assert [p["body"] for p in pages[:2]] == [p["body"] for p in source_pages[:2]]
+        assert pages[0]["flags"] & 0x02
+        assert [p["sequence"] for p in pages] == list(range(len(pages)))
+        assert all(p["crc_ok"] for p in pages)
+        assert all(p["serial"] == SERIAL for p in pages)
+        # Конец потока — только на последней странице куска
+        assert [bool(p["flags"] & 0x04) for p in pages] == [False] * (len(pages) - 1) + [True]
+        # Кусок начинается с целого пакета, а granule отсчитывается от его начала
+        assert not pages[2]["flags"] & 0x01
+        granules = [p["granule"] for p in pages[2:] if p["granule"] != -1]
+        assert granules == sorted(granules)
+        audio_packets = packets_of(pages[2:])
+        assert granules[-1] == len(audio_packets) * SAMPLES_PER_PACKET
+        assert 55 * 48000 <= granules[-1] <= 65 * 48000 or segment is segments[-1]
+        restored += audio_packets
+        total_samples += granules[-1]
+
+    assert restored == packets
+    assert total_samples == len(packets) * SAMPLES_PER_PACKET
+
+
+def test_short_voice_stays_single_segment():
+    data, _ = build_ogg_opus(20)
+    segments = main.split_ogg_opus(data, 60)
+    assert len(segments) == 1
+    pages = parse_pages(segments[0])
+    assert all(p["crc_ok"] for p in pages)
+    assert pages[-1]["flags"] & 0x04